@@ -0,0 +1,116 @@
+import hashlib
+import re
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from config import ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_SIMILARITY, MODEL_CHAT, get_system_message_tutor
+from metrics import metrics
+
+
+class _Entry:
+    def __init__(self, vector: np.ndarray, question: str, answer: str, references: List[dict]):
+        self.vector = vector
+        self.question = question
+        self.answer = answer
+        self.references = references
+        self.hits = 0
+        self.last_used = time.monotonic()
+
+
+# Function to fingerprint everything that shapes a tutor answer besides the question;
+# a changed prompt or model gives a new bucket and the old answers are dropped
+def prompt_fingerprint(current_objective: int) -> str:
+    source = f"{MODEL_CHAT}\n{get_system_message_tutor(current_objective)}"
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()[:16]
+
+
+# Semantic cache of first-turn tutor answers, keyed by (objective, question embedding)
+class AnswerCache:
+    def __init__(self, max_entries: int = ANSWER_CACHE_MAX_ENTRIES, similarity: float = ANSWER_CACHE_SIMILARITY):
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self._buckets: Dict[Tuple[int, str], List[_Entry]] = {}
+        self._matrices: Dict[Tuple[int, str], np.ndarray] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, current_objective: int, embedding: Sequence[float]) -> Optional[_Entry]:
+        key = (current_objective, prompt_fingerprint(current_objective))
+        query = _unit(embedding)
+        with self._lock:
+            entries = self._buckets.get(key)
+            if entries:
+                matrix = self._matrices.get(key)
+                if matrix is None:
+                    matrix = self._matrices[key] = np.stack([entry.vector for entry in entries])
+                scores = matrix @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.similarity:
+                    entry = entries[best]
+                    entry.hits += 1
+                    entry.last_used = time.monotonic()
+                    self.hits += 1
+                    return entry
+            self.misses += 1
+            return None
+
+    def store(self, current_objective: int, embedding: Sequence[float], question: str, answer: str, references: List[dict]):
+        fingerprint = prompt_fingerprint(current_objective)
+        key = (current_objective, fingerprint)
+        with self._lock:
+            for stale in [k for k in self._buckets if k[0] == current_objective and k[1] != fingerprint]:
+                self._drop_bucket(stale)
+            self._buckets.setdefault(key, []).append(_Entry(_unit(embedding), question, answer, references))
+            self._matrices.pop(key, None)
+            while self._size() > self.max_entries:
+                self._evict_one()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": self._size(),
+        }
+
+    def _size(self) -> int:
+        return sum(len(entries) for entries in self._buckets.values())
+
+    # Least frequently used goes first, least recently used breaks ties
+    def _evict_one(self):
+        victim_key, victim_index, victim_rank = None, None, None
+        for key, entries in self._buckets.items():
+            for i, entry in enumerate(entries):
+                rank = (entry.hits, entry.last_used)
+                if victim_rank is None or rank < victim_rank:
+                    victim_key, victim_index, victim_rank = key, i, rank
+        entries = self._buckets[victim_key]
+        del entries[victim_index]
+        self._matrices.pop(victim_key, None)
+        if not entries:
+            self._drop_bucket(victim_key)
+
+    def _drop_bucket(self, key):
+        self._buckets.pop(key, None)
+        self._matrices.pop(key, None)
+
+
+def _unit(embedding: Sequence[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+# Function to replay a cached answer as a stream of text deltas, word by word
+def replay(answer: str) -> Iterator[str]:
+    for piece in re.findall(r"\S+\s*|\s+", answer):
+        yield piece
+
+
+answer_cache = AnswerCache()
+metrics.register_collector("answer_cache", answer_cache.stats)
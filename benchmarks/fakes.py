@@ -0,0 +1,387 @@
+"""Local stand-ins for OpenAI, Pinecone and S3 with configurable latency.
+
+They implement only the calls the tutor makes, return objects with the same
+attribute shapes as the real SDKs, and are installed into the process-wide
+client registry so the app's own code paths run against them unchanged.
+"""
+import asyncio
+import hashlib
+import random
+import re
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+import httpx
+import numpy as np
+import openai
+
+from clients import registry, sdk_max_retries
+from config import LEARNING_OBJECTIVES, OBJECTIVE_COMPLETED_MARKER, PINECONE_INDEX_NAME, PINECONE_NAMESPACE
+
+EMBEDDING_DIMENSION = 1536
+
+
+class FakeLatency:
+    def __init__(self, chat_first_token: float = 0.05, chat_tokens_per_second: float = 1000.0, rewrite: float = 0.05,
+                 embedding: float = 0.02, query: float = 0.02, s3_bytes_per_second: float = 20e6, s3_request: float = 0.02):
+        self.chat_first_token = chat_first_token
+        self.chat_tokens_per_second = chat_tokens_per_second
+        self.rewrite = rewrite
+        self.embedding = embedding
+        self.query = query
+        self.s3_bytes_per_second = s3_bytes_per_second
+        self.s3_request = s3_request
+
+
+# Function to map text to a deterministic unit vector; texts sharing words land close together
+def fake_embedding(text: str, dimension: int = EMBEDDING_DIMENSION) -> List[float]:
+    vector = np.zeros(dimension, dtype=np.float32)
+    for word in re.findall(r"\w+", text.lower()):
+        seed = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+        vector += np.random.default_rng(seed).standard_normal(dimension).astype(np.float32)
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector /= norm
+    return vector.tolist()
+
+
+class _Counter:
+    def __init__(self):
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def hit(self):
+        with self._lock:
+            self.calls += 1
+
+
+# What the SDK raises once its own retries of a 429 are used up
+def _rate_limit_error() -> openai.RateLimitError:
+    response = httpx.Response(429, request=httpx.Request("POST", "https://api.openai.com/v1"))
+    return openai.RateLimitError("Rate limit reached", response=response, body=None)
+
+
+# Delay before the SDK's next retry: exponential from 0.5s up to 8s, less up to a quarter of jitter
+def _sdk_retry_delay(retries_taken: int) -> float:
+    return min(0.5 * 2 ** retries_taken, 8.0) * (1 - 0.25 * random.random())
+
+
+# Provider-side limit: requests per second over a sliding one-second window, None for unlimited.
+# Rejected requests go through the SDK's retry path, max_retries times as configured by the
+# client factories, so every hidden SDK attempt counts against the limit like a real one.
+class _ProviderLimit:
+    def __init__(self, requests_per_second: Optional[float], max_retries: int = 0):
+        self.requests_per_second = requests_per_second
+        self.max_retries = max_retries
+        self.rejected = 0
+        self.sdk_retries = 0
+        self._recent = deque()
+        self._lock = threading.Lock()
+
+    def _try(self) -> bool:
+        if self.requests_per_second is None:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            while self._recent and now - self._recent[0] > 1.0:
+                self._recent.popleft()
+            if len(self._recent) >= self.requests_per_second:
+                self.rejected += 1
+                return False
+            self._recent.append(now)
+            return True
+
+    def admit(self):
+        for retries_taken in range(self.max_retries + 1):
+            if self._try():
+                return
+            if retries_taken < self.max_retries:
+                with self._lock:
+                    self.sdk_retries += 1
+                time.sleep(_sdk_retry_delay(retries_taken))
+        raise _rate_limit_error()
+
+    async def admit_async(self):
+        for retries_taken in range(self.max_retries + 1):
+            if self._try():
+                return
+            if retries_taken < self.max_retries:
+                with self._lock:
+                    self.sdk_retries += 1
+                await asyncio.sleep(_sdk_retry_delay(retries_taken))
+        raise _rate_limit_error()
+
+
+class _FakeStream:
+    def __init__(self, pieces: List[str], latency: FakeLatency, streams: "_Gauge"):
+        self._pieces = pieces
+        self._latency = latency
+        self._streams = streams
+        self._closed = False
+
+    def __iter__(self):
+        self._streams.enter()
+        try:
+            time.sleep(self._latency.chat_first_token)
+            delay = 1.0 / self._latency.chat_tokens_per_second if self._latency.chat_tokens_per_second > 0 else 0.0
+            for piece in self._pieces:
+                if self._closed:
+                    return
+                if delay:
+                    time.sleep(delay)
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))])
+        finally:
+            self._streams.leave()
+
+    def close(self):
+        self._closed = True
+
+
+# The same stream for the async client: waits with asyncio.sleep, so open streams hold no thread
+class _FakeAsyncStream(_FakeStream):
+    async def __aiter__(self):
+        self._streams.enter()
+        try:
+            await asyncio.sleep(self._latency.chat_first_token)
+            delay = 1.0 / self._latency.chat_tokens_per_second if self._latency.chat_tokens_per_second > 0 else 0.0
+            for piece in self._pieces:
+                if self._closed:
+                    return
+                if delay:
+                    await asyncio.sleep(delay)
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))])
+        finally:
+            self._streams.leave()
+
+    async def aclose(self):
+        self._closed = True
+
+
+# Number of streams open at once, and the most seen
+class _Gauge:
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def enter(self):
+        with self._lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+
+    def leave(self):
+        with self._lock:
+            self.current -= 1
+
+
+def _last_user_text(messages: List[dict]) -> str:
+    for message in reversed(messages):
+        if message["role"] == "user":
+            content = message["content"]
+            if isinstance(content, list):
+                return " ".join(part.get("text", "") for part in content if part.get("type") == "text")
+            return content
+    return ""
+
+
+# Function to build a tutor-like answer with paragraphs and a code block
+def fake_answer(question: str, tokens: int, complete: bool) -> str:
+    words = [f"word{i % 50}" for i in range(max(10, tokens - 20))]
+    paragraphs = [" ".join(words[i:i + 40]) + "." for i in range(0, len(words), 40)]
+    body = f"Great question about {question[:60]}!\n\n" + "\n\n".join(paragraphs[:1])
+    body += "\n\n```python\nname = input('Your name? ')\nprint('Hello', name)\n```\n\n" + "\n\n".join(paragraphs[1:])
+    if complete:
+        body += "\n\n" + OBJECTIVE_COMPLETED_MARKER
+    return body
+
+
+class FakeOpenAI:
+    def __init__(self, latency: FakeLatency, answer_tokens: int = 300, complete_marker: str = "[done]",
+                 requests_per_second: Optional[float] = None, max_retries: Optional[int] = None):
+        self.latency = latency
+        self.answer_tokens = answer_tokens
+        self.complete_marker = complete_marker
+        self.limit = _ProviderLimit(requests_per_second, sdk_max_retries() if max_retries is None else max_retries)
+        self.streams = _Gauge()
+        self.chat_calls = _Counter()
+        self.rewrite_calls = _Counter()
+        self.embedding_calls = _Counter()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat))
+        self.embeddings = SimpleNamespace(create=self._embed)
+
+    def _chat(self, model: str, messages: List[dict], stream: bool = False, max_tokens: Optional[int] = None, **kwargs):
+        self.limit.admit()
+        question = _last_user_text(messages)
+        if not stream:  # Query rewrite
+            self.rewrite_calls.hit()
+            time.sleep(self.latency.rewrite)
+            content = f"Standalone: {question}"
+            return SimpleNamespace(
+                choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+                usage=SimpleNamespace(prompt_tokens=sum(len(str(m["content"])) // 4 for m in messages),
+                                      completion_tokens=len(content) // 4),
+            )
+        self.chat_calls.hit()
+        answer = fake_answer(question, self.answer_tokens, self.complete_marker in question)
+        return _FakeStream(re.findall(r"\S+\s*|\s+", answer), self.latency, self.streams)
+
+    def _embed(self, model: str, input, **kwargs):
+        self.limit.admit()
+        self.embedding_calls.hit()
+        time.sleep(self.latency.embedding)
+        texts = input if isinstance(input, list) else [input]
+        return SimpleNamespace(
+            data=[SimpleNamespace(index=i, embedding=fake_embedding(text)) for i, text in enumerate(texts)],
+            usage=SimpleNamespace(prompt_tokens=sum(len(text) // 4 for text in texts)),
+        )
+
+
+# The async client the tutor engine streams answers with; shares the sync fake's limits and counters
+class FakeAsyncOpenAI:
+    def __init__(self, sync: FakeOpenAI):
+        self.sync = sync
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat))
+
+    async def _chat(self, model: str, messages: List[dict], stream: bool = False, max_tokens: Optional[int] = None, **kwargs):
+        fake = self.sync
+        await fake.limit.admit_async()
+        fake.chat_calls.hit()
+        question = _last_user_text(messages)
+        answer = fake_answer(question, fake.answer_tokens, fake.complete_marker in question)
+        return _FakeAsyncStream(re.findall(r"\S+\s*|\s+", answer), fake.latency, fake.streams)
+
+
+# Function to generate a transcript-like corpus: a few chunks per learning objective
+def fake_corpus(chunks_per_objective: int = 20) -> List[dict]:
+    corpus = []
+    for objective_index, objective in enumerate(LEARNING_OBJECTIVES):
+        for i in range(chunks_per_objective):
+            text = (f"In this part of the course about {objective.lower()} Mosh shows example {i}. "
+                    f"We use print() and variables to explain {objective.lower()} step by step.")
+            corpus.append({
+                "id": f"chunk-{objective_index}-{i}",
+                "text": text,
+                "source": f"https://www.youtube.com/watch?v=_uQrJ0TkZl{objective_index % 10}",
+                "objective": objective_index,
+            })
+    return corpus
+
+
+class FakeIndex:
+    def __init__(self, latency: FakeLatency, corpus: Optional[List[dict]] = None):
+        self.latency = latency
+        self.queries = _Counter()
+        self._namespaces: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        if corpus:
+            self.upsert([
+                {"id": chunk["id"], "values": fake_embedding(chunk["text"]),
+                 "metadata": {key: value for key, value in chunk.items() if key != "id"}}
+                for chunk in corpus
+            ], namespace=PINECONE_NAMESPACE)
+
+    def upsert(self, vectors: List[dict], namespace: str = "", **kwargs):
+        with self._lock:
+            space = self._namespaces.setdefault(namespace, {})
+            for vector in vectors:
+                if isinstance(vector, tuple):
+                    vector = {"id": vector[0], "values": vector[1], "metadata": vector[2] if len(vector) > 2 else {}}
+                space[vector["id"]] = (np.asarray(vector["values"], dtype=np.float32), dict(vector.get("metadata") or {}))
+        return {"upserted_count": len(vectors)}
+
+    def query(self, vector, top_k: int = 5, namespace: str = "", include_metadata: bool = False, filter=None, **kwargs):
+        self.queries.hit()
+        time.sleep(self.latency.query)
+        with self._lock:
+            items = list(self._namespaces.get(namespace, {}).items())
+        if filter:
+            items = [(vid, item) for vid, item in items if _matches_filter(item[1], filter)]
+        if not items:
+            return {"matches": []}
+        matrix = np.stack([item[0] for _, item in items])
+        scores = matrix @ np.asarray(vector, dtype=np.float32)
+        order = np.argsort(-scores)[:top_k]
+        matches = []
+        for i in order:
+            match = {"id": items[i][0], "score": float(scores[i])}
+            if include_metadata:
+                match["metadata"] = items[i][1][1]
+            matches.append(match)
+        return {"matches": matches}
+
+    def list(self, namespace: str = "", limit: int = 100, **kwargs):
+        with self._lock:
+            ids = list(self._namespaces.get(namespace, {}))
+        for start in range(0, len(ids), limit):
+            yield ids[start:start + limit]
+
+    def fetch(self, ids: List[str], namespace: str = "", **kwargs):
+        with self._lock:
+            space = self._namespaces.get(namespace, {})
+            vectors = {vid: SimpleNamespace(id=vid, values=space[vid][0].tolist(), metadata=space[vid][1])
+                       for vid in ids if vid in space}
+        return SimpleNamespace(vectors=vectors)
+
+    def update(self, id: str, set_metadata: Optional[dict] = None, namespace: str = "", **kwargs):
+        with self._lock:
+            space = self._namespaces.get(namespace, {})
+            if id in space and set_metadata:
+                space[id][1].update(set_metadata)
+
+
+# Function to apply the subset of Pinecone's metadata filter the tutor uses: equality, $eq and $in
+def _matches_filter(metadata: dict, filter: dict) -> bool:
+    for key, condition in filter.items():
+        value = metadata.get(key)
+        if isinstance(condition, dict):
+            if "$eq" in condition and value != condition["$eq"]:
+                return False
+            if "$in" in condition and value not in condition["$in"]:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+# moto-style in-memory S3: objects land in a dict instead of a bucket
+class FakeS3:
+    def __init__(self, latency: FakeLatency):
+        self.latency = latency
+        self.objects: Dict[tuple, bytes] = {}
+        self._lock = threading.Lock()
+
+    def upload_fileobj(self, file, bucket: str, key: str, ExtraArgs: Optional[dict] = None, **kwargs):
+        self.put_object(Bucket=bucket, Key=key, Body=file.read(), **(ExtraArgs or {}))
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes, **kwargs):
+        time.sleep(self.latency.s3_request + len(Body) / self.latency.s3_bytes_per_second)
+        with self._lock:
+            self.objects[(Bucket, Key)] = Body
+        return {"ETag": hashlib.md5(Body).hexdigest()}
+
+    def head_object(self, Bucket: str, Key: str, **kwargs):
+        with self._lock:
+            if (Bucket, Key) not in self.objects:
+                raise KeyError(Key)
+            return {"ContentLength": len(self.objects[(Bucket, Key)])}
+
+
+# Function to swap the real SDK clients for fakes in the process-wide registry
+def install_fakes(openai_api_key: str, pinecone_api_key: str, latency: Optional[FakeLatency] = None,
+                  answer_tokens: int = 300, corpus: Optional[List[dict]] = None, openai_requests_per_second: Optional[float] = None,
+                  openai_max_retries: Optional[int] = None):
+    latency = latency or FakeLatency()
+    fakes = SimpleNamespace(
+        openai=FakeOpenAI(latency, answer_tokens=answer_tokens, requests_per_second=openai_requests_per_second,
+                          max_retries=openai_max_retries),
+        index=FakeIndex(latency, corpus if corpus is not None else fake_corpus()),
+        s3=FakeS3(latency),
+    )
+    registry.install("openai", openai_api_key, fakes.openai)
+    registry.install("openai_async", openai_api_key, FakeAsyncOpenAI(fakes.openai))
+    registry.install(f"pinecone:{PINECONE_INDEX_NAME}", pinecone_api_key, fakes.index)
+    registry.install("s3", "", fakes.s3)
+    return fakes
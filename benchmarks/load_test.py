@@ -0,0 +1,124 @@
+"""Multi-user load generator for one tutor process.
+
+Starts N simulated students at once (a class-wide burst) against the local
+fakes, each running the scripted conversation through get_context and
+generate_ai_response from its own thread, the way concurrent Streamlit
+sessions share one server. The fake OpenAI can enforce a provider-side
+requests-per-second limit to show how the concurrency governor absorbs 429s.
+
+Usage (from the repository root):
+    python -m benchmarks.load_test --sessions 50 --provider-rps 40
+    python -m benchmarks.load_test --sessions 50 --provider-rps 40 --no-governor
+"""
+import argparse
+import threading
+import time
+
+# Benchmarks must never touch the real embedding or conversation stores or bind the metrics port
+import config
+
+config.EMBEDDING_CACHE_PATH = None
+config.CONVERSATION_STORE_PATH = None
+config.METRICS_PORT = None
+
+from benchmarks.fakes import FakeLatency, install_fakes  # noqa: E402
+from benchmarks.run_bench import OPENAI_KEY, PINECONE_KEY, SCRIPT, percentile  # noqa: E402
+from clients import sdk_max_retries  # noqa: E402
+from governor import governor, set_session  # noqa: E402
+from metrics import metrics  # noqa: E402
+from retrieval import get_context  # noqa: E402
+from tutor import generate_ai_response, stream_text  # noqa: E402
+
+
+class _Results:
+    def __init__(self):
+        self.turn_times = []
+        self.ttfts = []
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def add(self, turn_time: float, ttft: float, error: str = None):
+        with self._lock:
+            self.turn_times.append(turn_time)
+            if error is None:
+                self.ttfts.append(ttft)
+            else:
+                self.errors.append(error)
+
+
+# Function to play one student's conversation on an objective
+def run_student(session_index: int, objective_index: int, start: threading.Barrier, results: _Results):
+    set_session(f"load-{session_index}")
+    topic = config.LEARNING_OBJECTIVES[objective_index].lower()
+    chat_history = []
+    start.wait()
+    for message in SCRIPT:
+        text = message.format(topic=topic)
+        chat_history.append({"role": "user", "content": text})
+        turn_started = time.perf_counter()
+        ttft = None
+        try:
+            _, references = get_context(text, chat_history, OPENAI_KEY, PINECONE_KEY, current_objective=objective_index)
+            response = generate_ai_response(text, references, OPENAI_KEY, chat_history, objective_index)
+            if isinstance(response, str):  # Error occurred
+                results.add(time.perf_counter() - turn_started, 0.0, response)
+                chat_history.pop()
+                continue
+            answer = ""
+            for delta in stream_text(response):
+                if ttft is None:
+                    ttft = time.perf_counter() - turn_started
+                answer += delta
+        except Exception as e:
+            results.add(time.perf_counter() - turn_started, 0.0, str(e))
+            chat_history.pop()
+            continue
+        results.add(time.perf_counter() - turn_started, ttft or 0.0)
+        chat_history.append({"role": "assistant", "content": answer, "references": references})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate concurrent students against local fakes.")
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--objectives", type=int, default=3, help="Students are spread over this many objectives")
+    parser.add_argument("--provider-rps", type=float, default=40.0, help="Fake OpenAI requests per second before it answers 429")
+    parser.add_argument("--answer-tokens", type=int, default=200)
+    parser.add_argument("--chat-first-token", type=float, default=0.3)
+    parser.add_argument("--token-rate", type=float, default=400.0)
+    parser.add_argument("--no-governor", action="store_true", help="Call the fakes directly, for comparison")
+    args = parser.parse_args()
+
+    fakes = install_fakes(OPENAI_KEY, PINECONE_KEY, FakeLatency(chat_first_token=args.chat_first_token, chat_tokens_per_second=args.token_rate),
+                          answer_tokens=args.answer_tokens, openai_requests_per_second=args.provider_rps,
+                          openai_max_retries=sdk_max_retries(governed=not args.no_governor))
+    governor.enabled = not args.no_governor
+
+    results = _Results()
+    start = threading.Barrier(args.sessions)
+    students = [
+        threading.Thread(target=run_student, args=(i, i % max(1, args.objectives), start, results), name=f"student-{i}")
+        for i in range(args.sessions)
+    ]
+    wall_start = time.perf_counter()
+    for student in students:
+        student.start()
+    for student in students:
+        student.join()
+    wall_seconds = time.perf_counter() - wall_start
+
+    counters = metrics.snapshot()["counters"].get("governor", {})
+    turns = len(results.turn_times)
+    print(f"{args.sessions} students, {turns} turns in {wall_seconds:.1f}s, governor {'on' if governor.enabled else 'off'}")
+    print(f"turn latency   p50 {percentile(results.turn_times, 0.5) * 1000:8.1f} ms   "
+          f"p95 {percentile(results.turn_times, 0.95) * 1000:8.1f} ms   p99 {percentile(results.turn_times, 0.99) * 1000:8.1f} ms")
+    print(f"ttft           p50 {percentile(results.ttfts, 0.5) * 1000:8.1f} ms   p95 {percentile(results.ttfts, 0.95) * 1000:8.1f} ms")
+    print(f"failed turns   {len(results.errors)}" + (f"  (first: {results.errors[0][:120]})" if results.errors else ""))
+    print(f"provider 429s  {fakes.openai.limit.rejected} (SDK retries {fakes.openai.limit.sdk_retries})   "
+          f"peak concurrent streams {fakes.openai.streams.peak}")
+    print(f"upstream calls chat {fakes.openai.chat_calls.calls}, rewrite {fakes.openai.rewrite_calls.calls}, "
+          f"embedding {fakes.openai.embedding_calls.calls}, vector_query {fakes.index.queries.calls}")
+    print(f"governor       {governor.stats()}  {counters}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""Offline benchmark of the tutor's chat turns against local fakes.
+
+Drives scripted multi-turn sessions through every learning objective using
+Streamlit's AppTest, so the real script (retrieval, generation, streaming,
+transcript rendering, objective advance) runs end to end without network
+access or spend. Reports latency percentiles, allocation peaks and CPU cost
+per turn, and compares them against a baseline recorded on the same machine
+(baselines are machine-specific and are not committed).
+
+Usage (from the repository root):
+    python -m benchmarks.run_bench                      # run and compare to benchmarks/baseline.json, if recorded
+    python -m benchmarks.run_bench --update-baseline    # record a new baseline on this machine
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+# Benchmarks must never touch the real embedding or conversation stores or bind the metrics port
+import config
+
+config.EMBEDDING_CACHE_PATH = None
+config.CONVERSATION_STORE_PATH = None
+config.METRICS_PORT = None
+
+from streamlit.testing.v1 import AppTest  # noqa: E402
+
+from benchmarks.fakes import FakeLatency, install_fakes  # noqa: E402
+from metrics import metrics  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_PATH = os.path.join(ROOT, "learning_app_streamlit.py")
+DEFAULT_BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+OPENAI_KEY = "bench-openai-key"
+PINECONE_KEY = "bench-pinecone-key"
+
+# One scripted conversation per objective; the last message makes the fake tutor complete it
+SCRIPT = [
+    "What is {topic}?",
+    "Can you show me an example of it?",
+    "Why does that work the way it does?",
+    "Thanks, I think I understand now [done]",
+]
+# Values compared against the baseline (lower is better for all of them)
+GUARDED = ["turn_p50", "turn_p95", "advance_p95", "ttft_p95", "cpu_ms_per_turn", "alloc_peak_kib_p95"]
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _run_timed(app, action, samples, alloc_peaks):
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    action()
+    samples.append(time.perf_counter() - start)
+    alloc_peaks.append(tracemalloc.get_traced_memory()[1] / 1024)
+    if app.exception:
+        raise RuntimeError(f"App raised: {[e.value for e in app.exception]}")
+
+
+# Function to drive one student through the scripted objectives
+def run_session(turns, objectives, timeout, turn_times, advance_times, alloc_peaks):
+    app = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    app.secrets["OPENAI_API_KEY"] = OPENAI_KEY
+    app.secrets["PINECONE_API_KEY"] = PINECONE_KEY
+    app.secrets["S3_BASE_URL"] = "https://bench-bucket.local"
+    app.run()
+    for objective_index in range(objectives):
+        topic = config.LEARNING_OBJECTIVES[objective_index].lower()
+        script = SCRIPT[:turns - 1] + SCRIPT[-1:]
+        for message in script:
+            text = message.format(topic=topic)
+            _run_timed(app, lambda: app.chat_input[0].set_value(text).run(), turn_times, alloc_peaks)
+        if objective_index < objectives - 1:
+            next_button = [button for button in app.button if button.key == "next_objective"]
+            if not next_button:
+                raise RuntimeError(f"Objective {objective_index} did not complete")
+            _run_timed(app, lambda: next_button[0].click().run(), advance_times, alloc_peaks)
+            # A browser drops the elements drawn before st.rerun(); AppTest keeps them in its
+            # tree with widget state that no longer exists, so redraw from session state
+            app.run()
+
+
+def run(args) -> dict:
+    latency = FakeLatency(
+        chat_first_token=args.chat_first_token,
+        chat_tokens_per_second=args.token_rate,
+        rewrite=args.rewrite_latency,
+        embedding=args.embedding_latency,
+        query=args.query_latency,
+    )
+    fakes = install_fakes(OPENAI_KEY, PINECONE_KEY, latency, answer_tokens=args.answer_tokens)
+
+    turn_times, advance_times, alloc_peaks = [], [], []
+    tracemalloc.start(1)
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    for _ in range(args.sessions):
+        run_session(args.turns, args.objectives, args.timeout, turn_times, advance_times, alloc_peaks)
+    cpu_seconds, wall_seconds = time.process_time() - cpu_start, time.perf_counter() - wall_start
+    tracemalloc.stop()
+
+    stages = metrics.snapshot()["stages"]
+    turns = len(turn_times)
+    return {
+        "sessions": args.sessions,
+        "turns": turns,
+        "turn_p50": percentile(turn_times, 0.5),
+        "turn_p95": percentile(turn_times, 0.95),
+        "turn_p99": percentile(turn_times, 0.99),
+        "advance_p50": percentile(advance_times, 0.5),
+        "advance_p95": percentile(advance_times, 0.95),
+        "ttft_p50": stages.get("ttft", {}).get("p50", 0.0),
+        "ttft_p95": stages.get("ttft", {}).get("p95", 0.0),
+        "alloc_peak_kib_p50": percentile(alloc_peaks, 0.5),
+        "alloc_peak_kib_p95": percentile(alloc_peaks, 0.95),
+        "cpu_ms_per_turn": 1000 * cpu_seconds / max(1, turns),
+        "turns_per_cpu_second": turns / cpu_seconds if cpu_seconds else 0.0,
+        "turns_per_second": turns / wall_seconds if wall_seconds else 0.0,
+        "stages": stages,
+        "calls": {
+            "chat": fakes.openai.chat_calls.calls,
+            "rewrite": fakes.openai.rewrite_calls.calls,
+            "embedding": fakes.openai.embedding_calls.calls,
+            "vector_query": fakes.index.queries.calls,
+        },
+    }
+
+
+# Function to list the guarded values that got worse than baseline * (1 + tolerance)
+def compare(result: dict, baseline: dict, tolerance: float):
+    regressions = []
+    for key in GUARDED:
+        if key not in baseline or not baseline[key]:
+            continue
+        limit = baseline[key] * (1 + tolerance)
+        if result[key] > limit:
+            regressions.append(f"{key}: {result[key]:.4f} > {limit:.4f} (baseline {baseline[key]:.4f})")
+    return regressions
+
+
+def print_report(result: dict):
+    print(f"{result['sessions']} sessions, {result['turns']} turns")
+    print(f"turn latency   p50 {result['turn_p50'] * 1000:8.1f} ms   p95 {result['turn_p95'] * 1000:8.1f} ms   p99 {result['turn_p99'] * 1000:8.1f} ms")
+    print(f"advance        p50 {result['advance_p50'] * 1000:8.1f} ms   p95 {result['advance_p95'] * 1000:8.1f} ms")
+    print(f"ttft           p50 {result['ttft_p50'] * 1000:8.1f} ms   p95 {result['ttft_p95'] * 1000:8.1f} ms")
+    print(f"alloc peak     p50 {result['alloc_peak_kib_p50']:8.0f} KiB  p95 {result['alloc_peak_kib_p95']:8.0f} KiB")
+    print(f"cpu per turn   {result['cpu_ms_per_turn']:8.1f} ms   ({result['turns_per_cpu_second']:.1f} turns per CPU-second, "
+          f"{result['turns_per_second']:.1f} turns/s wall)")
+    print("stages:")
+    for stage, stats in sorted(result["stages"].items()):
+        print(f"  {stage:28s} n={stats['count']:<5d} p50 {stats['p50'] * 1000:8.1f} ms   p95 {stats['p95'] * 1000:8.1f} ms")
+    print(f"upstream calls: {result['calls']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark chat turns offline against local fakes.")
+    parser.add_argument("--sessions", type=int, default=2)
+    parser.add_argument("--turns", type=int, default=len(SCRIPT), help="Messages per objective, the last one completes it")
+    parser.add_argument("--objectives", type=int, default=len(config.LEARNING_OBJECTIVES))
+    parser.add_argument("--answer-tokens", type=int, default=300)
+    parser.add_argument("--chat-first-token", type=float, default=0.05, help="Seconds before the first streamed token")
+    parser.add_argument("--token-rate", type=float, default=1000.0, help="Streamed tokens per second")
+    parser.add_argument("--rewrite-latency", type=float, default=0.05)
+    parser.add_argument("--embedding-latency", type=float, default=0.02)
+    parser.add_argument("--query-latency", type=float, default=0.02)
+    parser.add_argument("--timeout", type=float, default=60.0, help="Seconds allowed per script run")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown against the baseline")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--json", help="Also write the full result to this file")
+    args = parser.parse_args()
+    args.turns = max(1, args.turns)
+    args.objectives = max(1, min(args.objectives, len(config.LEARNING_OBJECTIVES)))
+
+    result = run(args)
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({key: result[key] for key in GUARDED}, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --update-baseline to record one")
+        return
+    with open(args.baseline) as f:
+        regressions = compare(result, json.load(f), args.tolerance)
+    if regressions:
+        print("REGRESSION against baseline:")
+        for line in regressions:
+            print(f"  {line}")
+        sys.exit(1)
+    print("No regressions against baseline")
+
+
+if __name__ == "__main__":
+    main()
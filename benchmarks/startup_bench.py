@@ -0,0 +1,150 @@
+"""Cold-start and rerun-time benchmark of the Streamlit script.
+
+Each sample starts a fresh interpreter, so module imports and the once-per-process
+startup are paid in full. Inside it the script's first run is timed (cold start),
+followed by reruns with no input, which is what every widget interaction costs.
+The child also reports which heavy optional modules the first run imported;
+boto3, botocore, pinecone, agentops and PIL should load only when they are used.
+
+Usage (from the repository root):
+    python -m benchmarks.startup_bench                      # run and compare to benchmarks/startup_baseline.json, if recorded
+    python -m benchmarks.startup_bench --update-baseline    # record a new baseline on this machine
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(ROOT, "benchmarks", "startup_baseline.json")
+# Imported lazily by the app; none of them is needed to draw the page
+LAZY_MODULES = ["boto3", "botocore", "pinecone", "agentops", "PIL"]
+# Values compared against the baseline (lower is better for all of them)
+GUARDED = ["cold_start_p50", "first_run_p50", "rerun_p50", "rerun_p95"]
+
+
+# Function to time the first run and the reruns in this (fresh) process; prints the result as JSON
+def child(reruns: int, timeout: float):
+    started = time.perf_counter()
+    import config
+
+    config.EMBEDDING_CACHE_PATH = None
+    config.CONVERSATION_STORE_PATH = None
+    config.METRICS_PORT = None
+
+    from streamlit.testing.v1 import AppTest
+
+    from benchmarks.fakes import install_fakes
+    from benchmarks.run_bench import APP_PATH, OPENAI_KEY, PINECONE_KEY
+
+    install_fakes(OPENAI_KEY, PINECONE_KEY)
+    harness = time.perf_counter() - started
+
+    app = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    app.secrets["OPENAI_API_KEY"] = OPENAI_KEY
+    app.secrets["PINECONE_API_KEY"] = PINECONE_KEY
+    run_started = time.perf_counter()
+    app.run()
+    first_run = time.perf_counter() - run_started
+    if app.exception:
+        raise RuntimeError(f"App raised: {[e.value for e in app.exception]}")
+    imported = sorted(name for name in LAZY_MODULES if name in sys.modules)
+
+    rerun_times = []
+    for _ in range(reruns):
+        run_started = time.perf_counter()
+        app.run()
+        rerun_times.append(time.perf_counter() - run_started)
+    print(json.dumps({"harness": harness, "first_run": first_run, "reruns": rerun_times, "lazy_imported": imported}))
+
+
+def _sample(reruns: int, timeout: float) -> dict:
+    started = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.startup_bench", "--child", "--reruns", str(reruns), "--timeout", str(timeout)],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    ).stdout
+    sample = json.loads(output.strip().splitlines()[-1])
+    sample["process"] = time.perf_counter() - started
+    return sample
+
+
+def run(args) -> dict:
+    from benchmarks.run_bench import percentile
+
+    samples = [_sample(args.reruns, args.timeout) for _ in range(args.samples)]
+    cold_starts = [sample["process"] - sample["harness"] for sample in samples]
+    first_runs = [sample["first_run"] for sample in samples]
+    reruns = [seconds for sample in samples for seconds in sample["reruns"]]
+    return {
+        "samples": len(samples),
+        "cold_start_p50": percentile(cold_starts, 0.5),
+        "first_run_p50": percentile(first_runs, 0.5),
+        "first_run_max": max(first_runs),
+        "rerun_p50": percentile(reruns, 0.5),
+        "rerun_p95": percentile(reruns, 0.95),
+        "lazy_imported": sorted({name for sample in samples for name in sample["lazy_imported"]}),
+    }
+
+
+# Function to list the guarded values that got worse than baseline * (1 + tolerance)
+def compare(result: dict, baseline: dict, tolerance: float):
+    regressions = []
+    for key in GUARDED:
+        if not baseline.get(key):
+            continue
+        limit = baseline[key] * (1 + tolerance)
+        if result[key] > limit:
+            regressions.append(f"{key}: {result[key] * 1000:.1f} ms > {limit * 1000:.1f} ms (baseline {baseline[key] * 1000:.1f} ms)")
+    return regressions
+
+
+def print_report(result: dict):
+    print(f"{result['samples']} fresh processes")
+    print(f"cold start     p50 {result['cold_start_p50'] * 1000:8.1f} ms   (interpreter, imports and first run)")
+    print(f"first run      p50 {result['first_run_p50'] * 1000:8.1f} ms   max {result['first_run_max'] * 1000:8.1f} ms")
+    print(f"rerun          p50 {result['rerun_p50'] * 1000:8.1f} ms   p95 {result['rerun_p95'] * 1000:8.1f} ms")
+    print(f"lazy modules imported on the first run: {result['lazy_imported'] or 'none'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the app's cold start and rerun time offline.")
+    parser.add_argument("--samples", type=int, default=5, help="Fresh processes to start")
+    parser.add_argument("--reruns", type=int, default=20, help="Reruns timed in each process")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Seconds allowed per script run")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown against the baseline")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.reruns, args.timeout)
+        return
+
+    result = run(args)
+    print_report(result)
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({key: result[key] for key in GUARDED}, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        return
+    regressions = []
+    if result["lazy_imported"]:
+        regressions.append(f"lazily imported modules loaded on the first run: {', '.join(result['lazy_imported'])}")
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions += compare(result, json.load(f), args.tolerance)
+    else:
+        print(f"No baseline at {args.baseline}; run with --update-baseline to record one")
+    if regressions:
+        print("REGRESSION against baseline:")
+        for line in regressions:
+            print(f"  {line}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+import hashlib
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import httpx
+from openai import DEFAULT_MAX_RETRIES, AsyncOpenAI, OpenAI
+
+from config import (
+    CLIENT_IDLE_TTL,
+    CLIENT_KEEPALIVE_EXPIRY,
+    CLIENT_POOL_MAX_CONNECTIONS,
+    CLIENT_POOL_MAX_KEEPALIVE,
+    GOVERNOR_ENABLED,
+    PINECONE_INDEX_NAME,
+    PINECONE_POOL_THREADS,
+    S3_MAX_POOL_CONNECTIONS,
+)
+from metrics import logger, metrics
+
+
+# A pooled client plus what we need to close it and check it is still usable
+class _Entry:
+    def __init__(self, client: Any, close: Optional[Callable[[], None]] = None, is_alive: Optional[Callable[[], bool]] = None):
+        self.client = client
+        self.close = close
+        self.is_alive = is_alive
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.uses = 0
+
+
+# Process-wide registry of network clients. Imported modules survive Streamlit
+# reruns, so every session and rerun in this process shares the same pools.
+class ClientRegistry:
+    def __init__(self, idle_ttl: float = CLIENT_IDLE_TTL):
+        self.idle_ttl = idle_ttl
+        self._entries: Dict[Tuple[str, str], _Entry] = {}
+        self._lock = threading.Lock()
+
+    def get(self, kind: str, api_key: str, factory: Callable[[], _Entry]) -> Any:
+        key = (kind, _fingerprint(api_key))
+        with self._lock:
+            self._evict_idle_locked()
+            entry = self._entries.get(key)
+            if entry is not None and entry.is_alive is not None and not entry.is_alive():
+                self._close_entry(entry)
+                entry = None
+            if entry is None:
+                entry = factory()
+                self._entries[key] = entry
+            entry.last_used = time.monotonic()
+            entry.uses += 1
+            return entry.client
+
+    # Put a ready-made client in place of the real one (benchmarks use this for local fakes)
+    def install(self, kind: str, api_key: str, client: Any, close: Optional[Callable[[], None]] = None):
+        with self._lock:
+            previous = self._entries.pop((kind, _fingerprint(api_key)), None)
+            if previous is not None:
+                self._close_entry(previous)
+            self._entries[(kind, _fingerprint(api_key))] = _Entry(client, close=close)
+
+    # Drop clients whose pools were closed underneath us and report the rest
+    def health_check(self) -> Dict[str, dict]:
+        report = {}
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle_locked()
+            for (kind, fingerprint), entry in list(self._entries.items()):
+                alive = entry.is_alive() if entry.is_alive is not None else True
+                report[f"{kind}:{fingerprint}"] = {
+                    "alive": alive,
+                    "uses": entry.uses,
+                    "age_seconds": round(now - entry.created, 1),
+                    "idle_seconds": round(now - entry.last_used, 1),
+                }
+                if not alive:
+                    self._close_entry(entry)
+                    del self._entries[(kind, fingerprint)]
+        return report
+
+    # Function to run the health check on every metrics export, reported as numbers
+    def stats(self) -> dict:
+        report = self.health_check()
+        alive = sum(1 for entry in report.values() if entry["alive"])
+        return {
+            "pooled": alive,
+            "dead_closed": len(report) - alive,
+            "max_idle_seconds": max((entry["idle_seconds"] for entry in report.values()), default=0.0),
+        }
+
+    def close_all(self):
+        with self._lock:
+            for entry in self._entries.values():
+                self._close_entry(entry)
+            self._entries.clear()
+
+    def _evict_idle_locked(self) -> int:
+        now = time.monotonic()
+        stale = [key for key, entry in self._entries.items() if now - entry.last_used > self.idle_ttl]
+        for key in stale:
+            self._close_entry(self._entries.pop(key))
+        return len(stale)
+
+    @staticmethod
+    def _close_entry(entry: _Entry):
+        if entry.close is None:
+            return
+        try:
+            entry.close()
+        except Exception as e:
+            logger.warning("Error closing pooled client: %s", e)
+
+
+def _fingerprint(api_key: str) -> str:
+    # Never keep raw API keys around as registry keys
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+
+
+registry = ClientRegistry()
+metrics.register_collector("clients", registry.stats)
+
+
+# Function to get how often the OpenAI SDK itself retries a failed request. Under the governor,
+# never: it retries 429s with jittered backoff, Retry-After and fair queueing, and SDK retries
+# underneath would multiply its attempts and bypass all three.
+def sdk_max_retries(governed: bool = GOVERNOR_ENABLED) -> int:
+    return 0 if governed else DEFAULT_MAX_RETRIES
+
+
+# Function to get a pooled OpenAI client with keep-alive connections
+def get_openai_client(api_key: str) -> OpenAI:
+    def factory() -> _Entry:
+        http_client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=CLIENT_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=CLIENT_POOL_MAX_KEEPALIVE,
+                keepalive_expiry=CLIENT_KEEPALIVE_EXPIRY,
+            ),
+        )
+        client = OpenAI(api_key=api_key, http_client=http_client, max_retries=sdk_max_retries())
+        return _Entry(client, close=http_client.close, is_alive=lambda: not http_client.is_closed)
+
+    return registry.get("openai", api_key, factory)
+
+
+# Function to get a pooled asyncio OpenAI client for the tutor engine. Its connections
+# belong to the engine's event loop; an evicted client is dropped rather than closed,
+# since closing it has to happen on that loop.
+def get_async_openai_client(api_key: str) -> AsyncOpenAI:
+    def factory() -> _Entry:
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=CLIENT_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=CLIENT_POOL_MAX_KEEPALIVE,
+                keepalive_expiry=CLIENT_KEEPALIVE_EXPIRY,
+            ),
+        )
+        client = AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=sdk_max_retries())
+        return _Entry(client, is_alive=lambda: not http_client.is_closed)
+
+    return registry.get("openai_async", api_key, factory)
+
+
+# Function to get a pooled Pinecone index handle
+def get_pinecone_index(api_key: str, index_name: str = PINECONE_INDEX_NAME):
+    def factory() -> _Entry:
+        from pinecone import Pinecone  # Imported on first use; the local retrieval backend never needs it
+
+        pc = Pinecone(api_key=api_key, pool_threads=PINECONE_POOL_THREADS)
+        index = pc.Index(index_name, pool_threads=PINECONE_POOL_THREADS)
+        return _Entry(index, close=lambda: index.__exit__(None, None, None))
+
+    return registry.get(f"pinecone:{index_name}", api_key, factory)
+
+
+# Function to get the shared S3 client (credentials come from the environment)
+def get_s3_client():
+    def factory() -> _Entry:
+        import boto3  # Imported on first use; most sessions never attach an image
+        from botocore.config import Config as BotoConfig
+
+        client = boto3.client(
+            "s3",
+            config=BotoConfig(max_pool_connections=S3_MAX_POOL_CONNECTIONS, tcp_keepalive=True),
+        )
+        return _Entry(client, close=client.close)
+
+    return registry.get("s3", "", factory)
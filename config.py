@@ -18,25 +18,25 @@ LEARNING_OBJECTIVES = [
 ]
 
 # Prompts
+OBJECTIVE_COMPLETED_MARKER = "OBJECTIVE_COMPLETED"  # Emitted by the tutor when the student has completed the objective; never rendered
 SYSTEM_MESSAGE_QUERY_GENERATION = "Given the following conversation and the user's final question, rephrase the final question to be a standalone question. Keep it short but capture everything that's relevant"
 
-# Dynamic System Message for Tutor
-def get_system_message_tutor(current_objective):
-    objective_messages = {
-        0: "Introduce Python and its various applications in different fields.",
-        1: "Guide the student through writing their first Python program, explaining basic syntax and structure.",
-        2: "Explain the concept of variables, their naming conventions, and different data types in Python.",
-        3: "Teach how to receive user input and perform type conversion between different data types.",
-        4: "Demonstrate string manipulation techniques and explain arithmetic operators and their precedence.",
-        5: "Introduce comparison and logical operators, showing how they're used in Python.",
-        6: "Explain conditional statements, focusing on if-else structures and their usage.",
-        7: "Introduce while loops, explaining their syntax and when to use them.",
-        8: "Teach about lists, their properties, and common methods used with lists.",
-        9: "Explain for loops and how to use the range() function for iteration.",
-        10: "Introduce tuples, their properties, and how they differ from lists."
-    }
-    
-    base_message = """You are Mosh, an AI assistant created by the youtuber, Mosh teaching Python programming. Your sole focus at this moment is on getting the user through the following objective: "{objective}". If you believe the student has completed the current objective, add "OBJECTIVE_COMPLETED" at the end of your response.
+# Per-objective focus of the tutor prompt
+TUTOR_OBJECTIVE_MESSAGES = {
+    0: "Introduce Python and its various applications in different fields.",
+    1: "Guide the student through writing their first Python program, explaining basic syntax and structure.",
+    2: "Explain the concept of variables, their naming conventions, and different data types in Python.",
+    3: "Teach how to receive user input and perform type conversion between different data types.",
+    4: "Demonstrate string manipulation techniques and explain arithmetic operators and their precedence.",
+    5: "Introduce comparison and logical operators, showing how they're used in Python.",
+    6: "Explain conditional statements, focusing on if-else structures and their usage.",
+    7: "Introduce while loops, explaining their syntax and when to use them.",
+    8: "Teach about lists, their properties, and common methods used with lists.",
+    9: "Explain for loops and how to use the range() function for iteration.",
+    10: "Introduce tuples, their properties, and how they differ from lists."
+}
+
+SYSTEM_PREFIX_TUTOR_TEMPLATE = """You are Mosh, an AI assistant created by the youtuber, Mosh teaching Python programming. Your sole focus at this moment is on getting the user through the following objective: "{objective}". If you believe the student has completed the current objective, add "{marker}" at the end of your response.
     Make sure to keep the discussion focused on the current objective. Keep it light, playful, and engaging. You will be interacting with a complete beginner so you have to be methodical and prescriptive.
 
 Your role is to:
@@ -57,10 +57,26 @@ You are currently playing out one objective of the course. The entire course con
     "Work with lists and their methods",
     "Utilize for loops and the range() function",
     "Understand and use tuples"
+"""
+
+# Tutor prompt prefixes of every objective, formatted once at import
+SYSTEM_PREFIXES_TUTOR = {
+    index: SYSTEM_PREFIX_TUTOR_TEMPLATE.format(objective=message, marker=OBJECTIVE_COMPLETED_MARKER) for index, message in TUTOR_OBJECTIVE_MESSAGES.items()
+}
+_SYSTEM_PREFIX_TUTOR_DEFAULT = SYSTEM_PREFIX_TUTOR_TEMPLATE.format(objective="Python programming", marker=OBJECTIVE_COMPLETED_MARKER)
+
+# Static part of the tutor prompt for one objective (no references), kept first so provider-side prompt caching can hit
+def get_system_prefix_tutor(current_objective):
+    return SYSTEM_PREFIXES_TUTOR.get(current_objective, _SYSTEM_PREFIX_TUTOR_DEFAULT)
+
+# Video references appended to the tutor prompt
+SYSTEM_MESSAGE_CONTEXT = "Here are some references from the videos you have on this topic:\n\n{context}"
 
-Here are some references from the videos you have on this topic:\n\n{context}"""
+SYSTEM_MESSAGES_TUTOR = {index: prefix + "\n" + SYSTEM_MESSAGE_CONTEXT for index, prefix in SYSTEM_PREFIXES_TUTOR.items()}
 
-    return base_message.format(objective=objective_messages.get(current_objective, "Python programming"), context="{context}")
+# Dynamic System Message for Tutor, with a {context} placeholder for the references
+def get_system_message_tutor(current_objective):
+    return SYSTEM_MESSAGES_TUTOR.get(current_objective) or get_system_prefix_tutor(current_objective) + "\n" + SYSTEM_MESSAGE_CONTEXT
 
 # Replace the static SYSTEM_MESSAGE_TUTOR with this function
 # SYSTEM_MESSAGE_TUTOR = get_system_message_tutor(current_objective)
@@ -68,14 +84,172 @@ Here are some references from the videos you have on this topic:\n\n{context}"""
 # S3 Configuration
 S3_BUCKET = "zoe-images"
 
+# Image Ingest (attached images are downscaled and re-encoded before they reach the vision model)
+IMAGE_MAX_LONG_SIDE = 2048  # The vision model fits high-detail images into 2048x2048...
+IMAGE_MAX_SHORT_SIDE = 768  # ...and then scales the short side down to 768px
+IMAGE_JPEG_QUALITY = 85
+IMAGE_INLINE_MAX_BYTES = 256 * 1024  # Smaller images are sent inline as data URLs instead of via S3
+IMAGE_UPLOAD_WORKERS = 4
+IMAGE_URL_CACHE_SIZE = 1024  # Content hashes of uploaded images remembered per process
+IMAGE_UPLOAD_TIMEOUT = 15.0  # Seconds to wait for the upload once the context is ready
+
 # Pinecone Configuration
 PINECONE_INDEX_NAME = "project-management"
 PINECONE_NAMESPACE = "programming_with_mosh_python_for_beginners"
 
+# Retrieval Configuration
+RETRIEVAL_BACKEND = "pinecone"  # "pinecone" queries the remote index, "local" searches the snapshot in LOCAL_INDEX_DIR
+RETRIEVAL_TOP_K = 5
+LOCAL_INDEX_DIR = "index_snapshot"  # Written by export_index.py
+LOCAL_INDEX_BLOCK_ROWS = 65536  # Rows scored per NumPy block, bounds temporary memory
+RETRIEVAL_WORKERS = 16  # Threads shared by all sessions for rewrite, embedding and search
+RETRIEVAL_REWRITE_TIMEOUT = 4.0  # Seconds to wait for the query rewrite before using the speculative context
+RETRIEVAL_SEARCH_TIMEOUT = 3.0  # Seconds to wait for an embedding + vector search
+RETRIEVAL_REUSE_SIMILARITY = 0.95  # Reuse the speculative results when the rewrite embeds this close to the raw message
+
+# Turn Deadlines (a late or failed retrieval stage falls back instead of holding up the answer)
+TURN_RETRIEVAL_BUDGET = 4.0  # Seconds from the student's message until the context must be ready
+TURN_REWRITE_SHARE = 0.6  # Most of the remaining budget the query rewrite may use
+CHAT_STALL_TIMEOUT = 20.0  # Seconds without a streamed token (or a connection) before the answer is abandoned
+FALLBACK_CONTEXT_ENABLED = True  # Use the session's last good context on the objective, or its default context, when retrieval fails
+FALLBACK_CACHE_SIZE = 4096  # Sessions whose last good context is kept for that
+# Shown under an answer whose context came from a fallback
+DEGRADED_NOTICES = {
+    "cached": "⚡ The video search was slow, so this answer uses references from earlier in this lesson.",
+    "objective": "⚡ The video search was slow, so this answer uses general references for this lesson.",
+    "none": "⚡ The video search was unavailable, so this answer doesn't use video references.",
+}
+HEDGE_ENABLED = True  # Send a duplicate vector query when the first one is slower than usual
+HEDGE_PERCENTILE = 0.95  # Recent vector query latency percentile after which the duplicate is sent
+HEDGE_MIN_DELAY = 0.05  # Seconds; bounds for that delay
+HEDGE_MAX_DELAY = 1.0  # Also used until HEDGE_MIN_SAMPLES queries were observed
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WORKERS = 16
+
+# Hybrid Retrieval (BM25 over the chunk texts of the snapshot in LOCAL_INDEX_DIR, fused with the vector results and reranked locally)
+HYBRID_ENABLED = True  # Without a snapshot only the vector candidates are reranked
+HYBRID_CANDIDATES = 20  # Candidates taken from each of the vector and lexical searches
+HYBRID_TOP_K = 3  # Chunks kept for the prompt after reranking
+HYBRID_RRF_K = 60  # Reciprocal-rank fusion constant
+HYBRID_OBJECTIVE_BOOST = 0.15  # Added to the rerank score of chunks about the current objective
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Objective Partitions (chunks tagged with the index in LEARNING_OBJECTIVES they teach; tag existing chunks with tag_objectives.py)
+OBJECTIVE_PARTITIONS_ENABLED = True  # Search only the current objective's chunks first; an untagged index is searched whole
+OBJECTIVE_WIDEN_SCORE = 0.78  # Also search the neighbouring objectives when the best vector score is below this (ada-002 scale)
+OBJECTIVE_WIDEN_RADIUS = 1  # Objectives on each side searched when widening
+OBJECTIVE_AMBIGUOUS_MARGIN = 0.02  # Tagging reports chunks whose two closest objectives are nearer than this
+OBJECTIVE_RECHECK_INTERVAL = 600.0  # Seconds an objective found without tagged chunks is searched whole before trying its partition again
+
+# Course Ingestion (ingest_course.py)
+INGEST_CHUNK_WORDS = 200
+INGEST_CHUNK_OVERLAP = 40  # Words repeated from the end of the previous chunk
+INGEST_EMBED_BATCH = 256  # Chunk texts per embeddings request
+INGEST_EMBED_WORKERS = 4  # Embeddings requests in flight
+INGEST_UPSERT_BATCH = 100  # Vectors per Pinecone upsert
+INGEST_UPSERT_WORKERS = 4
+INGEST_STATE_PATH = ".cache/ingest_state.sqlite3"  # Chunk embeddings and upsert progress, so re-runs only do new work
+
+# Query Rewrite Gate (skips the standalone-question rewrite when the message can be searched as is)
+REWRITE_GATE_MIN_WORDS = 4  # Shorter messages are treated as possible follow-ups
+REWRITE_GATE_NEW_TOPIC_SIMILARITY = 0.8  # Short messages embedding further than this from the last turn start a new topic
+
+# Answer Cache (replays tutor answers to near-identical first questions on the same objective)
+ANSWER_CACHE_ENABLED = True
+ANSWER_CACHE_MAX_ENTRIES = 2000  # Across all objectives; least used entries are evicted first
+ANSWER_CACHE_SIMILARITY = 0.97  # Minimum cosine similarity between question embeddings for a hit
+
+# Next-objective prefetch (prepares the next objective's introduction as soon as OBJECTIVE_COMPLETED is seen)
+PREFETCH_ENABLED = True
+PREFETCH_WORKERS = 8
+
+# Prompt Budget (tokens sent to MODEL_CHAT per turn, on top of the static system prompt)
+PROMPT_CONTEXT_TOKENS = 1500  # Video references
+PROMPT_HISTORY_TOKENS = 2000  # Recent turns sent verbatim
+PROMPT_HISTORY_MAX_MESSAGES = 8
+PROMPT_SUMMARY_TOKENS = 300  # Running summary of turns that fell out of the history window
+PROMPT_IMAGE_TOKENS = 765  # Estimated cost of one attached image
+PROMPT_DEDUP_SIMILARITY = 0.8  # Drop a reference whose word shingles overlap a better one this much
+
+# Streaming Display
+STREAM_RENDER_FPS = 12  # Max re-renders per second of the in-progress block while an answer streams
+STREAM_CURSOR = "▌"
+
+# Conversation Store (chat history of every session, restorable after a restart)
+CONVERSATION_STORE_PATH = ".cache/conversations.sqlite3"  # Local disk of one host (WAL mode); each session must stay with one process. None keeps it in memory
+CONVERSATION_MEMORY_WINDOW = 40  # Newest messages per session kept in memory, at least TRANSCRIPT_WINDOW
+CONVERSATION_PAGE_SIZE = 20  # Older messages are read back this many at a time
+CONVERSATION_PAGE_CACHE = 4  # Pages of older messages kept in memory per session
+CONVERSATION_CHUNK_CACHE_SIZE = 4096  # Reference chunks whose text is shared in memory by all sessions
+CONVERSATION_TTL = 90 * 24 * 60 * 60  # Seconds before an inactive session's conversation is deleted
+SESSION_CLAIMS_MAX = 10_000  # Browser sessions remembered per process as holding a conversation's URL token
+
+# Chat Transcript
+TRANSCRIPT_WINDOW = 20  # Most recent visible messages rendered on each rerun
+TRANSCRIPT_PAGE_SIZE = 20  # Older messages revealed per "Show earlier messages" click
+
+# Tutor Engine (the chat turn pipeline, shared by the Streamlit app and tutor_server.py)
+TUTOR_ENGINE_URL = None  # e.g. "http://127.0.0.1:8765" to use a separate tutor_server.py; None runs the engine in this process
+# With ENGINE_WORKERS > 1, list every worker's URL separated by commas; each session always goes to the same worker
+ENGINE_MAX_TURNS = 512  # Turns in flight per process; more wait up to ENGINE_QUEUE_TIMEOUT, then are turned away as busy
+ENGINE_QUEUE_TIMEOUT = 10.0
+ENGINE_STREAM_BUFFER = 64  # Events buffered per turn; beyond that generation waits for the client to read
+ENGINE_MAX_SESSIONS = 10_000  # Session handles kept per process; the least recently used idle ones are dropped
+ENGINE_BLOCKING_WORKERS = 64  # Threads for retrieval and store access, which are not async
+ENGINE_HISTORY_PAGE = 40  # Messages per history request
+ENGINE_HOST = "127.0.0.1"  # Every route also requires the shared token (TUTOR_ENGINE_TOKEN); widen only behind a private network
+ENGINE_ENV_KEYS = False  # Let turns without key headers spend the server's OPENAI_API_KEY / PINECONE_API_KEY; only for trusted callers
+ENGINE_PORT = 8765  # Worker i of ENGINE_WORKERS listens on ENGINE_PORT + i
+ENGINE_WORKERS = 1  # Server processes; sessions are split between them by a hash of the session id
+ENGINE_CLIENT_TIMEOUT = 60.0  # Seconds the app waits on the engine service before giving up on a request
+ENGINE_CLIENT_CONNECTIONS = 100  # Keep-alive connections the app holds to the engine service
+ENGINE_CLIENT_CACHE_SESSIONS = 1000  # Sessions whose messages the app keeps between reruns; the least recently used are dropped
+ENGINE_CLIENT_CACHE_TTL = 60.0  # Seconds before a session's kept messages are read from the service again
+
+# Metrics and Debug Logging
+METRICS_SAMPLE_RATE = 1.0  # Fraction of stage spans recorded into the latency histograms
+METRICS_WINDOW = 2048  # Most recent samples kept per histogram for percentiles
+METRICS_HOST = "127.0.0.1"  # Interface the metrics endpoint listens on; it has no authentication, so keep it private
+METRICS_PORT = 9464  # Serves /metrics (Prometheus text) and /metrics.json; None disables it. tutor_server.py worker i uses METRICS_PORT + i
+DEBUG_LOG_HISTORY = False  # Log a bounded view of the chat history at DEBUG level on each turn
+DEBUG_LOG_MAX_MESSAGES = 5
+DEBUG_LOG_MAX_CHARS = 200
+
 # OpenAI Models
-MODEL_QUERY_GENERATION = "gpt-4o"
+MODEL_QUERY_GENERATION = "gpt-4o-mini"  # Only used when the rewrite gate decides a rewrite is needed
 MODEL_CHAT = "gpt-4o"
 
+# Client Pool Configuration (clients are shared across sessions and reruns, keyed by API key)
+CLIENT_POOL_MAX_CONNECTIONS = 50  # Upper bound on open connections per OpenAI client
+CLIENT_POOL_MAX_KEEPALIVE = 20  # Idle connections kept warm per OpenAI client
+CLIENT_KEEPALIVE_EXPIRY = 60  # Seconds an idle keep-alive connection stays open
+CLIENT_IDLE_TTL = 30 * 60  # Seconds before an unused client is evicted from the registry
+PINECONE_POOL_THREADS = 4
+S3_MAX_POOL_CONNECTIONS = 20
+
+# Concurrency Governor (limits shared by every session in the process)
+GOVERNOR_ENABLED = True
+# Per stage: requests per second and burst per API key, and calls in flight across all keys
+GOVERNOR_LIMITS = {
+    "chat": {"rate": 8.0, "burst": 16, "max_in_flight": 32},  # Streamed tutor answers, held until the stream ends
+    "rewrite": {"rate": 10.0, "burst": 20, "max_in_flight": 16},
+    "embedding": {"rate": 20.0, "burst": 40, "max_in_flight": 16},
+    "vector_query": {"rate": 50.0, "burst": 50, "max_in_flight": 16},
+    "vector_upsert": {"rate": 20.0, "burst": 20, "max_in_flight": 8},  # Bulk writes from ingest_course.py
+}
+GOVERNOR_QUEUE_TIMEOUT = 30.0  # Seconds a call may wait for a slot and a rate token before it fails
+GOVERNOR_MAX_RETRIES = 4  # Retries after a 429 from the provider
+GOVERNOR_BACKOFF_BASE = 0.5  # Seconds; retry n sleeps a random time up to base * 2**n
+GOVERNOR_BACKOFF_CAP = 8.0
+
+# Embedding Configuration
+EMBEDDING_MODEL = "text-embedding-ada-002"
+EMBEDDING_CACHE_PATH = ".cache/embeddings.sqlite3"  # Set to None to keep the cache in memory only
+EMBEDDING_CACHE_MEMORY_SIZE = 4096  # Embeddings kept in the in-process LRU
+EMBEDDING_CACHE_DISK_SIZE = 200_000  # Embeddings kept in the on-disk store
+EMBEDDING_CACHE_TTL = 30 * 24 * 60 * 60  # Seconds before a stored embedding is recomputed
+
 # Custom CSS
 CUSTOM_CSS = """
 <style>
@@ -148,5 +322,25 @@ CUSTOM_CSS = """
     background-size: 2px 8px;
     background-repeat: repeat-y;
 }
+.stButton > button {
+    width: 100%;
+}
+.next-objective {
+    background-color: #4CAF50;
+    color: white;
+    padding: 15px 32px;
+    text-align: center;
+    text-decoration: none;
+    display: inline-block;
+    font-size: 16px;
+    margin: 4px 2px;
+    cursor: pointer;
+    border: none;
+    border-radius: 4px;
+    transition-duration: 0.4s;
+}
+.next-objective:hover {
+    background-color: #45a049;
+}
 </style>
 """
@@ -0,0 +1,324 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from collections.abc import Sequence
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from config import (
+    CONVERSATION_CHUNK_CACHE_SIZE,
+    CONVERSATION_MEMORY_WINDOW,
+    CONVERSATION_PAGE_CACHE,
+    CONVERSATION_PAGE_SIZE,
+    CONVERSATION_STORE_PATH,
+    CONVERSATION_TTL,
+)
+from metrics import logger, metrics
+
+# How many appended messages between sweeps of expired conversations
+_PRUNE_EVERY = 500
+
+
+# Conversations of every session, in SQLite so they survive restarts. The file is for
+# the processes of one host: WAL mode needs local disk, and each process keeps its own
+# in-memory window of a conversation, so a session must stay with one process (as
+# tutor_server routes it to one worker). Reference chunks are stored once in a chunk table
+# and messages only keep (chunk id, score) pairs; in memory, references share the text
+# of one cached copy per chunk instead of holding their own.
+class ConversationStore:
+    def __init__(self, path: Optional[str] = CONVERSATION_STORE_PATH, chunk_cache_size: int = CONVERSATION_CHUNK_CACHE_SIZE,
+                 ttl: float = CONVERSATION_TTL):
+        self.chunk_cache_size = chunk_cache_size
+        self.ttl = ttl
+        self._chunks: "OrderedDict[str, Tuple[str, Optional[str]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._appends = 0
+        self.loads = 0
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._inherited: List[sqlite3.Connection] = []
+
+    # The connection is opened on first use by the process that uses it, so tutor_server
+    # workers forked after import each open their own. A connection inherited across a
+    # fork is never used, and is kept rather than closed, which would drop the parent's locks.
+    @property
+    def _db(self) -> sqlite3.Connection:
+        if self._pid != os.getpid():
+            if self._conn is not None:
+                self._inherited.append(self._conn)
+            try:
+                self._conn = _open_store(self.path or ":memory:")
+            except sqlite3.Error as e:
+                logger.warning("Conversation store unavailable, keeping conversations in memory: %s", e)
+                self._conn = _open_store(":memory:")
+            self._pid = os.getpid()
+        return self._conn
+
+    # Function to find the conversation a session was last in: (conversation id, objective) or None
+    def load_session(self, session_id: str) -> Optional[Tuple[str, int]]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT conversation_id, objective FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return (row[0], row[1]) if row is not None else None
+
+    def save_session(self, session_id: str, conversation_id: str, objective: int):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, conversation_id, objective, updated) VALUES (?, ?, ?, ?)",
+                (session_id, conversation_id, objective, time.time()),
+            )
+
+    # Function to list (role, hidden) for every message, oldest first, without loading contents
+    def outline(self, conversation_id: str) -> List[Tuple[str, bool]]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT role, hidden FROM messages WHERE conversation_id = ? ORDER BY seq", (conversation_id,)
+            ).fetchall()
+        return [(role, bool(hidden)) for role, hidden in rows]
+
+    def append(self, conversation_id: str, seq: int, message: dict) -> dict:
+        now = time.time()
+        with self._lock:
+            message = self._intern_locked(message)
+            # The chunks go in with the message that references them, in one transaction,
+            # so a _prune in another process can't delete them in between
+            with _transaction(self._db):
+                for reference in message.get("references") or ():
+                    self._db.execute(
+                        "INSERT OR IGNORE INTO chunks (id, text, source) VALUES (?, ?, ?)",
+                        (reference["id"], reference["text"], reference.get("source")),
+                    )
+                self._db.execute(
+                    "INSERT OR REPLACE INTO messages (conversation_id, seq, role, hidden, content, refs, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (conversation_id, seq, message["role"], int(message.get("hidden", False)),
+                     json.dumps(message["content"]), _encode_refs(message.get("references")), now),
+                )
+                # Activity keeps the session alive: _prune drops sessions by their last update
+                self._db.execute("UPDATE sessions SET updated = ? WHERE conversation_id = ?", (now, conversation_id))
+            self._appends += 1
+            if self._appends % _PRUNE_EVERY == 0:
+                self._prune(now)
+        return message
+
+    def load(self, conversation_id: str, start: int, stop: int) -> List[dict]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT role, hidden, content, refs FROM messages WHERE conversation_id = ? AND seq >= ? AND seq < ? ORDER BY seq",
+                (conversation_id, start, stop),
+            ).fetchall()
+            self.loads += 1
+            messages = []
+            for role, hidden, content, refs in rows:
+                message = {"role": role, "content": json.loads(content)}
+                if hidden:
+                    message["hidden"] = True
+                if refs is not None:
+                    message["references"] = self._resolve_locked(json.loads(refs))
+                messages.append(message)
+        return messages
+
+    def stats(self) -> dict:
+        return {"cached_chunks": len(self._chunks), "appends": self._appends, "page_loads": self.loads}
+
+    # Function to make a message's references share the cached copy of each chunk
+    def _intern_locked(self, message: dict) -> dict:
+        references = message.get("references")
+        if references is None:
+            return message
+        interned = []
+        for reference in references:
+            chunk_id = reference.get("id") or hashlib.sha256(reference["text"].encode("utf-8")).hexdigest()[:16]
+            cached = self._chunks.get(chunk_id)
+            if cached is None:
+                cached = self._cache_chunk(chunk_id, reference["text"], reference.get("source"))
+            interned.append(_reference(chunk_id, cached, reference["score"]))
+        return {**message, "references": interned}
+
+    def _resolve_locked(self, refs: List[list]) -> List[dict]:
+        missing = [chunk_id for chunk_id, _ in refs if chunk_id not in self._chunks]
+        if missing:
+            placeholders = ",".join("?" * len(missing))
+            for chunk_id, text, source in self._db.execute(
+                f"SELECT id, text, source FROM chunks WHERE id IN ({placeholders})", missing
+            ):
+                self._cache_chunk(chunk_id, text, source)
+        references = []
+        for chunk_id, score in refs:
+            cached = self._chunks.get(chunk_id)
+            if cached is not None:
+                references.append(_reference(chunk_id, cached, score))
+        return references
+
+    def _cache_chunk(self, chunk_id: str, text: str, source: Optional[str]) -> Tuple[str, Optional[str]]:
+        cached = self._chunks[chunk_id] = (text, source)
+        self._chunks.move_to_end(chunk_id)
+        while len(self._chunks) > self.chunk_cache_size:
+            self._chunks.popitem(last=False)
+        return cached
+
+    def _prune(self, now: float):
+        cutoff = now - self.ttl
+        with _transaction(self._db):
+            self._db.execute(
+                "DELETE FROM messages WHERE conversation_id IN "
+                "(SELECT conversation_id FROM messages GROUP BY conversation_id HAVING MAX(created) < ?)", (cutoff,)
+            )
+            self._db.execute("DELETE FROM sessions WHERE updated < ?", (cutoff,))
+            # Chunks no remaining message references (refs holds [chunk id, score] pairs)
+            self._db.execute(
+                "DELETE FROM chunks WHERE id NOT IN "
+                "(SELECT json_extract(ref.value, '$[0]') FROM messages, json_each(messages.refs) AS ref "
+                "WHERE messages.refs IS NOT NULL)"
+            )
+
+
+def _reference(chunk_id: str, chunk: Tuple[str, Optional[str]], score: float) -> dict:
+    reference = {"id": chunk_id, "text": chunk[0], "score": score}
+    if chunk[1] is not None:
+        reference["source"] = chunk[1]
+    return reference
+
+
+def _encode_refs(references: Optional[List[dict]]) -> Optional[str]:
+    if references is None:
+        return None
+    return json.dumps([[reference["id"], reference["score"]] for reference in references])
+
+
+# One conversation as a read-mostly list of message dicts. Only the newest
+# CONVERSATION_MEMORY_WINDOW messages (and the first one) stay in memory; older
+# messages are read back from the store a page at a time when something asks for them.
+class Conversation(Sequence):
+    def __init__(self, store: ConversationStore, conversation_id: str, objective: int,
+                 window: int = CONVERSATION_MEMORY_WINDOW, page_size: int = CONVERSATION_PAGE_SIZE):
+        self.store = store
+        self.conversation_id = conversation_id
+        self.objective = objective
+        self.window = window
+        self.page_size = page_size
+        self._outline = store.outline(conversation_id)
+        self._recent: Dict[int, dict] = {}
+        self._pages: "OrderedDict[int, List[dict]]" = OrderedDict()
+        start = max(0, len(self._outline) - window)
+        for offset, message in enumerate(store.load(conversation_id, start, len(self._outline))):
+            self._recent[start + offset] = message
+        # The first message anchors incremental state such as the history summary
+        self._first = self._recent.get(0) or next(iter(store.load(conversation_id, 0, 1)), None)
+
+    def __len__(self) -> int:
+        return len(self._outline)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("conversation index out of range")
+        if index == 0 and self._first is not None:
+            return self._first
+        message = self._recent.get(index)
+        if message is not None:
+            return message
+        return self._page(index // self.page_size)[index % self.page_size]
+
+    # Replacing a message is only needed for the newest one (e.g. once an attached image has its URL)
+    def __setitem__(self, index: int, message: dict):
+        if index < 0:
+            index += len(self)
+        if index != len(self) - 1:
+            raise IndexError("only the newest message can be replaced")
+        self._store(index, message)
+
+    def append(self, message: dict):
+        self._outline.append((message["role"], bool(message.get("hidden", False))))
+        self._store(len(self._outline) - 1, message)
+        for index in [index for index in self._recent if index < len(self._outline) - self.window]:
+            del self._recent[index]
+
+    def visible_indices(self) -> List[int]:
+        return [i for i, (_, hidden) in enumerate(self._outline) if not hidden]
+
+    def user_turns(self) -> int:
+        return sum(1 for role, hidden in self._outline if role == "user" and not hidden)
+
+    def _store(self, index: int, message: dict):
+        stored = self.store.append(self.conversation_id, index, message)
+        # Keep the caller's dict (the transcript cache checks identity) but share the interned references
+        if "references" in stored:
+            message["references"] = stored["references"]
+        self._recent[index] = message
+        if index == 0:
+            self._first = message
+
+    def _page(self, page: int) -> List[dict]:
+        messages = self._pages.get(page)
+        if messages is None:
+            start = page * self.page_size
+            messages = self._pages[page] = self.store.load(self.conversation_id, start, start + self.page_size)
+            while len(self._pages) > CONVERSATION_PAGE_CACHE:
+                self._pages.popitem(last=False)
+        self._pages.move_to_end(page)
+        return messages
+
+
+# Function to reopen the conversation a session was last in, or start one on the first objective
+def open_conversation(session_id: str) -> Conversation:
+    saved = conversation_store.load_session(session_id)
+    if saved is None:
+        return start_conversation(session_id, 0)
+    conversation_id, objective = saved
+    return Conversation(conversation_store, conversation_id, objective)
+
+
+# Function to start a fresh conversation for a session (new objective or a reset chat)
+def start_conversation(session_id: str, objective: int) -> Conversation:
+    conversation_id = uuid.uuid4().hex
+    conversation_store.save_session(session_id, conversation_id, objective)
+    return Conversation(conversation_store, conversation_id, objective)
+
+
+# Function to run statements in one write transaction; the connection is in autocommit mode
+@contextmanager
+def _transaction(db: sqlite3.Connection):
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+
+def _open_store(path: str) -> sqlite3.Connection:
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # Autocommit mode; every access goes through the store lock
+    db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS sessions ("
+        "session_id TEXT PRIMARY KEY, conversation_id TEXT NOT NULL, objective INTEGER NOT NULL, updated REAL NOT NULL)"
+    )
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS messages ("
+        "conversation_id TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, hidden INTEGER NOT NULL, "
+        "content TEXT NOT NULL, refs TEXT, created REAL NOT NULL, PRIMARY KEY (conversation_id, seq))"
+    )
+    db.execute("CREATE TABLE IF NOT EXISTS chunks (id TEXT PRIMARY KEY, text TEXT NOT NULL, source TEXT)")
+    db.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)")
+    db.execute("CREATE INDEX IF NOT EXISTS sessions_conversation ON sessions (conversation_id)")
+    return db
+
+
+conversation_store = ConversationStore()
+metrics.register_collector("conversation_store", conversation_store.stats)
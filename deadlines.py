@@ -0,0 +1,81 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Optional
+
+from config import HEDGE_MAX_DELAY, HEDGE_MIN_DELAY, HEDGE_MIN_SAMPLES, HEDGE_PERCENTILE, HEDGE_WORKERS
+from governor import carry_session
+from metrics import metrics
+
+# Runs the calls being hedged; separate from the retrieval pool that waits on them
+_hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="hedge")
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+# Time left for one chat turn. Stages take what they need of the remaining budget,
+# so a slow early stage leaves less for the later ones instead of adding up.
+class Deadline:
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.expires = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    # Function to get how long a stage may wait: its share of what is left, at most cap
+    def allow(self, share: float = 1.0, cap: Optional[float] = None) -> float:
+        allowed = self.remaining() * share
+        return allowed if cap is None else min(allowed, cap)
+
+
+# Function to get how long to wait for a call before sending a duplicate: the stage's
+# recent latency percentile, or HEDGE_MAX_DELAY until enough calls were observed
+def hedge_delay(stage: str) -> float:
+    observed = metrics.quantile(stage, HEDGE_PERCENTILE, min_samples=HEDGE_MIN_SAMPLES)
+    if observed is None:
+        return HEDGE_MAX_DELAY
+    return min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, observed))
+
+
+# Function to run an idempotent call and, if it hasn't returned after `delay`, send
+# one duplicate; the first successful result wins, and a duplicate still waiting for a
+# thread is cancelled. Errors only surface if both fail.
+def hedged(stage: str, fn: Callable, *args, delay: Optional[float] = None, timeout: Optional[float] = None, **kwargs):
+    delay = hedge_delay(stage) if delay is None else delay
+    primary = _hedge_executor.submit(carry_session(fn), *args, **kwargs)
+    if timeout is not None and timeout <= delay:  # No time for a duplicate to help
+        return _first_success(stage, [primary], timeout)
+    done, _ = wait([primary], timeout=delay)
+    if done:
+        return primary.result()
+    metrics.incr(stage, "hedged")
+    duplicate = _hedge_executor.submit(carry_session(fn), *args, **kwargs)
+    return _first_success(stage, [primary, duplicate], None if timeout is None else max(0.0, timeout - delay))
+
+
+def _first_success(stage: str, futures: list, timeout: Optional[float]):
+    expires = None if timeout is None else time.monotonic() + timeout
+    pending = set(futures)
+    error: Optional[BaseException] = None
+    while pending:
+        done, pending = wait(pending, timeout=None if expires is None else max(0.0, expires - time.monotonic()),
+                             return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            if future.exception() is None:
+                if future is not futures[0]:
+                    metrics.incr(stage, "hedge_wins")
+                for other in pending:
+                    other.cancel()
+                return future.result()
+            error = future.exception()
+    if error is not None and not pending:
+        raise error
+    raise DeadlineExceeded(f"{stage} did not answer within {timeout}s")
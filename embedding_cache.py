@@ -0,0 +1,166 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import List, Optional
+
+from config import (
+    EMBEDDING_CACHE_DISK_SIZE,
+    EMBEDDING_CACHE_MEMORY_SIZE,
+    EMBEDDING_CACHE_PATH,
+    EMBEDDING_CACHE_TTL,
+)
+from metrics import logger, metrics
+
+# How many disk writes happen between eviction sweeps of the SQLite store
+_PRUNE_EVERY = 500
+
+
+# Two-tier embedding cache: a bounded in-process LRU in front of a SQLite
+# store that survives restarts. Keys hash the model name together with the text.
+class EmbeddingCache:
+    def __init__(self, path: Optional[str] = EMBEDDING_CACHE_PATH, memory_size: int = EMBEDDING_CACHE_MEMORY_SIZE,
+                 disk_size: int = EMBEDDING_CACHE_DISK_SIZE, ttl: float = EMBEDDING_CACHE_TTL):
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.ttl = ttl
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._inherited: List[sqlite3.Connection] = []
+
+    # The store is opened on first use by the process that uses it (see ConversationStore._db);
+    # None when there is no path or it cannot be opened
+    @property
+    def _db(self) -> Optional[sqlite3.Connection]:
+        if self._pid != os.getpid():
+            if self._conn is not None:
+                self._inherited.append(self._conn)
+            self._conn = None
+            self._pid = os.getpid()
+            if self.path:
+                try:
+                    self._conn = _open_store(self.path)
+                except sqlite3.Error as e:
+                    logger.warning("Embedding cache store unavailable, using memory only: %s", e)
+        return self._conn
+
+    @staticmethod
+    def make_key(text: str, model: str) -> str:
+        normalized = " ".join(text.split())
+        return hashlib.sha256(f"{model}\n{normalized}".encode("utf-8")).hexdigest()
+
+    def get(self, text: str, model: str) -> Optional[List[float]]:
+        key = self.make_key(text, model)
+        now = time.time()
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached is not None and now - cached[1] <= self.ttl:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return cached[0]
+            embedding = self._disk_get(key, now)
+            if embedding is not None:
+                self._memory_put(key, embedding, now)
+                self.disk_hits += 1
+                return embedding
+            self.misses += 1
+            return None
+
+    # Memory-only lookup that does not touch the disk store or the hit/miss counters
+    def peek(self, text: str, model: str) -> Optional[List[float]]:
+        with self._lock:
+            cached = self._memory.get(self.make_key(text, model))
+        return cached[0] if cached is not None else None
+
+    def put(self, text: str, model: str, embedding: List[float]):
+        key = self.make_key(text, model)
+        now = time.time()
+        with self._lock:
+            self._memory_put(key, embedding, now)
+            self._disk_put(key, model, embedding, now)
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_entries": len(self._memory),
+        }
+
+    def _memory_put(self, key: str, embedding: List[float], created: float):
+        self._memory[key] = (embedding, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _disk_get(self, key: str, now: float) -> Optional[List[float]]:
+        if self._db is None:
+            return None
+        try:
+            row = self._db.execute("SELECT vector, created FROM embeddings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                self._db.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+                return None
+            self._db.execute("UPDATE embeddings SET accessed = ? WHERE key = ?", (now, key))
+            return array("f", row[0]).tolist()
+        except sqlite3.Error as e:
+            logger.warning("Error reading embedding cache: %s", e)
+            return None
+
+    def _disk_put(self, key: str, model: str, embedding: List[float], now: float):
+        if self._db is None:
+            return
+        try:
+            self._db.execute(
+                "INSERT OR REPLACE INTO embeddings (key, model, vector, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, model, array("f", embedding).tobytes(), now, now),
+            )
+            self._writes += 1
+            if self._writes % _PRUNE_EVERY == 0:
+                self._prune(now)
+        except sqlite3.Error as e:
+            logger.warning("Error writing embedding cache: %s", e)
+
+    def _prune(self, now: float):
+        self._db.execute("DELETE FROM embeddings WHERE created < ?", (now - self.ttl,))
+        count = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if count > self.disk_size:
+            self._db.execute(
+                "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY accessed LIMIT ?)",
+                (count - self.disk_size,),
+            )
+
+
+def _open_store(path: str) -> sqlite3.Connection:
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # Autocommit mode; every access goes through the cache lock
+    db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS embeddings ("
+        "key TEXT PRIMARY KEY, model TEXT NOT NULL, vector BLOB NOT NULL, "
+        "created REAL NOT NULL, accessed REAL NOT NULL)"
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS embeddings_accessed ON embeddings (accessed)")
+    return db
+
+
+embedding_cache = EmbeddingCache()
+metrics.register_collector("embedding_cache", embedding_cache.stats)
@@ -0,0 +1,416 @@
+import asyncio
+import functools
+import hashlib
+import operator
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import AsyncIterator, List, Optional, Tuple, Union
+
+from answer_cache import answer_cache, replay
+from config import (
+    ANSWER_CACHE_ENABLED,
+    DEGRADED_NOTICES,
+    ENGINE_BLOCKING_WORKERS,
+    ENGINE_HISTORY_PAGE,
+    ENGINE_MAX_SESSIONS,
+    ENGINE_MAX_TURNS,
+    ENGINE_QUEUE_TIMEOUT,
+    ENGINE_STREAM_BUFFER,
+    IMAGE_UPLOAD_TIMEOUT,
+    LEARNING_OBJECTIVES,
+    OBJECTIVE_COMPLETED_MARKER,
+    PREFETCH_ENABLED,
+    TURN_RETRIEVAL_BUDGET,
+)
+from conversation_store import Conversation, open_conversation, start_conversation
+from deadlines import Deadline
+from governor import carry_session, set_session
+from metrics import log_history, logger, metrics
+from prefetch import PrefetchHandle, start_prefetch
+from retrieval import generate_embedding, get_context
+from tutor import (
+    CompletionDetector,
+    agenerate_ai_response,
+    astream_until_complete,
+    displayed_text,
+    get_hidden_context,
+    hidden_message_for,
+)
+
+# How often an advance re-checks a prefetched introduction that is still streaming
+_PREFETCH_POLL = 0.05
+
+
+class EngineBusy(Exception):
+    pass
+
+
+# One running turn. Its events ("accepted", "context", "image", "token", "restart",
+# "completed", "error" and a final "done") go through a bounded queue: when the
+# client reads slower than the answer streams, generation waits for it.
+class Turn:
+    def __init__(self, session_id: str, kind: str, buffer: int = ENGINE_STREAM_BUFFER):
+        self.id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.kind = kind
+        self.task: Optional[asyncio.Task] = None
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=buffer)
+        self._detached = False
+
+    async def emit(self, event: str, data: dict):
+        if not self._detached:
+            await self._queue.put((event, data))
+
+    # Function to stop buffering for a client that went away; the turn still finishes and is stored
+    def detach(self):
+        self._detached = True
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+    async def events(self) -> AsyncIterator[Tuple[str, dict]]:
+        while True:
+            event, data = await self._queue.get()
+            yield event, data
+            if event == "done":
+                return
+
+
+# What the engine keeps per student session: the open conversation, the incremental
+# history summary, a prefetched next introduction, and a lock so turns don't overlap
+class SessionState:
+    def __init__(self, session_id: str, conversation: Conversation):
+        self.session_id = session_id
+        self.conversation = conversation
+        self.lock = asyncio.Lock()
+        self.summary_state: dict = {}
+        self.last_prompt_report: dict = {}
+        self.prefetch: Optional[PrefetchHandle] = None
+        last_message = conversation[-1] if len(conversation) else None
+        self.objective_completed = (
+            last_message is not None and last_message["role"] == "assistant"
+            and OBJECTIVE_COMPLETED_MARKER in last_message["content"] and self.objective < len(LEARNING_OBJECTIVES) - 1
+        )
+
+    @property
+    def objective(self) -> int:
+        return self.conversation.objective
+
+    def snapshot(self) -> dict:
+        return {
+            "session_id": self.session_id,
+            "objective": self.objective,
+            "objective_title": LEARNING_OBJECTIVES[self.objective],
+            "objective_completed": self.objective_completed,
+            "messages": len(self.conversation),
+            "busy": self.lock.locked(),
+        }
+
+    def discard_prefetch(self):
+        if self.prefetch is not None:
+            self.prefetch.cancel()
+            self.prefetch = None
+
+
+# The chat turn pipeline as an asyncio service. Answers stream from the async OpenAI
+# client on the event loop, so open streams cost no threads; retrieval, embedding and
+# store access stay synchronous and run on a bounded thread pool. Frontends (the
+# Streamlit app, tutor_server.py) submit turns and read their events.
+class TutorEngine:
+    def __init__(self, max_turns: int = ENGINE_MAX_TURNS, max_sessions: int = ENGINE_MAX_SESSIONS,
+                 queue_timeout: float = ENGINE_QUEUE_TIMEOUT, blocking_workers: int = ENGINE_BLOCKING_WORKERS):
+        self.max_sessions = max_sessions
+        self.queue_timeout = queue_timeout
+        self.turns_in_flight = 0
+        self._sessions: "OrderedDict[str, SessionState]" = OrderedDict()
+        self._slots = asyncio.Semaphore(max_turns)
+        self._blocking = ThreadPoolExecutor(max_workers=blocking_workers, thread_name_prefix="engine")
+        metrics.register_collector("engine", self.stats)
+
+    def stats(self) -> dict:
+        return {"sessions": len(self._sessions), "turns_in_flight": self.turns_in_flight}
+
+    # Function to run blocking work on the engine's pool, carrying the session along for the governor
+    async def run_blocking(self, fn, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self._blocking, functools.partial(carry_session(fn), *args, **kwargs))
+
+    # Function to get a session's handle, reopening its conversation from the store if needed
+    async def session(self, session_id: str) -> SessionState:
+        state = self._sessions.get(session_id)
+        if state is None:
+            conversation = await self.run_blocking(open_conversation, session_id)
+            state = self._sessions.setdefault(session_id, SessionState(session_id, conversation))
+        self._sessions.move_to_end(session_id)
+        if len(self._sessions) > self.max_sessions:
+            for stale_id in [key for key, stale in self._sessions.items() if not stale.lock.locked()][:len(self._sessions) - self.max_sessions]:
+                self._sessions.pop(stale_id).discard_prefetch()
+        return state
+
+    async def state(self, session_id: str) -> dict:
+        return (await self.session(session_id)).snapshot()
+
+    # Function to read a page of a session's visible messages, newest last; `before` counts from the oldest
+    async def history(self, session_id: str, before: Optional[int] = None, limit: int = ENGINE_HISTORY_PAGE) -> dict:
+        state = await self.session(session_id)
+        conversation = state.conversation
+
+        def read():
+            visible = conversation.visible_indices()
+            end = len(visible) if before is None else max(0, min(before, len(visible)))
+            start = max(0, end - limit)
+            return start, len(visible), [conversation[index] for index in visible[start:end]]
+
+        start, total, messages = await self.run_blocking(read)
+        return {**state.snapshot(), "start": start, "total": total, "messages": messages}
+
+    # Function to start a student's turn; the answer streams through the returned Turn
+    async def submit(self, session_id: str, text: str, openai_api_key: str, pinecone_api_key: str,
+                     image: Union[None, str, Future] = None) -> Turn:
+        state = await self.session(session_id)
+        turn = Turn(session_id, "message")
+        await self._start(state, turn, functools.partial(self._answer, state, turn, text, openai_api_key, pinecone_api_key, image))
+        return turn
+
+    # Function to move a session to its next objective; the introduction streams through the returned Turn
+    async def advance(self, session_id: str, openai_api_key: str, pinecone_api_key: str) -> Turn:
+        state = await self.session(session_id)
+        if state.objective >= len(LEARNING_OBJECTIVES) - 1:
+            raise ValueError("Already on the last objective")
+        turn = Turn(session_id, "advance")
+        await self._start(state, turn, functools.partial(self._advance, state, turn, openai_api_key, pinecone_api_key))
+        return turn
+
+    # Function to start a fresh conversation on an objective (the current one by default)
+    async def reset(self, session_id: str, objective: Optional[int] = None) -> dict:
+        state = await self.session(session_id)
+        objective = state.objective if objective is None else objective
+        if not 0 <= objective < len(LEARNING_OBJECTIVES):
+            raise ValueError(f"objective must be between 0 and {len(LEARNING_OBJECTIVES) - 1}")
+        if state.lock.locked():
+            raise EngineBusy("A turn is still running for this session")
+        state.conversation = await self.run_blocking(start_conversation, session_id, objective)
+        state.objective_completed = False
+        state.discard_prefetch()
+        return state.snapshot()
+
+    async def _start(self, state: SessionState, turn: Turn, run):
+        if state.lock.locked():
+            raise EngineBusy("A turn is already running for this session")
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            metrics.incr("engine", "rejected")
+            raise EngineBusy("The tutor is at capacity, please try again shortly")
+        if state.lock.locked():  # Another turn for this session started while we waited for a slot
+            self._slots.release()
+            raise EngineBusy("A turn is already running for this session")
+        await state.lock.acquire()
+        self.turns_in_flight += 1
+        turn.task = asyncio.create_task(self._run(state, turn, run))
+
+    async def _run(self, state: SessionState, turn: Turn, run):
+        set_session(state.session_id)
+        try:
+            await run()
+        except Exception as e:
+            logger.exception("Error in %s turn: %s", turn.kind, e)
+            await turn.emit("error", {"message": f"An error occurred: {str(e)}"})
+            await turn.emit("done", {"content": "", "objective_completed": False, "messages": []})
+        finally:
+            self.turns_in_flight -= 1
+            state.lock.release()
+            self._slots.release()
+
+    async def _answer(self, state: SessionState, turn: Turn, text: str, openai_api_key: str, pinecone_api_key: str,
+                      image: Union[None, str, Future]):
+        started = time.monotonic()
+        conversation = state.conversation
+        objective = state.objective
+        user_message = {"role": "user", "content": text}
+        await self.run_blocking(conversation.append, user_message)
+        await turn.emit("accepted", {"turn_id": turn.id, "objective": objective})
+
+        # Near-identical first questions on this objective are answered from the answer cache.
+        # Its embedding counts against the retrieval budget, which it shares with get_context.
+        deadline = Deadline(TURN_RETRIEVAL_BUDGET)
+        question_embedding = None
+        cached_answer = None
+        if ANSWER_CACHE_ENABLED and image is None and conversation.user_turns() <= 1:
+            question_embedding = await self.run_blocking(_embed_or_none, text, openai_api_key, deadline)
+            if question_embedding is not None:
+                cached_answer = answer_cache.lookup(objective, question_embedding)
+
+        status = {}
+        if cached_answer is not None:
+            references = cached_answer.references
+        else:
+            _, references = await self.run_blocking(get_context, text, conversation, openai_api_key, pinecone_api_key,
+                                                    current_objective=objective, status=status, deadline=deadline)
+        degraded = status.get("degraded")
+        await turn.emit("context", {"references": references, "degraded": degraded, "notice": DEGRADED_NOTICES.get(degraded)})
+
+        # The image was downscaled and uploaded while the context was retrieved
+        image_url = None
+        if image is not None:
+            image_url, error = await _image_url(image)
+            await turn.emit("image", {"url": image_url, "error": error})
+            if image_url:
+                user_message = {"role": "user", "content": [
+                    {"type": "text", "text": text},
+                    {"type": "image_url", "image_url": {"url": image_url}},
+                ]}
+                await self.run_blocking(operator.setitem, conversation, -1, user_message)  # Store the message again, now with the image
+
+        detector = CompletionDetector(on_complete=lambda: self._prefetch_next(state, openai_api_key, pinecone_api_key))
+        first_delta_at = None
+        if cached_answer is not None:
+            # Only answers that didn't complete the objective are cached, so there is no marker to hold back
+            for delta in replay(cached_answer.answer):
+                first_delta_at = first_delta_at or time.monotonic()
+                await turn.emit("token", {"text": delta})
+            content = cached_answer.answer
+            error = None
+        else:
+            state.last_prompt_report = {}
+            response = await agenerate_ai_response(text, references, openai_api_key, conversation, objective,
+                                                   image_url, state.summary_state, state.last_prompt_report)
+            logger.debug("Prompt tokens for final response: %s", state.last_prompt_report)
+            log_history("History for final response", conversation)
+            if isinstance(response, str):  # Error occurred
+                content = error = response
+                await turn.emit("error", {"message": response})
+            else:
+                async for delta in astream_until_complete(response, detector):
+                    first_delta_at = first_delta_at or time.monotonic()
+                    await turn.emit("token", {"text": delta})
+                content = detector.content()
+                error = None
+        if first_delta_at is not None:
+            metrics.record("ttft", first_delta_at - started, answer_cache_hits=int(cached_answer is not None))
+
+        assistant_message = {"role": "assistant", "content": content, "references": references}
+        await self.run_blocking(conversation.append, assistant_message)
+
+        # Remember answers to first questions so the next student asking the same thing gets them instantly
+        if question_embedding is not None and cached_answer is None and error is None and content and not detector.completed:
+            answer_cache.store(objective, question_embedding, text, content, references)
+
+        last_objective = objective >= len(LEARNING_OBJECTIVES) - 1
+        if detector.completed:
+            state.objective_completed = not last_objective
+            self._prefetch_next(state, openai_api_key, pinecone_api_key)
+            await turn.emit("completed", {"objective": objective, "all_completed": last_objective})
+        metrics.record("turn", time.monotonic() - started, image_uploads=int(image is not None))
+        await turn.emit("done", {
+            "content": displayed_text(content),
+            "objective_completed": detector.completed,
+            "messages": [user_message, assistant_message],
+        })
+
+    async def _advance(self, state: SessionState, turn: Turn, openai_api_key: str, pinecone_api_key: str):
+        previous_objective = LEARNING_OBJECTIVES[state.objective]
+        objective = state.objective + 1
+        state.conversation = conversation = await self.run_blocking(start_conversation, state.session_id, objective)
+        state.objective_completed = False
+        await turn.emit("accepted", {"turn_id": turn.id, "objective": objective})
+
+        # Use the prefetched introduction if it is ready or still streaming
+        handle, state.prefetch = state.prefetch, None
+        if handle is not None and handle.objective_index == objective:
+            result = await self._serve_prefetched(turn, handle)
+            if result is not None:
+                hidden_message = {"role": "user", "content": result["hidden_message"], "hidden": True}
+                assistant_message = {"role": "assistant", "content": result["content"], "references": result["references"]}
+                await self.run_blocking(_append, conversation, hidden_message, assistant_message)
+                await turn.emit("done", {"content": result["content"], "objective_completed": False,
+                                         "messages": [hidden_message, assistant_message]})
+                return
+        elif handle is not None:
+            handle.cancel()
+
+        # Otherwise send the hidden message now; its context is shared by every student moving to this objective
+        hidden_text = hidden_message_for(previous_objective)
+        hidden_message = {"role": "user", "content": hidden_text, "hidden": True}
+        await self.run_blocking(conversation.append, hidden_message)
+        _, references = await self.run_blocking(get_hidden_context, hidden_text, openai_api_key, pinecone_api_key, objective)
+        await turn.emit("context", {"references": references, "degraded": None, "notice": None})
+        response = await agenerate_ai_response(hidden_text, references, openai_api_key, conversation, objective)
+        if isinstance(response, str):  # Error occurred
+            content = response
+            await turn.emit("error", {"message": response})
+        else:
+            detector = CompletionDetector()
+            async for delta in astream_until_complete(response, detector):
+                await turn.emit("token", {"text": delta})
+            content = detector.text
+        assistant_message = {"role": "assistant", "content": content, "references": references}
+        await self.run_blocking(conversation.append, assistant_message)
+        await turn.emit("done", {"content": content, "objective_completed": False, "messages": [hidden_message, assistant_message]})
+
+    # Function to stream a prefetched introduction as it arrives; None if it failed
+    @staticmethod
+    async def _serve_prefetched(turn: Turn, handle: PrefetchHandle) -> Optional[dict]:
+        sent = 0
+        while not handle.done():
+            text = handle.text
+            if len(text) > sent:
+                await turn.emit("token", {"text": text[sent:]})
+                sent = len(text)
+            await asyncio.sleep(_PREFETCH_POLL)
+        result = handle.result()
+        if result is None:
+            if sent:
+                await turn.emit("restart", {})  # The partial introduction is replaced by a fresh one
+            return None
+        if len(result["content"]) > sent:
+            await turn.emit("token", {"text": result["content"][sent:]})
+        return result
+
+    # Function to start preparing the next objective's introduction unless it is already underway
+    @staticmethod
+    def _prefetch_next(state: SessionState, openai_api_key: str, pinecone_api_key: str):
+        next_objective = state.objective + 1
+        if not PREFETCH_ENABLED or next_objective >= len(LEARNING_OBJECTIVES):
+            return
+        if state.prefetch is None or state.prefetch.objective_index != next_objective:
+            state.discard_prefetch()
+            state.prefetch = start_prefetch(next_objective, openai_api_key, pinecone_api_key)
+
+
+# Function to store messages at the end of a conversation, in order
+def _append(conversation: Conversation, *messages: dict):
+    for message in messages:
+        conversation.append(message)
+
+
+# Function to embed a first question for the answer cache (the embedding is reused by retrieval)
+def _embed_or_none(text: str, api_key: str, deadline: Deadline) -> Optional[List[float]]:
+    try:
+        return generate_embedding(text, api_key, deadline)
+    except Exception as e:
+        logger.warning("Error embedding question for the answer cache: %s", e)
+        return None
+
+
+# Function to wait for an attached image's URL (a data URL or its S3 location); (None, error) if ingest failed
+async def _image_url(image: Union[str, Future]) -> Tuple[Optional[str], Optional[str]]:
+    if isinstance(image, str):
+        return image, None
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(image), IMAGE_UPLOAD_TIMEOUT), None
+    except Exception as e:
+        return None, image_error(e)
+
+
+# Function to describe a failed image upload to the student
+def image_error(error: Exception) -> str:
+    from botocore.exceptions import NoCredentialsError  # Only loaded once an upload has failed
+    if isinstance(error, NoCredentialsError):
+        return "AWS credentials not available. Please configure your AWS credentials."
+    return f"An error occurred while uploading the file to S3: {str(error)}"
+
+
+# Function to pick which of `shards` engine workers owns a session; stable across processes and restarts
+def shard_for(session_id: str, shards: int) -> int:
+    return int.from_bytes(hashlib.sha1(session_id.encode()).digest()[:8], "big") % shards
@@ -0,0 +1,216 @@
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Iterator, List, Optional, Sequence, Tuple, Union
+
+from config import (
+    ENGINE_CLIENT_CACHE_SESSIONS,
+    ENGINE_CLIENT_CACHE_TTL,
+    ENGINE_CLIENT_CONNECTIONS,
+    ENGINE_CLIENT_TIMEOUT,
+    ENGINE_HISTORY_PAGE,
+    IMAGE_UPLOAD_TIMEOUT,
+    TUTOR_ENGINE_URL,
+)
+from engine import EngineBusy, TutorEngine, image_error, shard_for
+
+_client = None
+_client_lock = threading.Lock()
+
+
+# Runs the tutor engine on an event loop thread inside this process (the default).
+# Streamlit's script threads call in synchronously; turn events are handed over one
+# at a time, so a slow page holds back its own turn and nothing else.
+class LocalEngineClient:
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="tutor-engine", daemon=True)
+        self._thread.start()
+        self.engine: TutorEngine = self._call(_create_engine())
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def state(self, session_id: str) -> dict:
+        return self._call(self.engine.state(session_id))
+
+    # Function to get the session's conversation; the engine's own, so messages keep their identity across reruns
+    def messages(self, session_id: str) -> Sequence[dict]:
+        return self._call(self.engine.session(session_id)).conversation
+
+    def submit_turn(self, session_id: str, text: str, openai_api_key: str, pinecone_api_key: str,
+                    image: Union[None, str, Future] = None) -> Iterator[Tuple[str, dict]]:
+        return self._events(self.engine.submit(session_id, text, openai_api_key, pinecone_api_key, image))
+
+    def advance(self, session_id: str, openai_api_key: str, pinecone_api_key: str) -> Iterator[Tuple[str, dict]]:
+        return self._events(self.engine.advance(session_id, openai_api_key, pinecone_api_key))
+
+    def reset(self, session_id: str, objective: Optional[int] = None) -> dict:
+        return self._call(self.engine.reset(session_id, objective))
+
+    # Function to start a turn and read its events; leaving early detaches it, and the turn still finishes and is stored
+    def _events(self, start) -> Iterator[Tuple[str, dict]]:
+        turn = self._call(start)
+        events = turn.events()
+        try:
+            while True:
+                event = self._call(_next_event(events))
+                if event is None:
+                    return
+                yield event
+        finally:
+            self._loop.call_soon_threadsafe(turn.detach)
+            asyncio.run_coroutine_threadsafe(events.aclose(), self._loop)
+
+
+async def _create_engine() -> TutorEngine:
+    return TutorEngine()
+
+
+async def _next_event(events) -> Optional[Tuple[str, dict]]:
+    try:
+        return await events.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+# Talks to tutor_server.py over pooled keep-alive connections. Events arrive as
+# server-sent events and are yielded as they are parsed. Each session always goes
+# to the same worker, which holds its state. Sessions' messages are kept between
+# reruns for a while, for the most recently used sessions only.
+class RemoteEngineClient:
+    def __init__(self, urls: List[str], token: str, timeout: float = ENGINE_CLIENT_TIMEOUT, connections: int = ENGINE_CLIENT_CONNECTIONS,
+                 cache_sessions: int = ENGINE_CLIENT_CACHE_SESSIONS, cache_ttl: float = ENGINE_CLIENT_CACHE_TTL):
+        import httpx
+
+        self.urls = [url.rstrip("/") for url in urls]
+        self._http = httpx.Client(
+            headers={"Authorization": f"Bearer {token}"},
+            timeout=httpx.Timeout(timeout, connect=5.0),
+            limits=httpx.Limits(max_connections=connections, max_keepalive_connections=connections),
+        )
+        self.cache_sessions = cache_sessions
+        self.cache_ttl = cache_ttl
+        # session id -> (when its history was read, messages)
+        self._messages: "OrderedDict[str, Tuple[float, List[dict]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _url(self, session_id: str, path: str = "") -> str:
+        return f"{self.urls[shard_for(session_id, len(self.urls))]}/sessions/{session_id}{path}"
+
+    def state(self, session_id: str) -> dict:
+        return self._json(self._http.get(self._url(session_id)))
+
+    # Function to get the session's messages; read from the service, then kept up to date by turns
+    # until they are older than cache_ttl (another client may have written to the session)
+    def messages(self, session_id: str) -> Sequence[dict]:
+        with self._lock:
+            cached = self._messages.get(session_id)
+            if cached is not None and time.monotonic() - cached[0] < self.cache_ttl:
+                self._messages.move_to_end(session_id)
+                return cached[1]
+        fetched_at, messages, before = time.monotonic(), [], None
+        while True:
+            params = {"limit": ENGINE_HISTORY_PAGE} if before is None else {"limit": ENGINE_HISTORY_PAGE, "before": before}
+            page = self._json(self._http.get(self._url(session_id, "/history"), params=params))
+            messages[:0] = page["messages"]
+            if page["start"] == 0:
+                break
+            before = page["start"]
+        self._cache(session_id, messages, fetched_at)
+        return messages
+
+    def submit_turn(self, session_id: str, text: str, openai_api_key: str, pinecone_api_key: str,
+                    image: Union[None, str, Future] = None) -> Iterator[Tuple[str, dict]]:
+        # The service can't see this process's upload; wait for it here and send the URL along
+        error = None
+        if isinstance(image, Future):
+            try:
+                image = image.result(timeout=IMAGE_UPLOAD_TIMEOUT)
+            except Exception as e:
+                image, error = None, image_error(e)
+        if error is not None:
+            yield "image", {"url": None, "error": error}
+        body = {"text": text, "image_url": image}
+        yield from self._stream(session_id, "/turns", body, openai_api_key, pinecone_api_key)
+
+    def advance(self, session_id: str, openai_api_key: str, pinecone_api_key: str) -> Iterator[Tuple[str, dict]]:
+        self._cache(session_id, [])
+        yield from self._stream(session_id, "/advance", {}, openai_api_key, pinecone_api_key)
+
+    def reset(self, session_id: str, objective: Optional[int] = None) -> dict:
+        state = self._json(self._http.post(self._url(session_id, "/reset"), json={"objective": objective}))
+        self._cache(session_id, [])
+        return state
+
+    def _cache(self, session_id: str, messages: List[dict], fetched_at: Optional[float] = None):
+        with self._lock:
+            self._messages[session_id] = (time.monotonic() if fetched_at is None else fetched_at, messages)
+            self._messages.move_to_end(session_id)
+            while len(self._messages) > self.cache_sessions:
+                self._messages.popitem(last=False)
+
+    def _stream(self, session_id: str, path: str, body: dict, openai_api_key: str, pinecone_api_key: str) -> Iterator[Tuple[str, dict]]:
+        headers = {"X-OpenAI-Key": openai_api_key, "X-Pinecone-Key": pinecone_api_key, "Accept": "text/event-stream"}
+        done = False
+        try:
+            with self._http.stream("POST", self._url(session_id, path), json=body, headers=headers) as response:
+                if response.status_code != 200:
+                    response.read()
+                    self._json(response)
+                for event, data in _parse_sse(response.iter_lines()):
+                    if event == "done":
+                        done = True
+                        with self._lock:
+                            cached = self._messages.get(session_id)
+                            if cached is not None:
+                                cached[1].extend(data["messages"])
+                    yield event, data
+        finally:
+            if not done:  # Interrupted: the turn may still have been stored, so read the history again next time
+                with self._lock:
+                    self._messages.pop(session_id, None)
+
+    @staticmethod
+    def _json(response) -> dict:
+        if response.status_code == 503:
+            raise EngineBusy(response.json().get("error", "The tutor is busy"))
+        if response.status_code == 401:
+            raise PermissionError("The tutor engine rejected the TUTOR_ENGINE_TOKEN")
+        if response.status_code >= 400:
+            raise ValueError(response.json().get("error", f"Tutor engine returned {response.status_code}"))
+        return response.json()
+
+
+# Function to turn server-sent event lines into (event, data) pairs
+def _parse_sse(lines: Iterator[str]) -> Iterator[Tuple[str, dict]]:
+    event, data = "message", []
+    for line in lines:
+        if not line:
+            if data:
+                yield event, json.loads("\n".join(data))
+            event, data = "message", []
+        elif line.startswith("event:"):
+            event = line[6:].strip()
+        elif line.startswith("data:"):
+            data.append(line[5:].lstrip())
+
+
+# Function to get the engine client for this process: tutor_server.py workers when
+# TUTOR_ENGINE_URL is set (authenticating with their shared token), otherwise an engine
+# running in this process
+def get_engine_client(token: str = ""):
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                if TUTOR_ENGINE_URL:
+                    if not token:
+                        raise ValueError("TUTOR_ENGINE_URL is set but no TUTOR_ENGINE_TOKEN was given for the engine service")
+                    _client = RemoteEngineClient([url.strip() for url in TUTOR_ENGINE_URL.split(",") if url.strip()], token)
+                else:
+                    _client = LocalEngineClient()
+    return _client
@@ -0,0 +1,77 @@
+"""Snapshot the course namespace from Pinecone into a local index directory.
+
+Usage:
+    python export_index.py --api-key $PINECONE_API_KEY [--out index_snapshot] [--quantize int8]
+
+Set RETRIEVAL_BACKEND = "local" in config.py to serve get_context from the snapshot.
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from clients import get_pinecone_index
+from config import LOCAL_INDEX_DIR, PINECONE_INDEX_NAME, PINECONE_NAMESPACE
+from local_index import write_snapshot
+
+FETCH_BATCH_SIZE = 100
+
+
+# Function to pull every vector id, value and metadata from a namespace
+def fetch_namespace(index, namespace: str, batch_size: int = FETCH_BATCH_SIZE):
+    ids, vectors, metadata = [], [], []
+    pending = []
+
+    def flush():
+        response = index.fetch(ids=pending, namespace=namespace)
+        for vector_id in pending:
+            vector = response.vectors.get(vector_id)
+            if vector is None:
+                continue
+            ids.append(vector_id)
+            vectors.append(vector.values)
+            metadata.append(dict(vector.metadata or {}))
+        pending.clear()
+
+    for page in index.list(namespace=namespace):
+        for vector_id in page:
+            pending.append(vector_id)
+            if len(pending) >= batch_size:
+                flush()
+    if pending:
+        flush()
+    return ids, vectors, metadata
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a Pinecone namespace into a memory-mappable local index.")
+    parser.add_argument("--api-key", default=os.environ.get("PINECONE_API_KEY", ""))
+    parser.add_argument("--index", default=PINECONE_INDEX_NAME)
+    parser.add_argument("--namespace", default=PINECONE_NAMESPACE)
+    parser.add_argument("--out", default=LOCAL_INDEX_DIR)
+    parser.add_argument("--quantize", choices=["int8"], default=None, help="Store vectors as int8 with per-row scales")
+    args = parser.parse_args()
+
+    if not args.api_key:
+        parser.error("a Pinecone API key is required (--api-key or PINECONE_API_KEY)")
+
+    start = time.time()
+    index = get_pinecone_index(args.api_key, args.index)
+    ids, vectors, metadata = fetch_namespace(index, args.namespace)
+    if not ids:
+        parser.error(f"namespace '{args.namespace}' is empty")
+
+    write_snapshot(
+        args.out,
+        ids,
+        np.asarray(vectors, dtype=np.float32),
+        metadata,
+        quantize=args.quantize,
+        extra_manifest={"index": args.index, "namespace": args.namespace, "exported_at": time.time()},
+    )
+    print(f"Exported {len(ids)} vectors from {args.index}/{args.namespace} to {args.out} in {time.time() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
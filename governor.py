@@ -0,0 +1,442 @@
+import asyncio
+import functools
+import hashlib
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from contextvars import ContextVar, copy_context
+from typing import Any, Callable, Deque, Dict, Hashable, Optional
+
+from config import (
+    GOVERNOR_BACKOFF_BASE,
+    GOVERNOR_BACKOFF_CAP,
+    GOVERNOR_ENABLED,
+    GOVERNOR_LIMITS,
+    GOVERNOR_MAX_RETRIES,
+    GOVERNOR_QUEUE_TIMEOUT,
+)
+from metrics import metrics
+
+# The Streamlit session a call is made for; work handed to thread pools carries it along
+_session: ContextVar[str] = ContextVar("governor_session", default="")
+
+
+class GovernorTimeout(Exception):
+    pass
+
+
+def set_session(session_id: str):
+    _session.set(session_id)
+
+
+# Function to get the session the current call is made for; "" outside of one
+def current_session() -> str:
+    return _session.get()
+
+
+# Function to wrap fn so it runs with the caller's session when submitted to a thread pool
+def carry_session(fn: Callable) -> Callable:
+    return functools.partial(copy_context().run, fn)
+
+
+# Requests per second for one API key, with bursts up to `burst`
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Function to take one token, waiting for a refill up to the deadline; False when it would pass it
+    def acquire(self, deadline: float) -> bool:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                delay = (1 - self._tokens) / self.rate
+            if now + delay > deadline:
+                return False
+            time.sleep(delay)
+
+    # The same from a coroutine: waits for the refill with asyncio.sleep
+    async def acquire_async(self, deadline: float) -> bool:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                delay = (1 - self._tokens) / self.rate
+            if now + delay > deadline:
+                return False
+            await asyncio.sleep(delay)
+
+
+# A FairLimiter waiter for a coroutine: granting it wakes the waiting task on its own loop,
+# from whichever thread released the slot
+class _AsyncWaiter:
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self._future = loop.create_future()
+        self._granted = False
+
+    # Called with the limiter lock held; whether the slot was granted is decided here, not by the wake-up
+    def set(self):
+        self._granted = True
+        try:
+            self._loop.call_soon_threadsafe(self._wake)
+        except RuntimeError:  # The loop has closed; nobody is left to wake
+            pass
+
+    def is_set(self) -> bool:
+        return self._granted
+
+    def _wake(self):
+        if not self._future.done():
+            self._future.set_result(None)
+
+    async def wait(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self._future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self._granted
+
+
+# Bounded number of calls in flight. Waiters queue per session and sessions are
+# served round-robin, so one student firing many requests can't starve the others.
+class FairLimiter:
+    def __init__(self, max_in_flight: int):
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self._queues: "OrderedDict[str, Deque[threading.Event]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, session: str, timeout: float) -> bool:
+        with self._lock:
+            if self.in_flight < self.max_in_flight and not self._queues:
+                self.in_flight += 1
+                return True
+            waiter = threading.Event()
+            self._queues.setdefault(session, deque()).append(waiter)
+        if waiter.wait(timeout):
+            return True
+        return not self._withdraw(session, waiter)
+
+    # The same from a coroutine: waiting holds no thread, and the queue timeout starts at once.
+    # A waiter cancelled after its slot was granted hands the slot on instead of keeping it.
+    async def acquire_async(self, session: str, timeout: float) -> bool:
+        with self._lock:
+            if self.in_flight < self.max_in_flight and not self._queues:
+                self.in_flight += 1
+                return True
+            waiter = _AsyncWaiter(asyncio.get_running_loop())
+            self._queues.setdefault(session, deque()).append(waiter)
+        try:
+            if await waiter.wait(timeout):
+                return True
+        except asyncio.CancelledError:
+            if not self._withdraw(session, waiter):
+                self.release()
+            raise
+        return not self._withdraw(session, waiter)
+
+    # Function to take a waiter out of its queue; False when it was granted a slot in the meantime
+    def _withdraw(self, session: str, waiter) -> bool:
+        with self._lock:
+            if waiter.is_set():
+                return False
+            queue = self._queues.get(session)
+            if queue is not None:
+                queue.remove(waiter)
+                if not queue:
+                    del self._queues[session]
+        return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            while self.in_flight < self.max_in_flight and self._queues:
+                session, queue = self._queues.popitem(last=False)
+                waiter = queue.popleft()
+                if queue:  # The session goes to the back of the line
+                    self._queues[session] = queue
+                self.in_flight += 1
+                waiter.set()
+
+    @property
+    def queued(self) -> int:
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+
+# Identical calls already in flight share the first caller's result instead of
+# reaching the provider again
+class Coalescer:
+    def __init__(self):
+        self._in_flight: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    # Function to run fn, or wait for the same call already in flight. A follower waits at
+    # most timeout seconds, its own budget, rather than as long as the leader takes.
+    def run(self, key: Hashable, fn: Callable[[], Any], timeout: Optional[float] = None) -> Any:
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            try:
+                return future.result(timeout)
+            except FutureTimeoutError:
+                raise GovernorTimeout(f"Shared request did not finish within {timeout}s")
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+
+# A streamed completion that keeps its in-flight slot until it is exhausted or closed
+class GovernedStream:
+    def __init__(self, stream, release: Callable[[], None]):
+        self._stream = stream
+        self._release = release
+        self._released = False
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        try:
+            for chunk in self._stream:
+                yield chunk
+        finally:
+            self._done()
+
+    def close(self):
+        try:
+            if hasattr(self._stream, "close"):
+                self._stream.close()
+        finally:
+            self._done()
+
+    def __del__(self):
+        self._done()
+
+    def _done(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._release()
+
+
+class _Stage:
+    def __init__(self, rate: float, burst: float, max_in_flight: int):
+        self.rate = rate
+        self.burst = burst
+        self.limiter = FairLimiter(max_in_flight)
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.coalescer = Coalescer()
+
+
+# The asyncio counterpart of GovernedStream, for streams read by the tutor engine
+class AsyncGovernedStream:
+    def __init__(self, stream, release: Callable[[], None]):
+        self._stream = stream
+        self._release = release
+        self._released = False
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                yield chunk
+        finally:
+            self._done()
+
+    async def aclose(self):
+        try:
+            close = getattr(self._stream, "close", None)
+            if close is not None:
+                result = close()
+                if asyncio.iscoroutine(result):
+                    await result
+        finally:
+            self._done()
+
+    def __del__(self):
+        self._done()
+
+    def _done(self):
+        if not self._released:
+            self._released = True
+            self._release()
+
+
+# Process-wide limits on calls to OpenAI and Pinecone, one set per stage
+# ("chat", "rewrite", "embedding", "vector_query"). Every Streamlit session in
+# the process goes through the same governor.
+class Governor:
+    def __init__(self, limits: Dict[str, dict] = GOVERNOR_LIMITS, enabled: bool = GOVERNOR_ENABLED,
+                 queue_timeout: float = GOVERNOR_QUEUE_TIMEOUT, max_retries: int = GOVERNOR_MAX_RETRIES,
+                 backoff_base: float = GOVERNOR_BACKOFF_BASE, backoff_cap: float = GOVERNOR_BACKOFF_CAP):
+        self.enabled = enabled
+        self.queue_timeout = queue_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self._stages = {stage: _Stage(**limit) for stage, limit in limits.items()}
+        self._lock = threading.Lock()
+
+    # Function to run one provider call under the stage's limits, retrying on 429s
+    def call(self, stage: str, api_key: str, fn: Callable, *args, **kwargs):
+        if not self.enabled:
+            return fn(*args, **kwargs)
+        release = self.acquire(stage, api_key)
+        try:
+            return self._with_retries(stage, api_key, fn, *args, **kwargs)
+        finally:
+            release()
+
+    # Function to open a streamed completion; the slot is held until the stream is drained or closed
+    def stream(self, stage: str, api_key: str, fn: Callable, *args, **kwargs):
+        if not self.enabled:
+            return fn(*args, **kwargs)
+        release = self.acquire(stage, api_key)
+        try:
+            stream = self._with_retries(stage, api_key, fn, *args, **kwargs)
+        except BaseException:
+            release()
+            raise
+        return GovernedStream(stream, release)
+
+    # Function to open a streamed completion from async code. Waiting for a slot and retries
+    # happen on the event loop without blocking it or holding a thread.
+    async def astream(self, stage: str, api_key: str, fn: Callable, *args, **kwargs):
+        if not self.enabled:
+            return AsyncGovernedStream(await fn(*args, **kwargs), lambda: None)
+        release = await self.acquire_async(stage, api_key)
+        try:
+            attempt = 0
+            while True:
+                try:
+                    stream = await fn(*args, **kwargs)
+                    break
+                except Exception as e:
+                    if attempt >= self.max_retries or not _is_rate_limited(e):
+                        raise
+                    delay = _retry_after(e) or random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+                    attempt += 1
+                    metrics.incr("governor", f"{stage}_retries")
+                    await asyncio.sleep(delay)
+                    # A retry is another request against the key's rate limit, as in _with_retries
+                    if not await self._bucket(self._stages[stage], api_key).acquire_async(time.monotonic() + self.queue_timeout):
+                        raise
+        except BaseException:
+            release()
+            raise
+        return AsyncGovernedStream(stream, release)
+
+    # Function to share one call among identical requests already in flight
+    def coalesce(self, stage: str, key: Hashable, fn: Callable[[], Any], timeout: Optional[float] = None) -> Any:
+        if not self.enabled:
+            return fn()
+        return self._stages[stage].coalescer.run(key, fn, timeout)
+
+    def acquire(self, stage: str, api_key: str) -> Callable[[], None]:
+        limits = self._stages[stage]
+        start = time.monotonic()
+        if not limits.limiter.acquire(_session.get(), self.queue_timeout):
+            metrics.incr("governor", f"{stage}_timeouts")
+            raise GovernorTimeout(f"No {stage} capacity within {self.queue_timeout}s")
+        if not self._bucket(limits, api_key).acquire(start + self.queue_timeout):
+            limits.limiter.release()
+            metrics.incr("governor", f"{stage}_timeouts")
+            raise GovernorTimeout(f"{stage} rate limit for this API key not available within {self.queue_timeout}s")
+        metrics.record(f"governor_{stage}_wait", time.monotonic() - start)
+        return limits.limiter.release
+
+    async def acquire_async(self, stage: str, api_key: str) -> Callable[[], None]:
+        limits = self._stages[stage]
+        start = time.monotonic()
+        if not await limits.limiter.acquire_async(_session.get(), self.queue_timeout):
+            metrics.incr("governor", f"{stage}_timeouts")
+            raise GovernorTimeout(f"No {stage} capacity within {self.queue_timeout}s")
+        try:
+            acquired = await self._bucket(limits, api_key).acquire_async(start + self.queue_timeout)
+        except BaseException:  # Cancelled while waiting for a token
+            limits.limiter.release()
+            raise
+        if not acquired:
+            limits.limiter.release()
+            metrics.incr("governor", f"{stage}_timeouts")
+            raise GovernorTimeout(f"{stage} rate limit for this API key not available within {self.queue_timeout}s")
+        metrics.record(f"governor_{stage}_wait", time.monotonic() - start)
+        return limits.limiter.release
+
+    def stats(self) -> dict:
+        stats = {}
+        for stage, limits in self._stages.items():
+            stats[f"{stage}_in_flight"] = limits.limiter.in_flight
+            stats[f"{stage}_queued"] = limits.limiter.queued
+            stats[f"{stage}_coalesced"] = limits.coalescer.coalesced
+        return stats
+
+    def _bucket(self, limits: _Stage, api_key: str) -> TokenBucket:
+        key = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+        with self._lock:
+            bucket = limits.buckets.get(key)
+            if bucket is None:
+                bucket = limits.buckets[key] = TokenBucket(limits.rate, limits.burst)
+            return bucket
+
+    def _with_retries(self, stage: str, api_key: str, fn: Callable, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.max_retries or not _is_rate_limited(e):
+                    raise
+                # Full jitter: spread the retries of a burst instead of sending them back together
+                delay = _retry_after(e) or random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+                attempt += 1
+                metrics.incr("governor", f"{stage}_retries")
+                time.sleep(delay)
+                if not self._bucket(self._stages[stage], api_key).acquire(time.monotonic() + self.queue_timeout):
+                    raise
+
+
+def _is_rate_limited(error: Exception) -> bool:
+    status = getattr(error, "status_code", None) or getattr(error, "status", None)
+    return status == 429
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        value = headers.get("retry-after")
+        return min(float(value), GOVERNOR_BACKOFF_CAP) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+governor = Governor()
+metrics.register_collector("governor", governor.stats)
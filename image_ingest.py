@@ -0,0 +1,122 @@
+import base64
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+from PIL import Image, ImageOps
+
+from clients import get_s3_client
+from config import (
+    IMAGE_INLINE_MAX_BYTES,
+    IMAGE_JPEG_QUALITY,
+    IMAGE_MAX_LONG_SIDE,
+    IMAGE_MAX_SHORT_SIDE,
+    IMAGE_UPLOAD_WORKERS,
+    IMAGE_URL_CACHE_SIZE,
+)
+from governor import carry_session
+from metrics import metrics
+
+_executor = ThreadPoolExecutor(max_workers=IMAGE_UPLOAD_WORKERS, thread_name_prefix="image-upload")
+
+# Content hash -> URL of images already uploaded by this process
+_uploaded: "OrderedDict[str, str]" = OrderedDict()
+_uploaded_lock = threading.Lock()
+
+
+# An attached image after decoding, downscaling and re-encoding
+class PreparedImage:
+    def __init__(self, data: bytes, content_type: str, digest: str, width: int, height: int):
+        self.data = data
+        self.content_type = content_type
+        self.digest = digest
+        self.width = width
+        self.height = height
+
+    @property
+    def extension(self) -> str:
+        return "png" if self.content_type == "image/png" else "jpg"
+
+    def data_url(self) -> str:
+        return f"data:{self.content_type};base64,{base64.b64encode(self.data).decode('ascii')}"
+
+
+# Function to shrink an image to what the vision model actually looks at. High-detail
+# images are scaled to fit 2048px and then 768px on the short side anyway, so sending
+# more pixels only costs upload time. Screenshots with transparency stay PNG.
+def prepare_image(raw: bytes, digest: Optional[str] = None) -> PreparedImage:
+    digest = digest or content_digest(raw)
+    with metrics.span("image_prepare", input_bytes=len(raw)) as span:
+        image = ImageOps.exif_transpose(Image.open(io.BytesIO(raw)))
+        scale = min(1.0, IMAGE_MAX_LONG_SIDE / max(image.size), IMAGE_MAX_SHORT_SIDE / min(image.size))
+        if scale < 1.0:
+            image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.LANCZOS)
+
+        output = io.BytesIO()
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            image.save(output, format="PNG", optimize=True)
+            content_type = "image/png"
+        else:
+            image.convert("RGB").save(output, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True, progressive=True)
+            content_type = "image/jpeg"
+        data = output.getvalue()
+        span["output_bytes"] = len(data)
+    return PreparedImage(data, content_type, digest, image.width, image.height)
+
+
+def content_digest(raw: bytes) -> str:
+    return hashlib.sha256(raw).hexdigest()
+
+
+# Function to upload a prepared image under its content hash, skipping images already in the bucket
+def upload_to_s3(prepared: PreparedImage, bucket_name: str, base_url: str) -> str:
+    key = f"learning_app/{prepared.digest}.{prepared.extension}"
+    url = f"{base_url}/{key}"
+    with metrics.span("s3_upload", bytes=len(prepared.data)) as span:
+        client = get_s3_client()
+        try:
+            client.head_object(Bucket=bucket_name, Key=key)
+            span["deduplicated"] = 1
+        except Exception:  # Not there yet (or no permission to check): upload it
+            client.upload_fileobj(io.BytesIO(prepared.data), bucket_name, key, ExtraArgs={"ContentType": prepared.content_type})
+    _remember(prepared.digest, url)
+    return url
+
+
+def _remember(digest: str, url: str):
+    with _uploaded_lock:
+        _uploaded[digest] = url
+        _uploaded.move_to_end(digest)
+        while len(_uploaded) > IMAGE_URL_CACHE_SIZE:
+            _uploaded.popitem(last=False)
+
+
+def _known_url(digest: str) -> Optional[str]:
+    with _uploaded_lock:
+        url = _uploaded.get(digest)
+        if url is not None:
+            _uploaded.move_to_end(digest)
+        return url
+
+
+# Function to start ingesting an attached image off the script thread. The future gives
+# the URL to send to the vision model: small images are inlined as a data URL, repeats of
+# an image this process already uploaded reuse its URL, and the rest are uploaded to S3.
+def ingest_image(raw: bytes, bucket_name: str, base_url: str) -> Future:
+    return _executor.submit(carry_session(_ingest), raw, bucket_name, base_url)
+
+
+def _ingest(raw: bytes, bucket_name: str, base_url: str) -> str:
+    digest = content_digest(raw)
+    known = _known_url(digest)
+    if known is not None:
+        metrics.incr("image_ingest", "deduplicated")
+        return known
+    prepared = prepare_image(raw, digest)
+    if len(prepared.data) <= IMAGE_INLINE_MAX_BYTES:
+        metrics.incr("image_ingest", "inlined")
+        return prepared.data_url()
+    return upload_to_s3(prepared, bucket_name, base_url)
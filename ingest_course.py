@@ -0,0 +1,325 @@
+"""Build the course namespace from transcript files.
+
+Transcripts (.txt, .md, .srt or .vtt) are streamed line by line and cut into
+overlapping chunks tagged with `source` and `text` metadata, as get_context
+expects, and with the `objective` they teach (see tag_objectives.py). Chunks
+are embedded in large batches with a bounded number of requests in flight and
+written to Pinecone in bulk upserts, or to a local snapshot.
+
+Every chunk id is a hash of its source and text. Embeddings and upserts are
+recorded in a SQLite state file as each batch finishes, so re-running only
+embeds and upserts what changed and an interrupted run picks up where it stopped.
+
+Usage:
+    python ingest_course.py transcripts/ --openai-key $OPENAI_API_KEY --pinecone-key $PINECONE_API_KEY [--prune]
+    python ingest_course.py transcripts/ --openai-key $OPENAI_API_KEY --backend local [--out index_snapshot]
+
+A `sources.json` in the transcript directory may map file names to the video
+URLs shown to students; otherwise the file's relative path is the source.
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+from array import array
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from clients import get_openai_client, get_pinecone_index
+from config import (
+    EMBEDDING_MODEL,
+    INGEST_CHUNK_OVERLAP,
+    INGEST_CHUNK_WORDS,
+    INGEST_EMBED_BATCH,
+    INGEST_EMBED_WORKERS,
+    INGEST_STATE_PATH,
+    INGEST_UPSERT_BATCH,
+    INGEST_UPSERT_WORKERS,
+    LOCAL_INDEX_DIR,
+    OBJECTIVE_PARTITIONS_ENABLED,
+    PINECONE_INDEX_NAME,
+    PINECONE_NAMESPACE,
+)
+from governor import governor
+from local_index import write_snapshot
+from objective_partitions import assign_objectives, objective_embeddings
+
+TRANSCRIPT_EXTENSIONS = (".txt", ".md", ".srt", ".vtt")
+SOURCES_FILE = "sources.json"
+
+# Subtitle cue numbers, timestamps and the WEBVTT header carry no text
+_CUE_LINE = re.compile(r"^(\d+|WEBVTT.*|NOTE.*|[\d:.,]+\s*-->\s*[\d:.,]+.*)$")
+_TAG = re.compile(r"<[^>]+>")
+
+
+# Function to list the transcript files under a directory, in a stable order
+def find_transcripts(root: str) -> List[str]:
+    paths = []
+    for directory, _, files in os.walk(root):
+        paths.extend(os.path.join(directory, name) for name in files if name.lower().endswith(TRANSCRIPT_EXTENSIONS))
+    return sorted(paths)
+
+
+# Function to stream the words of a transcript, dropping subtitle cue lines and markup
+def read_words(path: str) -> Iterator[str]:
+    subtitles = path.lower().endswith((".srt", ".vtt"))
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            line = line.strip()
+            if subtitles:
+                if _CUE_LINE.match(line):
+                    continue
+                line = _TAG.sub("", line)
+            yield from line.split()
+
+
+# Function to cut a word stream into chunks of `size` words, each repeating the last `overlap` of the previous one
+def chunk_words(words: Iterator[str], size: int = INGEST_CHUNK_WORDS, overlap: int = INGEST_CHUNK_OVERLAP) -> Iterator[str]:
+    if not 0 <= overlap < size:
+        raise ValueError("overlap must be smaller than the chunk size")
+    window: deque = deque()
+    fresh = 0  # Words in the window not yet emitted in a chunk
+    for word in words:
+        window.append(word)
+        fresh += 1
+        if len(window) == size:
+            yield " ".join(window)
+            for _ in range(size - overlap):
+                window.popleft()
+            fresh = 0
+    if fresh:
+        yield " ".join(window)
+
+
+def chunk_id(source: str, text: str) -> str:
+    return hashlib.sha256(f"{source}\n{text}".encode("utf-8")).hexdigest()[:32]
+
+
+# Function to stream (id, source, text) for every chunk of every transcript
+def iter_chunks(root: str, size: int = INGEST_CHUNK_WORDS, overlap: int = INGEST_CHUNK_OVERLAP) -> Iterator[Tuple[str, str, str]]:
+    sources: Dict[str, str] = {}
+    sources_path = os.path.join(root, SOURCES_FILE)
+    if os.path.exists(sources_path):
+        with open(sources_path) as f:
+            sources = json.load(f)
+    for path in find_transcripts(root):
+        name = os.path.relpath(path, root)
+        source = sources.get(name) or sources.get(os.path.basename(path)) or name
+        seen = set()
+        for text in chunk_words(read_words(path), size, overlap):
+            vector_id = chunk_id(source, text)
+            if vector_id not in seen:  # Repeated passages within one transcript are stored once
+                seen.add(vector_id)
+                yield vector_id, source, text
+
+
+# Progress of ingestion runs: chunk texts per target, their embeddings, and which
+# chunks each target already holds. Everything is committed batch by batch.
+class IngestState:
+    def __init__(self, path: str = INGEST_STATE_PATH):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "target TEXT NOT NULL, id TEXT NOT NULL, source TEXT NOT NULL, text TEXT NOT NULL, "
+            "run REAL NOT NULL, written INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (target, id))"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS vectors (model TEXT NOT NULL, id TEXT NOT NULL, vector BLOB NOT NULL, PRIMARY KEY (model, id))")
+
+    # Function to record that a chunk belongs to this run; True when it still needs an embedding
+    def see(self, target: str, run: float, vector_id: str, source: str, text: str, model: str) -> bool:
+        self.db.execute(
+            "INSERT INTO chunks (target, id, source, text, run) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (target, id) DO UPDATE SET run = excluded.run",
+            (target, vector_id, source, text, run),
+        )
+        return self.db.execute("SELECT 1 FROM vectors WHERE model = ? AND id = ?", (model, vector_id)).fetchone() is None
+
+    def store_vectors(self, model: str, ids: List[str], vectors: List[List[float]]):
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO vectors (model, id, vector) VALUES (?, ?, ?)",
+                [(model, vector_id, array("f", vector).tobytes()) for vector_id, vector in zip(ids, vectors)],
+            )
+
+    # Function to stream this run's chunks with their vectors, optionally only those not yet written
+    def chunks(self, target: str, run: float, model: str, unwritten: bool = False) -> Iterator[Tuple[str, dict, List[float]]]:
+        query = (
+            "SELECT c.id, c.source, c.text, v.vector FROM chunks c JOIN vectors v ON v.model = ? AND v.id = c.id "
+            "WHERE c.target = ? AND c.run = ?" + (" AND c.written = 0" if unwritten else "") + " ORDER BY c.rowid"
+        )
+        for vector_id, source, text, blob in self.db.execute(query, (model, target, run)).fetchall():
+            yield vector_id, {"source": source, "text": text}, array("f", blob).tolist()
+
+    def mark_written(self, target: str, ids: List[str]):
+        with self.db:
+            self.db.executemany("UPDATE chunks SET written = 1 WHERE target = ? AND id = ?", [(target, vector_id) for vector_id in ids])
+
+    # Function to list the chunks of a target that no transcript produced in this run
+    def stale(self, target: str, run: float) -> List[str]:
+        return [row[0] for row in self.db.execute("SELECT id FROM chunks WHERE target = ? AND run != ?", (target, run))]
+
+    def forget(self, target: str, ids: List[str]):
+        with self.db:
+            self.db.executemany("DELETE FROM chunks WHERE target = ? AND id = ?", [(target, vector_id) for vector_id in ids])
+
+
+# Function to run fn over batches on a pool with at most `workers` batches in flight, handing each result to on_done
+def run_batches(batches: Iterator, fn: Callable, on_done: Callable, workers: int):
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest") as executor:
+        pending = {}
+        for batch in batches:
+            if len(pending) >= workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    on_done(pending.pop(future), future.result())
+            pending[executor.submit(fn, batch)] = batch
+        for future in list(pending):
+            on_done(pending.pop(future), future.result())
+
+
+def _batched(items: Iterator, size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Function to embed every chunk of the run that has no stored embedding yet; returns (chunks, embedded)
+def embed_chunks(state: IngestState, target: str, run: float, root: str, openai_api_key: str,
+                 batch_size: int = INGEST_EMBED_BATCH, workers: int = INGEST_EMBED_WORKERS,
+                 size: int = INGEST_CHUNK_WORDS, overlap: int = INGEST_CHUNK_OVERLAP) -> Tuple[int, int]:
+    client = get_openai_client(openai_api_key)
+    counts = {"chunks": 0, "embedded": 0}
+
+    def missing() -> Iterator[Tuple[str, str]]:
+        for vector_id, source, text in iter_chunks(root, size, overlap):
+            counts["chunks"] += 1
+            if state.see(target, run, vector_id, source, text, EMBEDDING_MODEL):
+                yield vector_id, text
+
+    def embed(batch: List[Tuple[str, str]]) -> List[List[float]]:
+        response = governor.call("embedding", openai_api_key, client.embeddings.create,
+                                 model=EMBEDDING_MODEL, input=[text for _, text in batch])
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+    def store(batch: List[Tuple[str, str]], vectors: List[List[float]]):
+        state.store_vectors(EMBEDDING_MODEL, [vector_id for vector_id, _ in batch], vectors)
+        counts["embedded"] += len(batch)
+        print(f"Embedded {counts['embedded']} new chunks ({counts['chunks']} read)")
+
+    run_batches(_batched(missing(), batch_size), embed, store, workers)
+    return counts["chunks"], counts["embedded"]
+
+
+# Function to add each chunk's objective to its metadata, when objective embeddings are given
+def tag_batch(batch: List[Tuple[str, dict, List[float]]], objective_vectors: Optional[np.ndarray]) -> List[Tuple[str, dict, List[float]]]:
+    if objective_vectors is None or not batch:
+        return batch
+    assigned, _ = assign_objectives(np.asarray([vector for _, _, vector in batch], dtype=np.float32), objective_vectors)
+    return [(vector_id, {**metadata, "objective": int(objective)}, vector)
+            for (vector_id, metadata, vector), objective in zip(batch, assigned)]
+
+
+# Function to upsert the run's unwritten chunks to Pinecone and optionally delete chunks no transcript produced
+def write_pinecone(state: IngestState, target: str, run: float, pinecone_api_key: str, index_name: str, namespace: str,
+                   batch_size: int = INGEST_UPSERT_BATCH, workers: int = INGEST_UPSERT_WORKERS, prune: bool = False,
+                   objective_vectors: Optional[np.ndarray] = None) -> Tuple[int, int]:
+    index = get_pinecone_index(pinecone_api_key, index_name)
+    written = [0]
+
+    def upsert(batch) -> None:
+        governor.call("vector_upsert", pinecone_api_key, index.upsert, namespace=namespace, vectors=[
+            {"id": vector_id, "values": vector, "metadata": metadata} for vector_id, metadata, vector in tag_batch(batch, objective_vectors)
+        ])
+
+    def mark(batch, _):
+        state.mark_written(target, [vector_id for vector_id, _, _ in batch])
+        written[0] += len(batch)
+
+    run_batches(_batched(state.chunks(target, run, EMBEDDING_MODEL, unwritten=True), batch_size), upsert, mark, workers)
+
+    removed = 0
+    if prune:
+        for batch in _batched(iter(state.stale(target, run)), batch_size):
+            governor.call("vector_upsert", pinecone_api_key, index.delete, ids=batch, namespace=namespace)
+            state.forget(target, batch)
+            removed += len(batch)
+    return written[0], removed
+
+
+# Function to write the run's chunks as a local snapshot; chunks from earlier runs are dropped with it
+def write_local(state: IngestState, target: str, run: float, directory: str, quantize: Optional[str] = None,
+                objective_vectors: Optional[np.ndarray] = None) -> int:
+    ids, vectors, metadata = [], [], []
+    for vector_id, meta, vector in tag_batch(list(state.chunks(target, run, EMBEDDING_MODEL)), objective_vectors):
+        ids.append(vector_id)
+        vectors.append(vector)
+        metadata.append(meta)
+    if not ids:
+        return 0
+    write_snapshot(directory, ids, np.asarray(vectors, dtype=np.float32), metadata, quantize=quantize,
+                   extra_manifest={"model": EMBEDDING_MODEL, "ingested_at": time.time()})
+    state.forget(target, state.stale(target, run))
+    return len(ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chunk, embed and index course transcripts.")
+    parser.add_argument("transcripts", help="Directory of .txt, .md, .srt or .vtt transcripts")
+    parser.add_argument("--openai-key", default=os.environ.get("OPENAI_API_KEY", ""))
+    parser.add_argument("--pinecone-key", default=os.environ.get("PINECONE_API_KEY", ""))
+    parser.add_argument("--backend", choices=["pinecone", "local"], default="pinecone")
+    parser.add_argument("--index", default=PINECONE_INDEX_NAME)
+    parser.add_argument("--namespace", default=PINECONE_NAMESPACE)
+    parser.add_argument("--out", default=LOCAL_INDEX_DIR, help="Snapshot directory for --backend local")
+    parser.add_argument("--quantize", choices=["int8"], default=None, help="Store local vectors as int8 with per-row scales")
+    parser.add_argument("--state", default=INGEST_STATE_PATH)
+    parser.add_argument("--chunk-words", type=int, default=INGEST_CHUNK_WORDS)
+    parser.add_argument("--overlap", type=int, default=INGEST_CHUNK_OVERLAP)
+    parser.add_argument("--embed-batch", type=int, default=INGEST_EMBED_BATCH)
+    parser.add_argument("--workers", type=int, default=INGEST_EMBED_WORKERS, help="Embedding requests in flight")
+    parser.add_argument("--prune", action="store_true", help="Delete Pinecone vectors of chunks no transcript produces any more")
+    args = parser.parse_args()
+
+    if not args.openai_key:
+        parser.error("an OpenAI API key is required (--openai-key or OPENAI_API_KEY)")
+    if args.backend == "pinecone" and not args.pinecone_key:
+        parser.error("a Pinecone API key is required (--pinecone-key or PINECONE_API_KEY)")
+    if not find_transcripts(args.transcripts):
+        parser.error(f"no transcripts found in '{args.transcripts}'")
+
+    start = time.time()
+    target = f"pinecone:{args.index}/{args.namespace}" if args.backend == "pinecone" else f"local:{os.path.abspath(args.out)}"
+    state = IngestState(args.state)
+    run = time.time()
+    chunks, embedded = embed_chunks(state, target, run, args.transcripts, args.openai_key,
+                                    batch_size=args.embed_batch, workers=args.workers,
+                                    size=args.chunk_words, overlap=args.overlap)
+    objective_vectors = objective_embeddings(args.openai_key) if OBJECTIVE_PARTITIONS_ENABLED else None
+    if args.backend == "pinecone":
+        written, removed = write_pinecone(state, target, run, args.pinecone_key, args.index, args.namespace, prune=args.prune,
+                                          objective_vectors=objective_vectors)
+        print(f"{chunks} chunks, {embedded} embedded, {written} upserted, {removed} removed "
+              f"in {args.index}/{args.namespace} in {time.time() - start:.1f}s")
+    else:
+        written = write_local(state, target, run, args.out, quantize=args.quantize, objective_vectors=objective_vectors)
+        print(f"{chunks} chunks, {embedded} embedded, {written} written to {args.out} in {time.time() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import math
+import re
+import threading
+from collections import Counter
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from config import BM25_B, BM25_K1, LOCAL_INDEX_DIR
+from local_index import get_local_index
+
+# Identifiers (with the call parentheses dropped), numbers and words; `range()` -> "range"
+_TOKEN = re.compile(r"[a-z_][a-z0-9_]*|\d+")
+_STOPWORDS = frozenset(
+    "a an and are as at be but by can do does for from how i if in into is it its me my of on or so that the "
+    "their then there these this to was we what when where which while who why will with you your".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in _TOKEN.findall(text.lower()) if token not in _STOPWORDS]
+
+
+# BM25 over the chunk texts of the local snapshot. Exact tokens such as `append`,
+# `input` or an error name are found even when the dense embedding misses them.
+class LexicalIndex:
+    def __init__(self, ids: List[str], metadata: List[dict], k1: float = BM25_K1, b: float = BM25_B):
+        self.ids = ids
+        self.metadata = metadata
+        self.k1 = k1
+        self.b = b
+        # Objective each row is tagged with, -1 for untagged rows
+        self._objectives = np.array([meta.get("objective", -1) for meta in metadata], dtype=np.int64)
+        self._tagged = bool((self._objectives >= 0).any())
+        lengths = np.zeros(len(ids), dtype=np.float32)
+        postings: Dict[str, Dict[int, int]] = {}
+        for row, meta in enumerate(metadata):
+            tokens = tokenize(meta.get("text", ""))
+            lengths[row] = len(tokens)
+            for token, count in Counter(tokens).items():
+                postings.setdefault(token, {})[row] = count
+        average = float(lengths.mean()) if len(ids) else 0.0
+        # Per-row length normalisation of the BM25 denominator, precomputed once
+        self._norms = k1 * (1 - b + b * lengths / average) if average else np.full(len(ids), k1, dtype=np.float32)
+        self._postings = {
+            token: (np.fromiter(rows.keys(), dtype=np.int64, count=len(rows)),
+                    np.fromiter(rows.values(), dtype=np.float32, count=len(rows)))
+            for token, rows in postings.items()
+        }
+        self._idf = {
+            token: math.log(1 + (len(ids) - len(rows) + 0.5) / (len(rows) + 0.5))
+            for token, rows in postings.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def scores(self, text: str) -> np.ndarray:
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for token in set(tokenize(text)):
+            posting = self._postings.get(token)
+            if posting is None:
+                continue
+            rows, counts = posting
+            scores[rows] += self._idf[token] * counts * (self.k1 + 1) / (counts + self._norms[rows])
+        return scores
+
+    # Same result shape as Pinecone's index.query: {'matches': [{'id', 'score', 'metadata'}]};
+    # with `objectives` only chunks tagged with one of them are returned (all, if none are tagged)
+    def query(self, texts: Sequence[str], top_k: int = 20, objectives: Optional[Sequence[int]] = None) -> dict:
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for text in texts:
+            scores = np.maximum(scores, self.scores(text))
+        if objectives is not None and self._tagged:
+            scores[~np.isin(self._objectives, list(objectives))] = 0.0
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        order = candidates[np.argsort(-scores[candidates])]
+        return {"matches": [{"id": self.ids[row], "score": float(scores[row]), "metadata": self.metadata[row]} for row in order]}
+
+
+_lexical_index: Optional[LexicalIndex] = None
+_lexical_index_lock = threading.Lock()
+
+
+# Function to get the process-wide lexical index, built from the local snapshot on first use
+def get_lexical_index(directory: str = LOCAL_INDEX_DIR) -> LexicalIndex:
+    global _lexical_index
+    if _lexical_index is None:
+        with _lexical_index_lock:
+            if _lexical_index is None:
+                snapshot = get_local_index(directory)
+                _lexical_index = LexicalIndex(snapshot.ids, snapshot.metadata)
+    return _lexical_index
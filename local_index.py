@@ -0,0 +1,198 @@
+import json
+import os
+import shutil
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from config import LOCAL_INDEX_BLOCK_ROWS, LOCAL_INDEX_DIR
+
+MANIFEST_FILE = "manifest.json"
+VECTORS_FILE = "vectors.npy"
+SCALES_FILE = "scales.npy"
+METADATA_FILE = "metadata.jsonl"
+# Prefix of the subdirectory each snapshot version is written to
+VERSION_PREFIX = "snapshot-"
+
+
+# Exact top-k search over a snapshot of the Pinecone namespace. Vectors are
+# memory-mapped read-only, so every worker process shares the same pages. Rows
+# are stored grouped by objective, so a search within some objectives only
+# scans their slices. The manifest names the version subdirectory holding the
+# files (snapshots written before versions keep them next to the manifest).
+class LocalIndex:
+    def __init__(self, directory: str = LOCAL_INDEX_DIR, block_rows: int = LOCAL_INDEX_BLOCK_ROWS):
+        with open(os.path.join(directory, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        files = os.path.join(directory, self.manifest.get("version", ""))
+        self.vectors = np.load(os.path.join(files, VECTORS_FILE), mmap_mode="r")
+        self.scales = None
+        if self.manifest.get("dtype") == "int8":
+            self.scales = np.load(os.path.join(files, SCALES_FILE), mmap_mode="r")
+        self.ids: List[str] = []
+        self.metadata: List[dict] = []
+        with open(os.path.join(files, METADATA_FILE)) as f:
+            for line in f:
+                record = json.loads(line)
+                self.ids.append(record["id"])
+                self.metadata.append(record.get("metadata") or {})
+        self.block_rows = block_rows
+        # Objective index -> (start, stop) rows; empty for a snapshot whose chunks aren't tagged
+        self.partitions: Dict[int, Tuple[int, int]] = {
+            int(objective): (start, stop) for objective, (start, stop) in self.manifest.get("partitions", {}).items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def dimension(self) -> int:
+        return self.vectors.shape[1]
+
+    # Same result shape as Pinecone's index.query: {'matches': [{'id', 'score', 'metadata'}]}
+    # Searches only the chunks tagged with `objectives` when given (none match in an untagged snapshot)
+    def query(self, vector: Sequence[float], top_k: int = 5, include_metadata: bool = True,
+              objectives: Optional[Sequence[int]] = None) -> dict:
+        return self.query_batch([vector], top_k=top_k, include_metadata=include_metadata, objectives=objectives)[0]
+
+    def query_batch(self, vectors: Iterable[Sequence[float]], top_k: int = 5, include_metadata: bool = True,
+                    objectives: Optional[Sequence[int]] = None) -> List[dict]:
+        queries = _normalize(np.asarray(list(vectors), dtype=np.float32))
+        ranges = self._ranges(objectives)
+        top_k = min(top_k, sum(stop - start for start, stop in ranges))
+        if top_k <= 0:
+            return [{"matches": []} for _ in range(len(queries))]
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        for start, stop in self._blocks(ranges):
+            block = self.vectors[start:stop]
+            scores = queries @ block.T.astype(np.float32, copy=False)
+            if self.scales is not None:
+                scores *= self.scales[start:stop]
+            rows = np.broadcast_to(np.arange(start, stop), scores.shape)
+            best_scores = np.concatenate([best_scores, scores], axis=1)
+            best_rows = np.concatenate([best_rows, rows], axis=1)
+            if best_scores.shape[1] > top_k:
+                keep = np.argpartition(-best_scores, top_k - 1, axis=1)[:, :top_k]
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+        results = []
+        for scores, rows in zip(best_scores, best_rows):
+            order = np.argsort(-scores)
+            matches = []
+            for i in order:
+                match = {"id": self.ids[rows[i]], "score": float(scores[i])}
+                if include_metadata:
+                    match["metadata"] = self.metadata[rows[i]]
+                matches.append(match)
+            results.append({"matches": matches})
+        return results
+
+    def _ranges(self, objectives: Optional[Sequence[int]]) -> List[Tuple[int, int]]:
+        if objectives is None:
+            return [(0, len(self))]
+        return sorted(self.partitions[objective] for objective in set(objectives) if objective in self.partitions)
+
+    def _blocks(self, ranges: List[Tuple[int, int]]) -> Iterator[Tuple[int, int]]:
+        for start, stop in ranges:
+            for block_start in range(start, stop, self.block_rows):
+                yield block_start, min(stop, block_start + self.block_rows)
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+# Function to write a snapshot that LocalIndex can load. Chunks tagged with an
+# objective are stored grouped by it (untagged ones last) and the manifest
+# records where each objective's rows start and stop.
+# The files go to a new version subdirectory and the manifest is swapped in with
+# os.replace, so a process with the current files memory-mapped never sees them
+# truncated or reordered under it, and a reader always gets ids, metadata and
+# vectors of the same version.
+def write_snapshot(directory: str, ids: List[str], vectors: np.ndarray, metadata: List[dict],
+                   quantize: Optional[str] = None, extra_manifest: Optional[Dict] = None):
+    os.makedirs(directory, exist_ok=True)
+    previous = _current_version(directory)
+    version = f"{VERSION_PREFIX}{time.time_ns()}"
+    files = os.path.join(directory, version)
+    os.makedirs(files)
+    vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+    objectives = [meta.get("objective") for meta in metadata]
+    order = sorted(range(len(ids)), key=lambda row: (objectives[row] is None, objectives[row] or 0, row))
+    ids = [ids[row] for row in order]
+    metadata = [metadata[row] for row in order]
+    vectors = vectors[order] if len(order) else vectors
+    manifest = dict(extra_manifest or {})
+    manifest.pop("partitions", None)
+    manifest.update({"count": len(ids), "dimension": int(vectors.shape[1]) if len(ids) else 0})
+    partitions: Dict[str, List[int]] = {}
+    for row, meta in enumerate(metadata):
+        if meta.get("objective") is not None:
+            partitions.setdefault(str(int(meta["objective"])), [row, row])[1] = row + 1
+    if partitions:
+        manifest["partitions"] = partitions
+    if quantize == "int8":
+        # Symmetric per-row quantization: row ~= scale * int8_row
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        quantized = np.round(vectors / scales[:, None]).astype(np.int8)
+        np.save(os.path.join(files, VECTORS_FILE), quantized)
+        np.save(os.path.join(files, SCALES_FILE), scales.astype(np.float32))
+        manifest["dtype"] = "int8"
+    else:
+        np.save(os.path.join(files, VECTORS_FILE), vectors)
+        manifest["dtype"] = "float32"
+    with open(os.path.join(files, METADATA_FILE), "w") as f:
+        for vector_id, meta in zip(ids, metadata):
+            f.write(json.dumps({"id": vector_id, "metadata": meta}) + "\n")
+    manifest["version"] = version
+    staged = os.path.join(directory, MANIFEST_FILE + ".tmp")
+    with open(staged, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(staged, os.path.join(directory, MANIFEST_FILE))
+    _remove_versions(directory, keep={version, previous})
+
+
+# Function to get the version the manifest points at: "" for a snapshot written before
+# versions, None when there is no snapshot yet
+def _current_version(directory: str) -> Optional[str]:
+    try:
+        with open(os.path.join(directory, MANIFEST_FILE)) as f:
+            return json.load(f).get("version", "")
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+# Function to delete the files of older versions. The previous one is kept for readers
+# that read its manifest just before the swap; unlinking files other processes have
+# mapped is safe, their pages stay valid until they let go.
+def _remove_versions(directory: str, keep: set):
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.startswith(VERSION_PREFIX) and name not in keep and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+    if "" not in keep:
+        for name in (VECTORS_FILE, SCALES_FILE, METADATA_FILE):
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+
+_local_index: Optional[LocalIndex] = None
+_local_index_lock = threading.Lock()
+
+
+# Function to get the process-wide local index, loading it on first use
+def get_local_index(directory: str = LOCAL_INDEX_DIR) -> LocalIndex:
+    global _local_index
+    if _local_index is None:
+        with _local_index_lock:
+            if _local_index is None:
+                _local_index = LocalIndex(directory)
+    return _local_index
@@ -0,0 +1,199 @@
+import json
+import logging
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional
+
+from config import (
+    DEBUG_LOG_HISTORY,
+    DEBUG_LOG_MAX_CHARS,
+    DEBUG_LOG_MAX_MESSAGES,
+    METRICS_HOST,
+    METRICS_PORT,
+    METRICS_SAMPLE_RATE,
+    METRICS_WINDOW,
+)
+
+logger = logging.getLogger("tutor")
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+# Latency samples for one stage: exact count and sum, percentiles over a sliding window
+class Histogram:
+    def __init__(self, window: int = METRICS_WINDOW):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def percentiles(self) -> Dict[float, float]:
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {q: 0.0 for q in QUANTILES}
+        return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in QUANTILES}
+
+    def quantile(self, q: float) -> float:
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+# In-process aggregation of chat-turn spans, counters and collected gauges
+class Metrics:
+    def __init__(self, sample_rate: float = METRICS_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self._histograms: Dict[str, Histogram] = {}
+        self._counters: Dict[tuple, float] = {}
+        self._collectors: Dict[str, Callable[[], dict]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            self._histograms.setdefault(stage, Histogram()).observe(seconds)
+
+    def incr(self, stage: str, attribute: str, value: float = 1):
+        with self._lock:
+            key = (stage, attribute)
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    # Function to get a recent latency percentile of a stage; None until it has min_samples samples
+    def quantile(self, stage: str, q: float, min_samples: int = 1) -> Optional[float]:
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None or len(histogram.samples) < min_samples:
+                return None
+            return histogram.quantile(q)
+
+    # Register a callable returning numeric stats (e.g. a cache's stats()) to include in exports
+    def register_collector(self, name: str, collect: Callable[[], dict]):
+        self._collectors[name] = collect
+
+    @contextmanager
+    def span(self, stage: str, **attributes):
+        start = time.perf_counter()
+        try:
+            yield attributes
+        except Exception:
+            self.incr(stage, "errors")
+            raise
+        finally:
+            self.record(stage, time.perf_counter() - start, **attributes)
+
+    # Function to record a finished span: its duration (sampled) and its numeric attributes (always)
+    def record(self, stage: str, seconds: float, **attributes):
+        if self.sample_rate >= 1 or random.random() < self.sample_rate:
+            self.observe(stage, seconds)
+        self.incr(stage, "count")
+        for name, value in attributes.items():
+            if isinstance(value, bool):
+                value = int(value)
+            if isinstance(value, (int, float)):
+                self.incr(stage, name, value)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            stages = {
+                stage: {
+                    "count": histogram.count,
+                    "sum": histogram.total,
+                    **{f"p{int(q * 100)}": value for q, value in histogram.percentiles().items()},
+                }
+                for stage, histogram in self._histograms.items()
+            }
+            counters: Dict[str, dict] = {}
+            for (stage, attribute), value in self._counters.items():
+                counters.setdefault(stage, {})[attribute] = value
+        collected = {}
+        for name, collect in list(self._collectors.items()):
+            try:
+                collected[name] = collect()
+            except Exception as e:
+                collected[name] = {"error": str(e)}
+        return {"stages": stages, "counters": counters, "collected": collected}
+
+    def render_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True, default=str)
+
+    def render_prometheus(self) -> str:
+        snapshot = self.snapshot()
+        lines = ["# TYPE tutor_stage_seconds summary"]
+        for stage, stats in sorted(snapshot["stages"].items()):
+            for q in QUANTILES:
+                lines.append(f'tutor_stage_seconds{{stage="{stage}",quantile="{q}"}} {stats[f"p{int(q * 100)}"]:.6f}')
+            lines.append(f'tutor_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+            lines.append(f'tutor_stage_seconds_sum{{stage="{stage}"}} {stats["sum"]:.6f}')
+        lines.append("# TYPE tutor_stage_total counter")
+        for stage, attributes in sorted(snapshot["counters"].items()):
+            for attribute, value in sorted(attributes.items()):
+                lines.append(f'tutor_stage_total{{stage="{stage}",attribute="{attribute}"}} {value}')
+        lines.append("# TYPE tutor_component gauge")
+        for name, stats in sorted(snapshot["collected"].items()):
+            for stat, value in sorted(stats.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f'tutor_component{{component="{name}",stat="{stat}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = metrics.render_prometheus(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = metrics.render_json(), "application/json"
+        else:
+            self.send_error(404)
+            return
+        payload = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server: Optional[ThreadingHTTPServer] = None
+_server_lock = threading.Lock()
+
+
+# Function to serve the metrics endpoint from a daemon thread, once per process
+def start_metrics_server(port: Optional[int] = METRICS_PORT, host: str = METRICS_HOST) -> Optional[ThreadingHTTPServer]:
+    global _server
+    if port is None:
+        return None
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            except OSError as e:  # e.g. another worker process already owns the port
+                logger.warning("Metrics endpoint not started on %s:%s: %s", host, port, e)
+                return None
+            threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    return _server
+
+
+# Function to log a bounded view of the chat history, only when DEBUG_LOG_HISTORY is on
+def log_history(label: str, chat_history: List[dict]):
+    if not DEBUG_LOG_HISTORY or not logger.isEnabledFor(logging.DEBUG):
+        return
+    recent = chat_history[-DEBUG_LOG_MAX_MESSAGES:]
+    summary = []
+    for msg in recent:
+        content = msg["content"]
+        if isinstance(content, list):
+            content = " ".join(part.get("text", "[image]") for part in content)
+        summary.append(f"{msg['role']}: {content[:DEBUG_LOG_MAX_CHARS]}")
+    logger.debug("%s (%d messages, last %d): %s", label, len(chat_history), len(recent), summary)
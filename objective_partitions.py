@@ -0,0 +1,68 @@
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from clients import get_openai_client
+from config import (
+    EMBEDDING_MODEL,
+    LEARNING_OBJECTIVES,
+    OBJECTIVE_PARTITIONS_ENABLED,
+    OBJECTIVE_WIDEN_RADIUS,
+    TUTOR_OBJECTIVE_MESSAGES,
+)
+from governor import governor
+
+
+# Function to build the Pinecone metadata filter for chunks tagged with any of `objectives`
+def objective_filter(objectives: Sequence[int]) -> dict:
+    if len(objectives) == 1:
+        return {"objective": {"$eq": objectives[0]}}
+    return {"objective": {"$in": list(objectives)}}
+
+
+# Function to list the objectives within `radius` of the current one, nearest first, without it
+def neighbor_objectives(current_objective: int, radius: int = OBJECTIVE_WIDEN_RADIUS) -> List[int]:
+    neighbors = []
+    for distance in range(1, radius + 1):
+        for objective in (current_objective - distance, current_objective + distance):
+            if 0 <= objective < len(LEARNING_OBJECTIVES):
+                neighbors.append(objective)
+    return neighbors
+
+
+# Function to get every objective a turn on current_objective may search: its own and its neighbours'
+def search_objectives(current_objective: Optional[int]) -> Optional[List[int]]:
+    if not OBJECTIVE_PARTITIONS_ENABLED or current_objective is None or not 0 <= current_objective < len(LEARNING_OBJECTIVES):
+        return None
+    return [current_objective] + neighbor_objectives(current_objective)
+
+
+# Function to describe an objective for tagging: its title and what the tutor teaches in it
+def objective_description(objective: int) -> str:
+    return f"{LEARNING_OBJECTIVES[objective]}. {TUTOR_OBJECTIVE_MESSAGES.get(objective, '')}".strip()
+
+
+# Function to embed every objective's description, one row per entry of LEARNING_OBJECTIVES
+def objective_embeddings(openai_api_key: str) -> np.ndarray:
+    client = get_openai_client(openai_api_key)
+    response = governor.call("embedding", openai_api_key, client.embeddings.create, model=EMBEDDING_MODEL,
+                             input=[objective_description(objective) for objective in range(len(LEARNING_OBJECTIVES))])
+    return np.asarray([item.embedding for item in sorted(response.data, key=lambda item: item.index)], dtype=np.float32)
+
+
+# Function to tag chunks with the objective whose description they are closest to. Returns
+# the objective of each row and its margin over the runner-up (small margins are ambiguous).
+def assign_objectives(vectors: np.ndarray, objectives: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if not len(vectors):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    scores = _unit(vectors) @ _unit(objectives).T
+    best = np.argmax(scores, axis=1)
+    top_two = -np.partition(-scores, 1, axis=1)[:, :2] if scores.shape[1] > 1 else np.repeat(scores, 2, axis=1)
+    return best, top_two[:, 0] - top_two[:, 1]
+
+
+def _unit(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
@@ -0,0 +1,72 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from config import LEARNING_OBJECTIVES, PREFETCH_WORKERS
+from governor import carry_session
+from metrics import logger
+from tutor import CompletionDetector, generate_ai_response, get_hidden_context, hidden_message_for, stream_until_complete
+
+_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+
+
+# A background run of the hidden-message turn for one objective. The text is
+# buffered as it streams in so a click before it finishes can still show progress.
+class PrefetchHandle:
+    def __init__(self, objective_index: int):
+        self.objective_index = objective_index
+        self.hidden_message = hidden_message_for(LEARNING_OBJECTIVES[objective_index - 1])
+        self.text = ""
+        self.references = []
+        self.error = None
+        self._cancelled = threading.Event()
+        self.future = None
+
+    def cancel(self):
+        self._cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def done(self) -> bool:
+        return self.future is not None and self.future.done()
+
+    # Function to wait for the prefetched turn; None if it failed or was cancelled
+    def result(self, timeout: Optional[float] = None) -> Optional[dict]:
+        if self.future is None or self.future.cancelled():
+            return None
+        self.future.result(timeout=timeout)
+        if self.error is not None or self.cancelled:
+            return None
+        return {"hidden_message": self.hidden_message, "content": self.text, "references": self.references}
+
+    def _run(self, openai_api_key: str, pinecone_api_key: str):
+        try:
+            _, self.references = get_hidden_context(self.hidden_message, openai_api_key, pinecone_api_key, self.objective_index)
+            if self.cancelled:
+                return
+            chat_history = [{"role": "user", "content": self.hidden_message, "hidden": True}]
+            response = generate_ai_response(self.hidden_message, self.references, openai_api_key, chat_history, self.objective_index)
+            if isinstance(response, str):  # Error occurred
+                self.error = response
+                return
+            stream = stream_until_complete(response, CompletionDetector())
+            for delta in stream:
+                if self.cancelled:
+                    stream.close()
+                    response.close()  # Free the connection instead of draining the stream
+                    return
+                self.text += delta
+        except Exception as e:
+            self.error = f"An error occurred: {str(e)}"
+            logger.warning("Error prefetching objective %s: %s", self.objective_index, e)
+
+
+# Function to start preparing the introduction to an objective in the background
+def start_prefetch(objective_index: int, openai_api_key: str, pinecone_api_key: str) -> PrefetchHandle:
+    handle = PrefetchHandle(objective_index)
+    handle.future = _executor.submit(carry_session(handle._run), openai_api_key, pinecone_api_key)
+    return handle
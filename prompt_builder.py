@@ -0,0 +1,194 @@
+import re
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+from config import (
+    MODEL_CHAT,
+    OBJECTIVE_COMPLETED_MARKER,
+    PROMPT_CONTEXT_TOKENS,
+    PROMPT_DEDUP_SIMILARITY,
+    PROMPT_HISTORY_MAX_MESSAGES,
+    PROMPT_HISTORY_TOKENS,
+    PROMPT_IMAGE_TOKENS,
+    PROMPT_SUMMARY_TOKENS,
+    SYSTEM_MESSAGE_CONTEXT,
+    get_system_prefix_tutor,
+)
+from metrics import logger
+
+# Per-message framing tokens added by the chat format
+_MESSAGE_OVERHEAD = 4
+# Shortest run of words treated as the overlap between two consecutive transcript chunks
+_MIN_OVERLAP_WORDS = 8
+_IMAGE_PLACEHOLDER = "[The student attached an image here]"
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    try:
+        import tiktoken
+        return tiktoken.encoding_for_model(MODEL_CHAT)
+    except Exception as e:  # Not installed, or the encoding could not be loaded
+        logger.warning("tiktoken unavailable, estimating token counts: %s", e)
+        return None
+
+
+# Function to count the tokens in a piece of text
+def count_tokens(text: str) -> int:
+    encoding = _encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def message_tokens(message: dict) -> int:
+    content = message["content"]
+    if isinstance(content, list):
+        tokens = 0
+        for part in content:
+            if part.get("type") == "image_url":
+                tokens += PROMPT_IMAGE_TOKENS
+            else:
+                tokens += count_tokens(part.get("text", ""))
+    else:
+        tokens = count_tokens(content or "")
+    return tokens + _MESSAGE_OVERHEAD
+
+
+def _shingles(text: str, size: int = 5) -> set:
+    words = re.findall(r"\w+", text.lower())
+    return {tuple(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+
+
+# Join two chunks that overlap end-to-start (consecutive transcript windows)
+def _merge_overlap(first: str, second: str) -> Optional[str]:
+    a, b = first.split(), second.split()
+    for size in range(min(len(a), len(b)) - 1, _MIN_OVERLAP_WORDS - 1, -1):
+        if a[-size:] == b[:size]:
+            return " ".join(a + b[size:])
+    return None
+
+
+# Function to drop near-duplicate references and merge overlapping ones, best score first
+def dedup_chunks(references: List[dict]) -> Tuple[List[dict], int]:
+    kept: List[dict] = []
+    dropped = 0
+    for ref in sorted(references, key=lambda ref: ref['score'], reverse=True):
+        text = ref['text']
+        shingles = _shingles(text)
+        duplicate = False
+        for chunk in kept:
+            overlap = len(shingles & chunk['shingles']) / max(1, min(len(shingles), len(chunk['shingles'])))
+            if overlap >= PROMPT_DEDUP_SIMILARITY:
+                duplicate = True
+                break
+            merged = _merge_overlap(chunk['text'], text) or _merge_overlap(text, chunk['text'])
+            if merged is not None:
+                chunk['text'] = merged
+                chunk['shingles'] = _shingles(merged)
+                duplicate = True
+                break
+        if duplicate:
+            dropped += 1
+        else:
+            kept.append({'text': text, 'score': ref['score'], 'shingles': shingles})
+    return [{'text': chunk['text'], 'score': chunk['score']} for chunk in kept], dropped
+
+
+# Only role and content go to the API; images are kept on the newest message only
+def _sanitize(message: dict, keep_images: bool) -> dict:
+    content = message["content"]
+    if isinstance(content, list) and not keep_images:
+        parts = [part.get("text", "") if part.get("type") != "image_url" else _IMAGE_PLACEHOLDER for part in content]
+        content = "\n".join(part for part in parts if part)
+    return {"role": message["role"], "content": content}
+
+
+def _summary_line(message: dict) -> Optional[str]:
+    content = message["content"]
+    if isinstance(content, list):
+        content = " ".join(part.get("text", "") for part in content if part.get("type") == "text")
+    text = " ".join(content.replace(OBJECTIVE_COMPLETED_MARKER, "").split())
+    if not text or message.get("hidden", False):
+        return None
+    if message["role"] == "user":
+        return "Student: " + " ".join(text.split()[:25])
+    first_sentence = re.split(r"(?<=[.!?])\s", text, maxsplit=1)[0]
+    return "Tutor: " + " ".join(first_sentence.split()[:30])
+
+
+# Function to assemble the tutor prompt within the configured token budgets.
+# summary_state persists between turns of one conversation (e.g. in session state)
+# so turns that slide out of the history window are summarized once, incrementally.
+def build_tutor_prompt(current_objective: int, references: List[dict], chat_history: List[dict],
+                       summary_state: Optional[dict] = None) -> Tuple[List[dict], dict]:
+    if summary_state is None:
+        summary_state = {}
+    anchor = chat_history[0] if chat_history else None
+    if ("covered" not in summary_state or summary_state["anchor"] is not anchor
+            or summary_state["covered"] > len(chat_history)):
+        summary_state.clear()
+        summary_state.update({"anchor": anchor, "covered": 0, "lines": []})
+
+    # References: dedup, then pack the best ones into the budget
+    chunks, dropped_chunks = dedup_chunks(references)
+    context_parts, context_tokens = [], 0
+    for chunk in chunks:
+        tokens = count_tokens(chunk['text'])
+        if context_tokens + tokens > PROMPT_CONTEXT_TOKENS:
+            dropped_chunks += 1
+            continue
+        context_parts.append(chunk['text'])
+        context_tokens += tokens
+
+    # History: newest turns first, never re-including turns already summarized
+    window: List[dict] = []
+    history_tokens = 0
+    window_start = len(chat_history)
+    for i in range(len(chat_history) - 1, summary_state["covered"] - 1, -1):
+        message = _sanitize(chat_history[i], keep_images=not window)
+        tokens = message_tokens(message)
+        if window and (history_tokens + tokens > PROMPT_HISTORY_TOKENS or len(window) >= PROMPT_HISTORY_MAX_MESSAGES):
+            break
+        window.insert(0, message)
+        history_tokens += tokens
+        window_start = i
+
+    # Turns that just left the window join the running summary
+    for message in chat_history[summary_state["covered"]:window_start]:
+        line = _summary_line(message)
+        if line:
+            summary_state["lines"].append(line)
+    summary_state["covered"] = max(summary_state["covered"], window_start)
+    while summary_state["lines"] and count_tokens("\n".join(summary_state["lines"])) > PROMPT_SUMMARY_TOKENS:
+        summary_state["lines"].pop(0)
+
+    # Static prefix first so it stays byte-identical across turns; per-turn references go last
+    system_prefix = get_system_prefix_tutor(current_objective)
+    messages = [{"role": "system", "content": system_prefix}]
+    summary_tokens = 0
+    if summary_state["lines"]:
+        summary = "Summary of the earlier conversation:\n" + "\n".join(summary_state["lines"])
+        messages.append({"role": "system", "content": summary})
+        summary_tokens = count_tokens(summary) + _MESSAGE_OVERHEAD
+    messages.extend(window[:-1])
+    context_message_tokens = 0
+    if context_parts:
+        context_message = SYSTEM_MESSAGE_CONTEXT.format(context="\n\n".join(context_parts))
+        messages.append({"role": "system", "content": context_message})
+        context_message_tokens = count_tokens(context_message) + _MESSAGE_OVERHEAD
+    messages.extend(window[-1:])
+
+    system_tokens = count_tokens(system_prefix) + _MESSAGE_OVERHEAD
+    report = {
+        "system_tokens": system_tokens,
+        "summary_tokens": summary_tokens,
+        "history_tokens": history_tokens,
+        "context_tokens": context_message_tokens,
+        "total_tokens": system_tokens + summary_tokens + history_tokens + context_message_tokens,
+        "history_messages": len(window),
+        "summarized_messages": summary_state["covered"],
+        "context_chunks": len(context_parts),
+        "dropped_chunks": dropped_chunks,
+    }
+    return messages, report
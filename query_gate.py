@@ -0,0 +1,78 @@
+import re
+import threading
+from typing import List, Optional
+
+from config import REWRITE_GATE_MIN_WORDS, REWRITE_GATE_NEW_TOPIC_SIMILARITY
+from metrics import metrics
+
+# Words that only make sense with the earlier conversation in view
+_ANAPHORA = re.compile(
+    r"\b(it|its|it's|this|that|these|those|they|them|their|he|she|him|her|one|ones|"
+    r"above|previous|earlier|again|same|instead|another|else)\b",
+    re.IGNORECASE,
+)
+# Openers that continue the previous turn rather than ask something new
+_FOLLOW_UP = re.compile(
+    r"^\s*(and|but|so|or|also|then|ok|okay|yes|yeah|yep|no|nope|sure|why|how come|"
+    r"what about|how about|what if|can you|could you)\b",
+    re.IGNORECASE,
+)
+
+
+def message_text(content) -> str:
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if part.get("type") == "text")
+    return content or ""
+
+
+# Cheap local check for whether a message needs the LLM standalone-question
+# rewrite before it can be searched. Counters show how often it was skipped.
+class RewriteGate:
+    REASONS = ("no_history", "self_contained", "new_topic", "rewritten")
+
+    def __init__(self, min_words: int = REWRITE_GATE_MIN_WORDS, new_topic_similarity: float = REWRITE_GATE_NEW_TOPIC_SIMILARITY):
+        self.min_words = min_words
+        self.new_topic_similarity = new_topic_similarity
+        self.counts = {reason: 0 for reason in self.REASONS}
+        self._lock = threading.Lock()
+
+    # chat_history ends with the message being asked about; last_turn_similarity is the
+    # optional cosine similarity between this message and the previous user turn
+    def needs_rewrite(self, user_message: str, chat_history: List[dict], last_turn_similarity: Optional[float] = None) -> bool:
+        reason = self._decide(user_message, chat_history, last_turn_similarity)
+        with self._lock:
+            self.counts[reason] += 1
+        return reason == "rewritten"
+
+    def _decide(self, user_message, chat_history, last_turn_similarity) -> str:
+        # Indexed access stops at the first match, so a long stored history is not read back
+        if not any(chat_history[i].get("role") in ("user", "assistant") for i in range(len(chat_history) - 1)):
+            return "no_history"
+        if _ANAPHORA.search(user_message) or _FOLLOW_UP.search(user_message):
+            return "rewritten"
+        if len(user_message.split()) >= self.min_words:
+            return "self_contained"
+        # A short message with no references back: only rewrite it if it stays on the last turn's topic
+        if last_turn_similarity is not None and last_turn_similarity < self.new_topic_similarity:
+            return "new_topic"
+        return "rewritten"
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = dict(self.counts)
+        total = sum(counts.values())
+        counts["skip_rate"] = (total - counts["rewritten"]) / total if total else 0.0
+        return counts
+
+
+# Function to find the text of the last user turn before the current message
+def last_user_text(chat_history: List[dict]) -> Optional[str]:
+    for i in range(len(chat_history) - 2, -1, -1):
+        msg = chat_history[i]
+        if msg.get("role") == "user":
+            return message_text(msg.get("content"))
+    return None
+
+
+rewrite_gate = RewriteGate()
+metrics.register_collector("rewrite_gate", rewrite_gate.stats)
@@ -0,0 +1,93 @@
+import re
+from typing import Dict, List, Optional, Sequence
+
+from config import (
+    HYBRID_OBJECTIVE_BOOST,
+    HYBRID_RRF_K,
+    HYBRID_TOP_K,
+    LEARNING_OBJECTIVES,
+)
+from lexical_index import tokenize
+
+# Weights of the rerank features; each feature is in [0, 1]
+_WEIGHTS = {
+    "fusion": 0.35,  # Reciprocal-rank fusion of the vector and lexical lists
+    "dense": 0.25,  # Vector similarity, when the chunk came back from the vector search
+    "coverage": 0.25,  # Share of the query's terms the chunk contains
+    "code": 0.15,  # Code tokens from the question (`append`, `range()`, an error name) found verbatim
+}
+# Code-looking tokens: calls, dotted names, snake_case and CamelCase words such as error names
+_CODE_TOKEN = re.compile(r"\b[A-Za-z_][A-Za-z0-9_]*\(\)|\b\w+\.\w+\b|\b[a-z]+_[a-z_]+\b|\b[A-Z][a-z]+(?:[A-Z][a-z]+)+\b|`([^`]+)`")
+
+
+def _key(match: dict) -> str:
+    return match.get("id") or match["metadata"]["text"]
+
+
+# Function to fuse ranked result lists: each list adds 1 / (k + rank) for every match it has
+def reciprocal_rank_fusion(*result_sets, k: int = HYBRID_RRF_K) -> Dict[str, float]:
+    fused: Dict[str, float] = {}
+    for results in result_sets:
+        for rank, match in enumerate(results["matches"], 1):
+            fused[_key(match)] = fused.get(_key(match), 0.0) + 1.0 / (k + rank)
+    return fused
+
+
+def code_tokens(text: str) -> List[str]:
+    tokens = []
+    for match in _CODE_TOKEN.finditer(text):
+        token = (match.group(1) or match.group(0)).strip().lower()
+        tokens.append(token[:-2] if token.endswith("()") else token)
+    return tokens
+
+
+def _objective_prior(metadata: dict, current_objective: Optional[int], objective_terms: set) -> float:
+    if current_objective is None:
+        return 0.0
+    if "objective" in metadata:
+        return 1.0 if metadata["objective"] == current_objective else 0.0
+    # Chunks not tagged with an objective: how much of the objective's wording they share
+    if not objective_terms:
+        return 0.0
+    return len(objective_terms & set(tokenize(metadata.get("text", "")))) / len(objective_terms)
+
+
+# Function to fuse vector and lexical candidates and keep the best few. The local
+# reranker scores each candidate on rank fusion, dense similarity, query-term
+# coverage and verbatim code tokens, plus a boost for the current objective.
+def hybrid_rerank(queries: Sequence[str], vector_results: dict, lexical_results: Optional[dict] = None,
+                  current_objective: Optional[int] = None, top_k: int = HYBRID_TOP_K) -> dict:
+    result_sets = [vector_results] + ([lexical_results] if lexical_results is not None else [])
+    fused = reciprocal_rank_fusion(*result_sets)
+    best_fusion = max(fused.values(), default=0.0) or 1.0
+    dense = {_key(match): match["score"] for match in vector_results["matches"]}
+    candidates = {}
+    for results in result_sets:
+        for match in results["matches"]:
+            candidates.setdefault(_key(match), match)
+
+    query_terms = set()
+    query_code = set()
+    for query in queries:
+        query_terms.update(tokenize(query))
+        query_code.update(code_tokens(query))
+    objective_terms = set()
+    if current_objective is not None and 0 <= current_objective < len(LEARNING_OBJECTIVES):
+        objective_terms = set(tokenize(LEARNING_OBJECTIVES[current_objective]))
+
+    scored = []
+    for key, match in candidates.items():
+        text = match["metadata"].get("text", "")
+        chunk_terms = set(tokenize(text))
+        lowered = text.lower()
+        features = {
+            "fusion": fused[key] / best_fusion,
+            "dense": max(0.0, dense.get(key, 0.0)),
+            "coverage": len(query_terms & chunk_terms) / len(query_terms) if query_terms else 0.0,
+            "code": sum(1 for token in query_code if token in lowered) / len(query_code) if query_code else 0.0,
+        }
+        score = sum(_WEIGHTS[name] * value for name, value in features.items())
+        score += HYBRID_OBJECTIVE_BOOST * _objective_prior(match["metadata"], current_objective, objective_terms)
+        scored.append({**match, "score": score})
+    scored.sort(key=lambda match: match["score"], reverse=True)
+    return {"matches": scored[:top_k]}
@@ -0,0 +1,355 @@
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from clients import _fingerprint, get_openai_client, get_pinecone_index
+from config import (
+    EMBEDDING_MODEL,
+    FALLBACK_CACHE_SIZE,
+    FALLBACK_CONTEXT_ENABLED,
+    HEDGE_ENABLED,
+    HYBRID_CANDIDATES,
+    HYBRID_ENABLED,
+    LEARNING_OBJECTIVES,
+    MODEL_QUERY_GENERATION,
+    OBJECTIVE_RECHECK_INTERVAL,
+    OBJECTIVE_WIDEN_SCORE,
+    PINECONE_NAMESPACE,
+    RETRIEVAL_BACKEND,
+    RETRIEVAL_REUSE_SIMILARITY,
+    RETRIEVAL_REWRITE_TIMEOUT,
+    RETRIEVAL_SEARCH_TIMEOUT,
+    RETRIEVAL_TOP_K,
+    RETRIEVAL_WORKERS,
+    SYSTEM_MESSAGE_QUERY_GENERATION,
+    TURN_RETRIEVAL_BUDGET,
+    TURN_REWRITE_SHARE,
+)
+from deadlines import Deadline, DeadlineExceeded, hedged
+from embedding_cache import embedding_cache
+from governor import carry_session, current_session, governor
+from lexical_index import get_lexical_index
+from local_index import get_local_index
+from metrics import log_history, logger, metrics
+from objective_partitions import neighbor_objectives, objective_filter, search_objectives
+from query_gate import last_user_text, rewrite_gate
+from reranker import hybrid_rerank
+
+# Shared by every session in the process; stages of one turn run side by side here
+_executor = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix="retrieval")
+
+# With hybrid retrieval the vector search returns a wider candidate list for the reranker
+_CANDIDATES = HYBRID_CANDIDATES if HYBRID_ENABLED else RETRIEVAL_TOP_K
+
+# Last results retrieved in time by each session on each objective, the first fallback when a
+# later turn of that session fails. Results answer one student's questions, so never another's.
+_last_good: "OrderedDict[Tuple[str, Optional[int]], dict]" = OrderedDict()
+_last_good_lock = threading.Lock()
+
+# Objectives found with no tagged chunks nearby (e.g. in an index not tagged yet) and when; their turns
+# search the whole namespace until OBJECTIVE_RECHECK_INTERVAL has passed, so a later tagging run is picked up
+_unpartitioned: Dict[int, float] = {}
+_unpartitioned_lock = threading.Lock()
+
+
+# Function to get the timeout of one provider request: what is left of the turn's share, at
+# most cap. Without one the SDKs wait up to ten minutes, holding a retrieval thread long
+# after the turn has moved on.
+def request_timeout(deadline: Optional[Deadline], cap: float = RETRIEVAL_SEARCH_TIMEOUT, share: float = 1.0) -> float:
+    if deadline is None:
+        return cap
+    if deadline.expired:
+        raise DeadlineExceeded("The turn's retrieval budget is spent")
+    return deadline.allow(share, cap)
+
+
+# Function to generate embeddings using OpenAI (served from the embedding cache when possible)
+def generate_embedding(text: str, api_key: str, deadline: Optional[Deadline] = None) -> List[float]:
+    with metrics.span("embed") as span:
+        embedding = embedding_cache.get(text, EMBEDDING_MODEL)
+        span["cache_hits"] = int(embedding is not None)
+        if embedding is None:
+            client = get_openai_client(api_key)
+            timeout = request_timeout(deadline)
+            # Sessions embedding the same text with the same key at the same time share one request
+            response = governor.coalesce("embedding", (_fingerprint(api_key), EMBEDDING_MODEL, text), lambda: governor.call(
+                "embedding", api_key, client.embeddings.create,
+                model=EMBEDDING_MODEL,
+                input=text,
+                timeout=timeout,
+            ), timeout)
+            embedding = response.data[0].embedding
+            span["prompt_tokens"] = response.usage.prompt_tokens
+            embedding_cache.put(text, EMBEDDING_MODEL, embedding)
+        return embedding
+
+
+# Function to rephrase the latest message as a standalone question
+def rewrite_query(chat_history: List[dict], api_key: str, deadline: Optional[Deadline] = None) -> str:
+    client = get_openai_client(api_key)
+    messages = [{"role": "system", "content": SYSTEM_MESSAGE_QUERY_GENERATION}]
+    for msg in chat_history[-5:]:  # Include last 5 messages for context
+        messages.append(msg)
+    timeout = request_timeout(deadline, RETRIEVAL_REWRITE_TIMEOUT, TURN_REWRITE_SHARE)
+    with metrics.span("rewrite") as span:
+        response = governor.coalesce("rewrite", (_fingerprint(api_key), _rewrite_key(messages)), lambda: governor.call(
+            "rewrite", api_key, client.chat.completions.create,
+            model=MODEL_QUERY_GENERATION,
+            messages=messages,
+            max_tokens=100,
+            n=1,
+            temperature=0.7,
+            timeout=timeout,
+        ), timeout)
+        span["prompt_tokens"] = response.usage.prompt_tokens
+        span["completion_tokens"] = response.usage.completion_tokens
+    return response.choices[0].message.content
+
+
+def _rewrite_key(messages: List[dict]) -> str:
+    return json.dumps(messages, sort_keys=True, default=str)
+
+
+# Function to run a vector query against the configured backend, optionally only over chunks tagged with `objectives`
+def query_index(query_embedding: Sequence[float], pinecone_api_key: str, top_k: int = RETRIEVAL_TOP_K,
+                objectives: Optional[Sequence[int]] = None, deadline: Optional[Deadline] = None, share: float = 1.0):
+    with metrics.span("vector_query"):
+        if RETRIEVAL_BACKEND == "local":
+            try:
+                return get_local_index().query(query_embedding, top_k=top_k, include_metadata=True, objectives=objectives)
+            except FileNotFoundError as e:
+                logger.warning("Local index not available, falling back to Pinecone: %s", e)
+        index = get_pinecone_index(pinecone_api_key)
+        timeout = request_timeout(deadline, share=share)
+        params = {"vector": query_embedding, "top_k": top_k, "namespace": PINECONE_NAMESPACE, "include_metadata": True,
+                  "_request_timeout": timeout}
+        if objectives is not None:
+            params["filter"] = objective_filter(objectives)
+        if HEDGE_ENABLED:
+            # Queries are idempotent; a duplicate sent after a slow start trims the tail. Both share
+            # one governor slot and rate token, and the request timeout ends whichever one loses.
+            return governor.call("vector_query", pinecone_api_key, hedged, "vector_query", index.query, timeout=timeout, **params)
+        return governor.call("vector_query", pinecone_api_key, index.query, **params)
+
+
+# Function to search the current objective's chunks first. When its best match scores
+# below OBJECTIVE_WIDEN_SCORE the neighbouring objectives are searched too, and when it
+# has no chunks at all (an index that isn't tagged yet) the whole namespace is. These
+# queries run one after another, so each may take only half of what is left of the
+# deadline while another one could still follow it.
+def query_objective(query_embedding: Sequence[float], pinecone_api_key: str, current_objective: Optional[int],
+                    top_k: int = RETRIEVAL_TOP_K, deadline: Optional[Deadline] = None):
+    if search_objectives(current_objective) is None or _is_unpartitioned(current_objective):
+        return query_index(query_embedding, pinecone_api_key, top_k=top_k, deadline=deadline)
+    results = query_index(query_embedding, pinecone_api_key, top_k=top_k, objectives=[current_objective], deadline=deadline, share=0.5)
+    if results["matches"] and results["matches"][0]["score"] >= OBJECTIVE_WIDEN_SCORE:
+        return results
+    neighbors = neighbor_objectives(current_objective)
+    if neighbors:
+        metrics.incr("vector_query", "widened")
+        results = merge_results(results, query_index(query_embedding, pinecone_api_key, top_k=top_k, objectives=neighbors,
+                                                     deadline=deadline, share=1.0 if results["matches"] else 0.5), top_k=top_k)
+    if not results["matches"]:
+        metrics.incr("vector_query", "unpartitioned")
+        with _unpartitioned_lock:
+            _unpartitioned[current_objective] = time.monotonic()
+        results = query_index(query_embedding, pinecone_api_key, top_k=top_k, deadline=deadline)
+    return results
+
+
+def _is_unpartitioned(objective: int) -> bool:
+    with _unpartitioned_lock:
+        marked = _unpartitioned.get(objective)
+        if marked is None:
+            return False
+        if time.monotonic() - marked < OBJECTIVE_RECHECK_INTERVAL:
+            return True
+        del _unpartitioned[objective]
+        return False
+
+
+# Function to embed a query and search for it
+def search(text: str, openai_api_key: str, pinecone_api_key: str, current_objective: Optional[int] = None,
+           deadline: Optional[Deadline] = None):
+    query_embedding = generate_embedding(text, openai_api_key, deadline)
+    return query_embedding, query_objective(query_embedding, pinecone_api_key, current_objective, top_k=_CANDIDATES, deadline=deadline)
+
+
+# Function to run the BM25 search; None when there is no local snapshot to search
+def lexical_search(texts: List[str], top_k: int = HYBRID_CANDIDATES, objectives: Optional[Sequence[int]] = None) -> Optional[dict]:
+    with metrics.span("lexical_query"):
+        try:
+            return get_lexical_index().query(texts, top_k=top_k, objectives=objectives)
+        except FileNotFoundError:
+            return None
+
+
+# Function to turn query matches into the prompt context and the references shown to the student
+def build_context(results) -> Tuple[str, List[dict]]:
+    context = ""
+    references = []
+    for match in results['matches']:
+        context += match['metadata']['text'] + "\n\n"
+        reference = {
+            'text': match['metadata']['text'],
+            'score': match['score']
+        }
+        if match.get('id'):
+            reference['id'] = match['id']
+        if 'source' in match['metadata']:
+            reference['source'] = match['metadata']['source']
+        references.append(reference)
+    return context, references
+
+
+# Function to merge two result sets, keeping each chunk's best score
+def merge_results(*result_sets, top_k: int = RETRIEVAL_TOP_K) -> dict:
+    best = {}
+    for results in result_sets:
+        for match in results['matches']:
+            key = match.get('id') or match['metadata']['text']
+            if key not in best or match['score'] > best[key]['score']:
+                best[key] = match
+    matches = sorted(best.values(), key=lambda match: match['score'], reverse=True)
+    return {'matches': matches[:top_k]}
+
+
+def cosine_similarity(a: Sequence[float], b: Sequence[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+def _same_query(a: str, b: str) -> bool:
+    return " ".join(a.lower().split()).strip(" ?.!") == " ".join(b.lower().split()).strip(" ?.!")
+
+
+# Similarity to the previous user turn, only when both embeddings are already in memory
+def _last_turn_similarity(user_message: str, chat_history: List[dict]) -> Optional[float]:
+    last_text = last_user_text(chat_history)
+    if not last_text:
+        return None
+    message_embedding = embedding_cache.peek(user_message, EMBEDDING_MODEL)
+    last_embedding = embedding_cache.peek(last_text, EMBEDDING_MODEL)
+    if message_embedding is None or last_embedding is None:
+        return None
+    return cosine_similarity(message_embedding, last_embedding)
+
+
+# Wait for a stage until its deadline; a failed or late stage yields None and is listed in status["late"]
+def _wait(future, timeout: float, stage: str, status: Optional[dict] = None):
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        logger.warning("%s exceeded %.2fs, continuing without it", stage, timeout)
+    except Exception as e:
+        logger.warning("Error in %s: %s", stage, e)
+    if status is not None:
+        status["late"].append(stage)
+    return None
+
+
+# Search for the rewritten query unless it lands close enough to the speculative one
+def _search_rewritten(contextual_query: str, speculative, openai_api_key: str, pinecone_api_key: str,
+                      current_objective: Optional[int] = None, deadline: Optional[Deadline] = None):
+    query_embedding = generate_embedding(contextual_query, openai_api_key, deadline)
+    if speculative is not None:
+        speculative_embedding, speculative_results = speculative
+        if cosine_similarity(query_embedding, speculative_embedding) >= RETRIEVAL_REUSE_SIMILARITY:
+            return speculative_results
+    results = query_objective(query_embedding, pinecone_api_key, current_objective, top_k=_CANDIDATES, deadline=deadline)
+    if speculative is not None:
+        results = merge_results(results, speculative[1], top_k=_CANDIDATES)
+    return results
+
+
+# Function to get context when retrieval failed or ran out of time: this session's last good
+# results on the objective, else the chunks that best match the objective itself in the local snapshot
+def fallback_results(current_objective: Optional[int]) -> Tuple[Optional[dict], str]:
+    if not FALLBACK_CONTEXT_ENABLED:
+        return None, "none"
+    with _last_good_lock:
+        cached = _last_good.get((current_session(), current_objective)) if current_session() else None
+    if cached is not None:
+        return cached, "cached"
+    if current_objective is not None and 0 <= current_objective < len(LEARNING_OBJECTIVES):
+        objective = LEARNING_OBJECTIVES[current_objective]
+        lexical = lexical_search([objective], objectives=search_objectives(current_objective))
+        if lexical is not None and lexical["matches"]:
+            return hybrid_rerank([objective], {"matches": []}, lexical, current_objective), "objective"
+    return None, "none"
+
+
+# Function to get relevant context for a turn. The raw message is embedded and
+# searched speculatively while the standalone-question rewrite runs; the rewrite
+# is skipped entirely when the gate finds the message self-contained. All stages
+# share one TURN_RETRIEVAL_BUDGET; when it runs out, or retrieval fails, the turn
+# falls back to cached or objective-default context. status, when passed, gets
+# "degraded" (None, "cached", "objective" or "none") and the stages that were "late".
+# A caller that spent part of the turn already (e.g. on the answer cache) passes its deadline.
+def get_context(user_message: str, chat_history: List[dict], openai_api_key: str, pinecone_api_key: str, image_url=None,
+                current_objective: Optional[int] = None, status: Optional[dict] = None,
+                deadline: Optional[Deadline] = None) -> Tuple[str, List[dict]]:
+    status = {} if status is None else status
+    with metrics.span("retrieval") as span:
+        context, references, span["rewrites"] = _get_context(user_message, chat_history, openai_api_key, pinecone_api_key,
+                                                             current_objective, deadline or Deadline(TURN_RETRIEVAL_BUDGET), status)
+        span["references"] = len(references)
+        span["late_stages"] = len(status["late"])
+        if status["degraded"] is not None:
+            span[f"degraded_{status['degraded']}"] = 1
+    return context, references
+
+
+def _get_context(user_message: str, chat_history: List[dict], openai_api_key: str, pinecone_api_key: str,
+                 current_objective: Optional[int], deadline: Deadline, status: dict):
+    log_history("Retrieving context for chat history", chat_history)
+    status.update(degraded=None, late=[])
+    # Searches stay within the current objective and, at most, its neighbours
+    lexical_objectives = search_objectives(current_objective)
+    speculative_future = _executor.submit(carry_session(search), user_message, openai_api_key, pinecone_api_key, current_objective,
+                                          deadline)
+
+    contextual_query: Optional[str] = None
+    rewrites = 0
+    if rewrite_gate.needs_rewrite(user_message, chat_history, _last_turn_similarity(user_message, chat_history)):
+        rewrites = 1
+        rewrite_future = _executor.submit(carry_session(rewrite_query), chat_history, openai_api_key, deadline)
+        contextual_query = _wait(rewrite_future, deadline.allow(TURN_REWRITE_SHARE, RETRIEVAL_REWRITE_TIMEOUT), "query rewrite", status)
+        logger.debug("Contextual Query Response: %s", contextual_query)
+    # One BM25 search over every form of the question, alongside the vector searches
+    queries = [user_message] if contextual_query is None else [user_message, contextual_query]
+    lexical_future = _executor.submit(carry_session(lexical_search), queries, HYBRID_CANDIDATES, lexical_objectives) if HYBRID_ENABLED else None
+    speculative = _wait(speculative_future, deadline.allow(cap=RETRIEVAL_SEARCH_TIMEOUT), "speculative search", status)
+
+    if contextual_query is None or _same_query(contextual_query, user_message):
+        results = speculative[1] if speculative is not None else None
+    else:
+        rewritten_future = _executor.submit(carry_session(_search_rewritten), contextual_query, speculative, openai_api_key, pinecone_api_key,
+                                            current_objective, deadline)
+        results = _wait(rewritten_future, deadline.allow(cap=RETRIEVAL_SEARCH_TIMEOUT), "rewritten search", status)
+        if results is None and speculative is not None:
+            results = speculative[1]
+
+    if results is None:
+        results, status["degraded"] = fallback_results(current_objective)
+        if results is None:
+            return "", [], rewrites
+        context, references = build_context(results)
+        return context, references, rewrites
+    if HYBRID_ENABLED:
+        lexical = _wait(lexical_future, deadline.allow(cap=RETRIEVAL_SEARCH_TIMEOUT), "lexical search", status)
+        results = hybrid_rerank(queries, results, lexical, current_objective)
+    if results["matches"] and current_session():
+        key = (current_session(), current_objective)
+        with _last_good_lock:
+            _last_good[key] = results
+            _last_good.move_to_end(key)
+            while len(_last_good) > FALLBACK_CACHE_SIZE:
+                _last_good.popitem(last=False)
+    context, references = build_context(results)
+    return context, references, rewrites
@@ -0,0 +1,49 @@
+import hashlib
+import re
+import secrets
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+from config import SESSION_CLAIMS_MAX
+
+_TOKEN = re.compile(r"^[A-Za-z0-9_-]{32}$")
+
+# Which browser session holds each token, so one conversation is written by one tab
+_claims: Dict[str, str] = {}
+_claims_lock = threading.Lock()
+
+
+# Function to make a fresh token for the URL: random, and never the store key itself
+def new_token() -> str:
+    return secrets.token_urlsafe(24)
+
+
+# Function to derive the session id a token opens in the engine and the conversation store.
+# It is one-way, so the store key never appears in a URL and a leaked key opens nothing.
+def session_key(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()[:32]
+
+
+# Function to bind a token to one live browser session. A token that another open tab
+# already holds is refused, so a duplicated tab or a shared link starts a conversation
+# of its own instead of writing into that one; a reload is a new browser session whose
+# predecessor has gone, so it gets its conversation back.
+def claim(token: str, browser_session: str, is_active: Callable[[str], bool]) -> bool:
+    with _claims_lock:
+        holder = _claims.get(token)
+        if holder is not None and holder != browser_session and is_active(holder):
+            return False
+        _claims[token] = browser_session
+        if len(_claims) > SESSION_CLAIMS_MAX:
+            for stale in [t for t, holder in _claims.items() if t != token and not is_active(holder)]:
+                del _claims[stale]
+        return True
+
+
+# Function to get the (token, session id) of a browser session: the one in its URL when
+# that is well-formed and free, otherwise a new one
+def open_session(token: Optional[str], browser_session: str, is_active: Callable[[str], bool]) -> Tuple[str, str]:
+    if not token or not _TOKEN.match(token) or not claim(token, browser_session, is_active):
+        token = new_token()
+        claim(token, browser_session, is_active)
+    return token, session_key(token)
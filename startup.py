@@ -0,0 +1,31 @@
+import os
+import threading
+import time
+
+import streamlit as st
+
+from metrics import logger, metrics, start_metrics_server
+
+
+# Function to initialize everything the app needs once per process. Streamlit
+# re-executes the script on every interaction; cache_resource runs this body only
+# on the first run in the process, and later runs get the cached result back.
+@st.cache_resource(show_spinner=False)
+def startup(agentops_api_key: str = "") -> dict:
+    started = time.perf_counter()
+    start_metrics_server()
+    # agentops is slow to import; sessions can start while it loads
+    telemetry = None
+    if agentops_api_key or os.environ.get("AGENTOPS_API_KEY"):  # agentops falls back to the environment
+        telemetry = threading.Thread(target=_init_agentops, args=(agentops_api_key,), name="agentops-init", daemon=True)
+        telemetry.start()
+    metrics.record("startup", time.perf_counter() - started)
+    return {"started_at": time.time(), "telemetry": telemetry}
+
+
+def _init_agentops(api_key: str):
+    try:
+        import agentops
+        agentops.init(api_key or None)
+    except Exception as e:
+        logger.warning("Error initializing agentops: %s", e)
@@ -0,0 +1,93 @@
+import time
+from typing import Optional
+
+from config import STREAM_CURSOR, STREAM_RENDER_FPS
+
+_FENCE = "```"
+
+
+# Offset just past the last blank line that is not inside a code fence, i.e. the
+# end of the last finished markdown block in text (0 if there is none yet)
+def _finished_blocks_end(text: str) -> int:
+    in_fence = False
+    end = 0
+    offset = 0
+    for line in text.splitlines(keepends=True):
+        offset += len(line)
+        if line.lstrip().startswith(_FENCE):
+            in_fence = not in_fence
+        elif not in_fence and not line.strip() and line.endswith("\n"):
+            end = offset
+    return end
+
+
+# Renders a streamed answer into a Streamlit placeholder. Deltas are buffered and
+# the in-progress block is re-rendered at most fps times a second (or right away
+# when a paragraph or code fence ends). Finished blocks are written once into
+# their own element and never re-sent, so each flush only carries the tail.
+class StreamRenderer:
+    def __init__(self, placeholder, fps: float = STREAM_RENDER_FPS, cursor: str = STREAM_CURSOR):
+        self.placeholder = placeholder
+        # Whatever the placeholder shows (e.g. a "Prepping..." note) stays until the first flush
+        self.container = None
+        self.tail = None
+        self.interval = 1.0 / fps if fps > 0 else 0.0
+        self.cursor = cursor
+        self.text = ""
+        self.committed = 0
+        self.deltas = 0
+        self.renders = 0
+        self.started = time.monotonic()
+        self.first_delta_at: Optional[float] = None
+        self.last_delta_at: Optional[float] = None
+        self._last_flush = 0.0
+
+    def write(self, delta: str):
+        if not delta:
+            return
+        now = time.monotonic()
+        if self.first_delta_at is None:
+            self.first_delta_at = now
+        self.last_delta_at = now
+        self.text += delta
+        self.deltas += 1
+        if now - self._last_flush >= self.interval or "\n\n" in delta or _FENCE in delta:
+            self.flush()
+
+    def flush(self, final: bool = False):
+        if self.container is None:
+            self.container = self.placeholder.container()
+            self.tail = self.container.empty()
+        pending = self.text[self.committed:]
+        boundary = _finished_blocks_end(pending)
+        if boundary:
+            # The current tail element keeps the finished blocks; new text goes to a fresh element
+            self.tail.markdown(pending[:boundary])
+            self.renders += 1
+            self.tail = self.container.empty()
+            self.committed += boundary
+            pending = pending[boundary:]
+        if pending or not final:
+            self.tail.markdown(pending if final else pending + self.cursor)
+            self.renders += 1
+        elif final:
+            self.tail.empty()
+        self._last_flush = time.monotonic()
+
+    # Function to render what is left without the cursor and return the full text
+    def close(self) -> str:
+        self.flush(final=True)
+        return self.text
+
+    def stats(self) -> dict:
+        streaming = 0.0
+        if self.first_delta_at is not None and self.last_delta_at is not None:
+            streaming = self.last_delta_at - self.first_delta_at
+        return {
+            "deltas": self.deltas,
+            "chars": len(self.text),
+            "renders": self.renders,
+            "time_to_first_delta": None if self.first_delta_at is None else self.first_delta_at - self.started,
+            "stream_seconds": streaming,
+            "tokens_per_second": self.deltas / streaming if streaming > 0 else 0.0,
+        }
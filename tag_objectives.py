@@ -0,0 +1,137 @@
+"""Tag the chunks of the course index with the learning objective they teach.
+
+Each chunk gets an `objective` metadata field: the index in LEARNING_OBJECTIVES
+whose description (title plus the tutor's objective message) its embedding is
+closest to. get_context then searches the current objective's chunks first and
+only widens to neighbouring objectives when they match poorly.
+
+In Pinecone the metadata of changed chunks is updated in place. A local snapshot
+is rewritten with its rows grouped by objective, so a search scans only the
+current objective's slice. Chunks that already carry a tag keep it unless
+--retag is given, so hand corrections survive a re-run.
+
+Usage:
+    python tag_objectives.py --openai-key $OPENAI_API_KEY --pinecone-key $PINECONE_API_KEY [--dry-run] [--retag]
+    python tag_objectives.py --openai-key $OPENAI_API_KEY --backend local [--snapshot index_snapshot]
+"""
+import argparse
+import os
+import time
+from collections import Counter
+from typing import List
+
+import numpy as np
+
+from clients import get_pinecone_index
+from config import (
+    INGEST_UPSERT_WORKERS,
+    LEARNING_OBJECTIVES,
+    LOCAL_INDEX_DIR,
+    OBJECTIVE_AMBIGUOUS_MARGIN,
+    PINECONE_INDEX_NAME,
+    PINECONE_NAMESPACE,
+)
+from export_index import fetch_namespace
+from governor import governor
+from ingest_course import run_batches
+from local_index import LocalIndex, write_snapshot
+from objective_partitions import assign_objectives, objective_embeddings
+
+
+# Function to decide every chunk's objective; existing tags are kept unless retag
+def tag(vectors: np.ndarray, metadata: List[dict], objective_vectors: np.ndarray, retag: bool = False) -> List[int]:
+    assigned, margins = assign_objectives(vectors, objective_vectors)
+    objectives = []
+    for meta, objective in zip(metadata, assigned):
+        objectives.append(int(meta["objective"]) if not retag and meta.get("objective") is not None else int(objective))
+    ambiguous = int((margins < OBJECTIVE_AMBIGUOUS_MARGIN).sum())
+    print(f"{ambiguous} of {len(metadata)} chunks are nearly as close to a second objective (margin < {OBJECTIVE_AMBIGUOUS_MARGIN})")
+    return objectives
+
+
+def print_distribution(objectives: List[int]):
+    counts = Counter(objectives)
+    for index, objective in enumerate(LEARNING_OBJECTIVES):
+        print(f"  {index:2d}  {counts.get(index, 0):6d}  {objective}")
+
+
+# Function to update the `objective` metadata of the chunks whose tag changed; returns how many were updated
+def tag_pinecone(pinecone_api_key: str, index_name: str, namespace: str, objective_vectors: np.ndarray,
+                 retag: bool = False, dry_run: bool = False, workers: int = INGEST_UPSERT_WORKERS) -> int:
+    index = get_pinecone_index(pinecone_api_key, index_name)
+    ids, vectors, metadata = fetch_namespace(index, namespace)
+    if not ids:
+        return 0
+    objectives = tag(np.asarray(vectors, dtype=np.float32), metadata, objective_vectors, retag)
+    print_distribution(objectives)
+    changed = [(vector_id, objective) for vector_id, meta, objective in zip(ids, metadata, objectives) if meta.get("objective") != objective]
+    if dry_run:
+        return len(changed)
+
+    def update(item) -> None:
+        vector_id, objective = item
+        governor.call("vector_upsert", pinecone_api_key, index.update, id=vector_id, set_metadata={"objective": objective}, namespace=namespace)
+
+    updated = [0]
+
+    def done(item, _):
+        updated[0] += 1
+        if updated[0] % 500 == 0:
+            print(f"Updated {updated[0]} of {len(changed)} chunks")
+
+    run_batches(iter(changed), update, done, workers)
+    return updated[0]
+
+
+# Function to rewrite a local snapshot with tagged chunks grouped by objective; returns how many tags changed
+def tag_local(directory: str, objective_vectors: np.ndarray, retag: bool = False, dry_run: bool = False) -> int:
+    snapshot = LocalIndex(directory)
+    # Read into memory first; the rewritten snapshot is a new version swapped in by write_snapshot
+    vectors = np.asarray(snapshot.vectors, dtype=np.float32)
+    if snapshot.scales is not None:
+        vectors = vectors * np.asarray(snapshot.scales)[:, None]
+    metadata = [dict(meta) for meta in snapshot.metadata]
+    objectives = tag(vectors, metadata, objective_vectors, retag)
+    print_distribution(objectives)
+    changed = sum(1 for meta, objective in zip(metadata, objectives) if meta.get("objective") != objective)
+    if dry_run:
+        return changed
+    for meta, objective in zip(metadata, objectives):
+        meta["objective"] = objective
+    # Re-quantizing rows that were already int8 gives back the same int8 codes
+    write_snapshot(directory, list(snapshot.ids), vectors, metadata, quantize="int8" if snapshot.scales is not None else None,
+                   extra_manifest={**snapshot.manifest, "tagged_at": time.time()})
+    return changed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tag course chunks with the learning objective they belong to.")
+    parser.add_argument("--openai-key", default=os.environ.get("OPENAI_API_KEY", ""))
+    parser.add_argument("--pinecone-key", default=os.environ.get("PINECONE_API_KEY", ""))
+    parser.add_argument("--backend", choices=["pinecone", "local"], default="pinecone")
+    parser.add_argument("--index", default=PINECONE_INDEX_NAME)
+    parser.add_argument("--namespace", default=PINECONE_NAMESPACE)
+    parser.add_argument("--snapshot", default=LOCAL_INDEX_DIR, help="Snapshot directory for --backend local")
+    parser.add_argument("--retag", action="store_true", help="Recompute tags of chunks that already have one")
+    parser.add_argument("--dry-run", action="store_true", help="Print the distribution without writing anything")
+    args = parser.parse_args()
+
+    if not args.openai_key:
+        parser.error("an OpenAI API key is required (--openai-key or OPENAI_API_KEY)")
+    if args.backend == "pinecone" and not args.pinecone_key:
+        parser.error("a Pinecone API key is required (--pinecone-key or PINECONE_API_KEY)")
+
+    start = time.time()
+    objective_vectors = objective_embeddings(args.openai_key)
+    if args.backend == "pinecone":
+        changed = tag_pinecone(args.pinecone_key, args.index, args.namespace, objective_vectors, args.retag, args.dry_run)
+        target = f"{args.index}/{args.namespace}"
+    else:
+        changed = tag_local(args.snapshot, objective_vectors, args.retag, args.dry_run)
+        target = args.snapshot
+    verb = "would change" if args.dry_run else "changed"
+    print(f"{changed} tags {verb} in {target} in {time.time() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
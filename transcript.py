@@ -0,0 +1,130 @@
+import re
+import uuid
+from functools import lru_cache
+from typing import List
+
+import streamlit as st
+
+from config import LEARNING_OBJECTIVES, OBJECTIVE_COMPLETED_MARKER, TRANSCRIPT_PAGE_SIZE, TRANSCRIPT_WINDOW
+
+
+# Function to extract YouTube video title from URL
+@lru_cache(maxsize=1024)
+def get_youtube_title(url: str) -> str:
+    # This is a simple regex to extract the video ID
+    video_id = re.search(r'(?:v=|\/)([0-9A-Za-z_-]{11}).*', url)
+    if video_id:
+        return f"YouTube Video (ID: {video_id.group(1)})"
+    return "YouTube Video"
+
+
+# Function to build the markdown for a list of references in one string
+def references_markdown(references: List[dict]) -> str:
+    parts = []
+    for i, ref in enumerate(references, 1):
+        parts.append(f"**Reference {i}** (Relevance Score: {ref['score']:.2f})")
+        parts.append(ref['text'])
+        if 'source' in ref and 'youtube.com' in ref['source']:
+            video_title = get_youtube_title(ref['source'])
+            parts.append(f"[{video_title}]({ref['source']})")
+        parts.append("---")
+    return "\n\n".join(parts)
+
+
+# Function to build the sidebar's learning steps as one block of HTML, once per objective
+@lru_cache(maxsize=None)
+def learning_steps_html(current_objective: int) -> str:
+    steps = []
+    for i, objective in enumerate(LEARNING_OBJECTIVES):
+        if i < current_objective:
+            class_name, text_class = "completed", "completed-text"
+        elif i == current_objective:
+            class_name, text_class = "active", "active-text"
+        else:
+            class_name, text_class = "", "inactive-text"
+        steps.append(f"""
+        <div class="step {class_name}">
+            <div class="circle"></div>
+            <span class="step-text {text_class}">{objective}</span>
+        </div>""")
+    return f"""
+    <div class="steps-container">
+        <h3>
+            <span class="target-emoji">🎯</span>
+            Learning Steps
+        </h3>
+        <div class="steps">
+            <div class="progress-line"></div>{"".join(steps)}
+        </div>
+    </div>
+    """
+
+
+# Everything needed to draw a finished message, computed once per message
+class _Prepared:
+    def __init__(self, message: dict):
+        self.key = uuid.uuid4().hex
+        content = message["content"]
+        self.image_url = None
+        if isinstance(content, list) and "text" in content[0] and "image_url" in content[1]:
+            self.text = content[0]["text"]
+            self.image_url = content[1]["image_url"]["url"]
+        else:
+            self.text = content
+        if OBJECTIVE_COMPLETED_MARKER in self.text:  # Stored with the answer, never shown
+            self.text = self.text.replace(OBJECTIVE_COMPLETED_MARKER, "").rstrip()
+        self.references = message.get("references") if message["role"] == "assistant" else None
+        self._references_markdown = None
+
+    @property
+    def references_markdown(self) -> str:
+        if self._references_markdown is None:
+            self._references_markdown = references_markdown(self.references)
+        return self._references_markdown
+
+
+def _prepared(message: dict, cache: dict, index: int) -> _Prepared:
+    cached = cache.get(index)
+    # Identity check: the conversation may have been cleared and refilled since
+    if cached is None or cached[0] is not message:
+        cached = cache[index] = (message, _Prepared(message))
+    return cached[1]
+
+
+def _render_message(message: dict, prepared: _Prepared):
+    with st.chat_message(message["role"]):
+        st.markdown(prepared.text)
+        if prepared.image_url:
+            st.image(prepared.image_url, caption="Attached Image", use_column_width=True)
+        if prepared.references is not None:
+            # Reference bodies are only built and sent when the student asks for them
+            if st.toggle("Show References", key=f"references_{prepared.key}"):
+                with st.container(border=True):
+                    st.markdown(prepared.references_markdown)
+
+
+# Function to render the chat history. Only the newest TRANSCRIPT_WINDOW visible
+# messages are drawn; older ones are revealed a page at a time.
+def render_transcript(messages: List[dict]):
+    cache = st.session_state.setdefault("transcript_cache", {})
+    if not messages:
+        st.session_state.transcript_extra = 0
+    if len(cache) > len(messages):
+        for index in [index for index in cache if index >= len(messages)]:
+            del cache[index]
+
+    if hasattr(messages, "visible_indices"):  # A stored conversation knows this without loading old messages
+        visible = messages.visible_indices()
+    else:
+        visible = [i for i, message in enumerate(messages) if not message.get("hidden", False)]
+    shown = TRANSCRIPT_WINDOW + st.session_state.get("transcript_extra", 0)
+    if len(visible) > shown:
+        hidden_count = len(visible) - shown
+        if st.button(f"Show earlier messages ({hidden_count})", key="show_earlier_messages"):
+            st.session_state.transcript_extra = st.session_state.get("transcript_extra", 0) + TRANSCRIPT_PAGE_SIZE
+            st.rerun()
+        visible = visible[-shown:]
+
+    for index in visible:
+        message = messages[index]
+        _render_message(message, _prepared(message, cache, index))
@@ -0,0 +1,184 @@
+import threading
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+from clients import get_async_openai_client, get_openai_client
+from config import CHAT_STALL_TIMEOUT, MODEL_CHAT, OBJECTIVE_COMPLETED_MARKER
+from governor import governor
+from metrics import metrics
+from prompt_builder import build_tutor_prompt
+from retrieval import get_context
+
+_hidden_context: Dict[str, Tuple[str, List[dict]]] = {}
+_hidden_context_lock = threading.Lock()
+
+
+# Function to generate AI response with streaming and memory. The prompt is packed
+# into the token budgets by build_tutor_prompt; its token breakdown is copied into
+# prompt_report when one is passed.
+def generate_ai_response(prompt: str, references: List[dict], api_key: str, chat_history: List[dict], current_objective: int,
+                         image_url=None, summary_state: Optional[dict] = None, prompt_report: Optional[dict] = None):
+    client = get_openai_client(api_key)
+    try:
+        params = _chat_params(references, chat_history, current_objective, summary_state, prompt_report)
+
+        # Waits for a free slot under the process-wide limits; the slot is held while the answer streams
+        response = governor.stream("chat", api_key, client.chat.completions.create, **params)
+
+        return response
+    except Exception as e:
+        return f"An error occurred: {str(e)}"
+
+
+# Function to open a streamed answer from async code (the tutor engine); same prompt and limits as generate_ai_response
+async def agenerate_ai_response(prompt: str, references: List[dict], api_key: str, chat_history: List[dict], current_objective: int,
+                                image_url=None, summary_state: Optional[dict] = None, prompt_report: Optional[dict] = None):
+    client = get_async_openai_client(api_key)
+    try:
+        params = _chat_params(references, chat_history, current_objective, summary_state, prompt_report)
+        return await governor.astream("chat", api_key, client.chat.completions.create, **params)
+    except Exception as e:
+        return f"An error occurred: {str(e)}"
+
+
+def _chat_params(references: List[dict], chat_history: List[dict], current_objective: int,
+                 summary_state: Optional[dict], prompt_report: Optional[dict]) -> dict:
+    with metrics.span("prompt_build") as span:
+        messages, report = build_tutor_prompt(current_objective, references, chat_history, summary_state)
+        span.update(report)
+    if prompt_report is not None:
+        prompt_report.update(report)
+
+    # Create a dictionary of parameters
+    return {
+        "model": MODEL_CHAT,
+        "messages": messages,
+        "max_tokens": 1600,
+        "n": 1,
+        "temperature": 0.7,
+        "stream": True,
+        "timeout": CHAT_STALL_TIMEOUT,  # Connect and between-token limit, so a stalled stream ends the turn
+    }
+
+
+# Function to turn a streamed completion (or a replayed cached answer) into text deltas
+def stream_text(response) -> Iterator[str]:
+    for chunk in response:
+        content = chunk if isinstance(chunk, str) else chunk.choices[0].delta.content
+        if content is not None:
+            yield content
+
+
+# Finds the completion marker in a streamed answer as it arrives. Text that could be
+# the start of a marker split across deltas is held back until the next delta shows
+# whether it is, so the marker never reaches the screen.
+class CompletionDetector:
+    def __init__(self, marker: str = OBJECTIVE_COMPLETED_MARKER, on_complete: Optional[Callable[[], None]] = None):
+        self.marker = marker
+        self.on_complete = on_complete
+        self.completed = False
+        self.text = ""  # Everything released for display, without the marker
+        self._held = ""
+
+    # Function to take the next delta and return the part that is safe to display
+    def feed(self, delta: str) -> str:
+        if self.completed:
+            return ""
+        pending = self._held + delta
+        found = pending.find(self.marker)
+        if found >= 0:
+            self._held = ""
+            self.completed = True
+            if self.on_complete is not None:
+                self.on_complete()
+            return self._release(pending[:found])
+        held = _partial_marker_length(pending, self.marker)
+        self._held = pending[len(pending) - held:] if held else ""
+        return self._release(pending[:len(pending) - held])
+
+    # Function to release what was held back once the stream has ended without the marker
+    def flush(self) -> str:
+        held, self._held = self._held, ""
+        return self._release(held)
+
+    # Function to get the answer as it is stored: the displayed text, plus the marker if it was seen
+    def content(self) -> str:
+        return f"{self.text.rstrip()}\n\n{self.marker}" if self.completed else self.text
+
+    def _release(self, text: str) -> str:
+        self.text += text
+        return text
+
+
+# Length of the longest suffix of text that is a proper prefix of marker
+def _partial_marker_length(text: str, marker: str) -> int:
+    for length in range(min(len(text), len(marker) - 1), 0, -1):
+        if marker.startswith(text[-length:]):
+            return length
+    return 0
+
+
+# Function to stream an answer's displayable text through a detector. Once the marker
+# arrives nothing after it is wanted, so the stream is closed right away to free the
+# connection and the chat slot and stop paying for output tokens.
+def stream_until_complete(response, detector: CompletionDetector) -> Iterator[str]:
+    try:
+        for delta in stream_text(response):
+            visible = detector.feed(delta)
+            if visible:
+                yield visible
+            if detector.completed:
+                metrics.incr("chat", "early_stops")
+                return
+        rest = detector.flush()
+        if rest:
+            yield rest
+    finally:
+        if detector.completed and hasattr(response, "close"):
+            response.close()
+
+
+# Function to stream an async answer's displayable text through a detector, closing it at the marker
+async def astream_until_complete(response, detector: CompletionDetector) -> AsyncIterator[str]:
+    try:
+        async for chunk in response:
+            content = chunk.choices[0].delta.content
+            visible = detector.feed(content) if content is not None else ""
+            if visible:
+                yield visible
+            if detector.completed:
+                metrics.incr("chat", "early_stops")
+                return
+        rest = detector.flush()
+        if rest:
+            yield rest
+    finally:
+        if detector.completed:
+            await response.aclose()
+
+
+# Function to strip the completion marker from a stored answer for display
+def displayed_text(content: str) -> str:
+    return content.replace(OBJECTIVE_COMPLETED_MARKER, "").rstrip() if OBJECTIVE_COMPLETED_MARKER in content else content
+
+
+# Function to build the hidden message that opens the next objective
+def hidden_message_for(previous_objective: str) -> str:
+    return f"You just helped me complete '{previous_objective}'. What am I looking forward to, in this one?"
+
+
+# Function to get the retrieval context for a hidden message. It has no chat
+# history, so the result is the same for every student and is computed once per process.
+def get_hidden_context(hidden_message: str, openai_api_key: str, pinecone_api_key: str,
+                       current_objective: Optional[int] = None) -> Tuple[str, List[dict]]:
+    with _hidden_context_lock:
+        cached = _hidden_context.get(hidden_message)
+    if cached is not None:
+        return cached
+    chat_history = [{"role": "user", "content": hidden_message, "hidden": True}]
+    status = {}
+    context, references = get_context(hidden_message, chat_history, openai_api_key, pinecone_api_key,
+                                      current_objective=current_objective, status=status)
+    if references and status["degraded"] is None:  # Don't pin the result of a failed retrieval
+        with _hidden_context_lock:
+            _hidden_context[hidden_message] = (context, references)
+    return context, references
@@ -0,0 +1,267 @@
+"""HTTP service for the tutor engine.
+
+Serves the chat turn pipeline (engine.TutorEngine) to any frontend. Connections are
+kept alive between requests, and turn events stream back as server-sent events in
+chunked responses: each event is written and drained before the next one is read
+from the turn, so a slow reader holds back only its own turn.
+
+Endpoints:
+    GET  /healthz                          engine stats
+    GET  /sessions/{id}                    objective and completion state
+    GET  /sessions/{id}/history            visible messages (?before=N&limit=N)
+    POST /sessions/{id}/turns              {"text": ..., "image_url": ...}; streams the answer
+    POST /sessions/{id}/advance            moves to the next objective; streams its introduction
+    POST /sessions/{id}/reset              {"objective": N or null}; starts a fresh conversation
+
+Every request must carry the shared token as "Authorization: Bearer <token>"; the
+server reads it from --token or TUTOR_ENGINE_TOKEN and refuses to start without one.
+The app sends the same token from its TUTOR_ENGINE_TOKEN secret. API keys are read
+from the X-OpenAI-Key and X-Pinecone-Key headers. Only with --env-keys (or
+ENGINE_ENV_KEYS) do requests without them fall back to OPENAI_API_KEY and
+PINECONE_API_KEY in the server's environment.
+
+With --workers N, N processes are started and worker i listens on port + i. Each
+session belongs to one worker (by a hash of its id); list every worker's URL in
+TUTOR_ENGINE_URL and the app's client routes each session to its worker. Each
+worker also exports its own metrics, on --metrics-port + i.
+
+Usage (from the repository root):
+    TUTOR_ENGINE_TOKEN=... python tutor_server.py                            # one worker on ENGINE_PORT
+    TUTOR_ENGINE_TOKEN=... python tutor_server.py --workers 4 --port 8765    # workers on 8765-8768
+"""
+import argparse
+import asyncio
+import hmac
+import json
+import os
+import re
+import sys
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+from clients import registry
+from config import ENGINE_ENV_KEYS, ENGINE_HISTORY_PAGE, ENGINE_HOST, ENGINE_PORT, ENGINE_WORKERS, METRICS_PORT
+from engine import EngineBusy, TutorEngine, shard_for
+from metrics import logger, start_metrics_server
+
+_ROUTE = re.compile(r"^/sessions/([A-Za-z0-9_-]{1,128})(/history|/turns|/advance|/reset)?$")
+_MAX_BODY = 16 * 1024 * 1024  # Inline (data URL) images make for large turn requests
+_REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found", 405: "Method Not Allowed",
+            409: "Conflict", 413: "Payload Too Large", 421: "Misdirected Request", 503: "Service Unavailable"}
+
+
+class _HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class TutorServer:
+    def __init__(self, engine: TutorEngine, token: str, worker: int = 0, workers: int = 1, env_keys: bool = ENGINE_ENV_KEYS):
+        self.engine = engine
+        self.token = token
+        self.worker = worker
+        self.workers = workers
+        self.env_keys = env_keys
+
+    # Function to serve one keep-alive connection, a request at a time
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                try:
+                    await self.route(method, target, headers, body, writer)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    raise
+                except _HttpError as e:
+                    await _send_json(writer, e.status, {"error": str(e)})
+                except EngineBusy as e:
+                    await _send_json(writer, 503, {"error": str(e)})
+                except Exception as e:
+                    logger.exception("Error handling %s %s: %s", method, target, e)
+                    await _send_json(writer, 500, {"error": f"An error occurred: {str(e)}"})
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # The client went away
+        except _HttpError as e:
+            await _send_json(writer, e.status, {"error": str(e)})
+        finally:
+            writer.close()
+
+    async def route(self, method: str, target: str, headers: dict, body: bytes, writer: asyncio.StreamWriter):
+        scheme, _, token = headers.get("authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not hmac.compare_digest(token.strip().encode(), self.token.encode()):
+            raise _HttpError(401, "A valid bearer token is required")
+        url = urlsplit(target)
+        if url.path == "/healthz":
+            return await _send_json(writer, 200, {"worker": self.worker, **self.engine.stats()})
+        match = _ROUTE.match(url.path)
+        if match is None:
+            raise _HttpError(404, f"No route for {url.path}")
+        session_id, action = match.group(1), match.group(2) or ""
+        if self.workers > 1 and shard_for(session_id, self.workers) != self.worker:
+            raise _HttpError(421, f"Session belongs to worker {shard_for(session_id, self.workers)}")
+        expected = "GET" if action in ("", "/history") else "POST"
+        if method != expected:
+            raise _HttpError(405, f"Use {expected} for {url.path}")
+
+        if action == "":
+            return await _send_json(writer, 200, await self.engine.state(session_id))
+        if action == "/history":
+            query = parse_qs(url.query)
+            before = _int_param(query, "before")
+            limit = _int_param(query, "limit") or ENGINE_HISTORY_PAGE
+            return await _send_json(writer, 200, await self.engine.history(session_id, before, min(limit, 500)))
+
+        payload = _json_body(body)
+        if action == "/reset":
+            try:
+                return await _send_json(writer, 200, await self.engine.reset(session_id, payload.get("objective")))
+            except ValueError as e:
+                raise _HttpError(400, str(e))
+
+        openai_api_key = headers.get("x-openai-key") or (os.environ.get("OPENAI_API_KEY", "") if self.env_keys else "")
+        pinecone_api_key = headers.get("x-pinecone-key") or (os.environ.get("PINECONE_API_KEY", "") if self.env_keys else "")
+        if not openai_api_key or not pinecone_api_key:
+            raise _HttpError(400, "OpenAI and Pinecone API keys are required")
+        if action == "/turns":
+            text = payload.get("text")
+            if not isinstance(text, str) or not text.strip():
+                raise _HttpError(400, "text is required")
+            turn = await self.engine.submit(session_id, text, openai_api_key, pinecone_api_key, payload.get("image_url") or None)
+        else:
+            try:
+                turn = await self.engine.advance(session_id, openai_api_key, pinecone_api_key)
+            except ValueError as e:
+                raise _HttpError(409, str(e))
+        await _stream_events(writer, turn)
+
+
+# Function to write a turn's events as server-sent events; a client that leaves is detached from the turn
+async def _stream_events(writer: asyncio.StreamWriter, turn):
+    writer.write(_head(200, {"Content-Type": "text/event-stream", "Cache-Control": "no-cache", "Transfer-Encoding": "chunked"}))
+    try:
+        async for event, data in turn.events():
+            payload = f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+            writer.write(b"%x\r\n%s\r\n" % (len(payload), payload))
+            await writer.drain()  # Backpressure: the next event waits until this one is on its way
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+    except (ConnectionError, asyncio.CancelledError):
+        turn.detach()
+        raise
+
+
+async def _read_request(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, _ = line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise _HttpError(400, "Malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length") or 0)
+    except ValueError:
+        raise _HttpError(400, "Malformed Content-Length")
+    if length < 0:
+        raise _HttpError(400, "Malformed Content-Length")
+    if length > _MAX_BODY:
+        raise _HttpError(413, "Request body too large")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), target, headers, body
+
+
+def _head(status: int, headers: dict) -> bytes:
+    lines = [f"HTTP/1.1 {status} {_REASONS.get(status, 'Internal Server Error')}"]
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+async def _send_json(writer: asyncio.StreamWriter, status: int, payload: dict):
+    body = json.dumps(payload).encode()
+    writer.write(_head(status, {"Content-Type": "application/json", "Content-Length": len(body)}) + body)
+    await writer.drain()
+
+
+def _json_body(body: bytes) -> dict:
+    if not body:
+        return {}
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        raise _HttpError(400, "Body is not valid JSON")
+    if not isinstance(payload, dict):
+        raise _HttpError(400, "Body must be a JSON object")
+    return payload
+
+
+def _int_param(query: dict, name: str) -> Optional[int]:
+    values = query.get(name)
+    if not values:
+        return None
+    try:
+        return int(values[0])
+    except ValueError:
+        raise _HttpError(400, f"{name} must be an integer")
+
+
+async def serve(host: str, port: int, token: str, worker: int, workers: int, env_keys: bool):
+    server = TutorServer(TutorEngine(), token, worker, workers, env_keys)
+    listener = await asyncio.start_server(server.handle, host, port, reuse_address=True)
+    print(f"Tutor engine worker {worker} listening on {host}:{port}")
+    async with listener:
+        await listener.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the tutor engine over HTTP.")
+    parser.add_argument("--host", default=ENGINE_HOST)
+    parser.add_argument("--port", type=int, default=ENGINE_PORT, help="Port of the first worker")
+    parser.add_argument("--workers", type=int, default=ENGINE_WORKERS, help="Worker processes, on consecutive ports")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="Metrics port of the first worker")
+    parser.add_argument("--token", default=os.environ.get("TUTOR_ENGINE_TOKEN", ""), help="Shared bearer token every request must carry")
+    parser.add_argument("--env-keys", action="store_true", default=ENGINE_ENV_KEYS,
+                        help="Use this server's OPENAI_API_KEY and PINECONE_API_KEY for requests that send no keys")
+    args = parser.parse_args()
+    if not args.token:
+        parser.error("a shared token is required (--token or TUTOR_ENGINE_TOKEN)")
+
+    worker = 0
+    children = []
+    for index in range(1, args.workers):
+        pid = os.fork()
+        if pid == 0:
+            worker, children = index, []
+            break
+        children.append(pid)
+    if args.metrics_port is not None:
+        start_metrics_server(args.metrics_port + worker)  # Scrape every worker's port; each process keeps its own metrics
+    try:
+        asyncio.run(serve(args.host, args.port + worker, args.token, worker, args.workers, args.env_keys))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        registry.close_all()  # Close the pooled provider connections of this worker
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()